@@ -0,0 +1,388 @@
+# pylint: disable=line-too-long, broad-exception-caught
+'''
+Script batch_costing.py
+
+A python script to run the costing stages (build_costs, disburse_costs, build_events and distribute_costs)
+for a batch of hospital_code/model_code/run_code jobs, running stages in parallel where possible.
+
+    SYNOPSIS:
+    $ python batch_costing.py [job ...]
+        [-j jobsFile|--jobsFile=jobsFile]
+        [-w workers|--workers=workers]
+        [-W writers|--writers=writers]
+        [-F|--fixedPoint]
+        [-t tolerance|--tolerance=tolerance]
+        [-T|--telemetryHistory]
+        [-D DatabaseType|--DatabaseType=DatabaseType]
+        [-C configDir|--configDir=configDir]
+        [-c configFile|--configFile=configFile]
+        [-s server|--server=server]
+        [-u username|--username=username]
+        [-p password|--password=password]
+        [-d databaseName|--databaseName=databaseName]
+        [-v loggingLevel|--verbose=logingLevel]
+        [-L logDir|--logDir=logDir]
+        [-l logfile|--logfile=logfile]
+        [--profile[=mode]]
+        [--traceMemory]
+        [--roundTripThreshold=threshold]
+
+    REQUIRED
+    job
+    A job to be run, as hospital_code,model_code,run_code[,iterate]
+    (there must be at least one job on the command line or in the jobsFile)
+
+    -D DatabaseType|--DatabaseType=DatabaseType
+    The type of database [choice:MSSQL/MySQL/SQLite]
+
+
+    OPTIONS
+    -j jobsFile|--jobsFile=jobsFile
+    An Excel workbook (.xlsx) or CSV file (.csv) of jobs with the columns
+    hospital_code, model_code, run_code and, optionally, iterate.
+
+    -w workers|--workers=workers
+    The maximum number of stages that can be run at the same time (default=number of CPUs)
+
+    -W writers|--writers=writers
+    The maximum number of stages that can be writing to the database at the same time (default=workers)
+
+    -F|--fixedPoint
+    Run the build_costs, disburse_costs and distribute_costs stages in fixed point mode
+    (costs held as integer units of 0.00001 dollars and apportioned so that the total cost is conserved exactly).
+
+    -t tolerance|--tolerance=tolerance
+    The cost conservation tolerance, in dollars, for the build_costs, disburse_costs and distribute_costs stages (default=0.01).
+    A stage fails if the costs it saves (plus any costs it releases) differ from the costs it read by more than this.
+
+    -T|--telemetryHistory
+    Have every stage append it's telemetry to the stage_telemetry table
+    (every stage always writes a JSON telemetry report next to it's log file)
+
+    -C configDir|--configDir=configDir
+    The directory containing the database connection configuration file
+    (default='databaseConfig')
+
+    -c configFile|--configFile=configFile
+    The database connection configuration file (default=clinical_costing.json)
+    which has the default database values for each Database Type.
+    These can be overwritten using command line options.
+
+    -s server|--server=server]
+    The address of the database server
+
+    -u userName|--userName=userName]
+    The user name require to access the database
+
+    -p password|--userName=userName]
+    The user password require to access the database
+
+    -d databaseName|--databaseName=databaseName]
+    The name of the database
+
+    -v loggingLevel|--verbose=loggingLevel
+    Set the level of logging that you want.
+
+    -L logDir|--logDir=logDir
+    The directory where the log file will be created (default=".").
+    Each job logs to it's own hospital_code_model_code_run_code sub-directory of logDir.
+
+    -l logfile|--logfile=logfile
+    The name of a log file where you want all messages captured.
+
+    --profile[=mode]
+    Profile this run [choice:cprofile/sampling] (default=cprofile) and save the pstats file (cprofile only)
+    and a collapsed-stack file (for flame graphs) in logDir, named after the stage, hospital, model and run.
+
+    --traceMemory
+    Trace memory allocations and save a memory report in logDir, with the top allocation sites
+    and the size of each DataFrame at each step of the stage.
+
+    --roundTripThreshold=threshold
+    When the SQL is profiled (INFO or DEBUG logging), report the SQL shapes executed more than threshold times
+    as possible N+1 patterns (default=100).
+
+
+    THE MAIN CODE
+    Start by parsing the command line arguements and setting up logging.
+    Then assemble the list of jobs and run each stage of each job as a separate process,
+    as soon as the stages it depends upon have completed.
+    Then report the timings for every stage of every job.
+'''
+
+# pylint: disable=invalid-name, bare-except, pointless-string-statement, unspecified-encoding
+
+import os
+import sys
+import argparse
+import logging
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import pandas as pd
+import functions as f
+import telemetry_functions as tf
+import conservation_functions as cf
+import data as d
+
+
+# The costing stages, the stages that must complete before each stage can start,
+# whether the stage writes to the database, and any lock that the stage must hold while it runs.
+# build_events can add new distribution codes to the model, so only one build_events can run for a model at any one time.
+stages = {
+    'build_costs': {'after': [], 'writer': True, 'lock': None},
+    'disburse_costs': {'after': ['build_costs'], 'writer': True, 'lock': None},
+    'build_events': {'after': [], 'writer': True, 'lock': 'model'},
+    'distribute_costs': {'after': ['disburse_costs', 'build_events'], 'writer': True, 'lock': None},
+}
+
+
+def runStage(command, outFile):
+    '''
+    Run one stage of one job as a separate process, capturing stdout and stderr in outFile
+    '''
+    start = time.time()
+    with open(outFile, 'wt', encoding='utf-8', newline='') as output:
+        returnCode = subprocess.call(command, stdout=output, stderr=subprocess.STDOUT)
+    return (returnCode, start, time.time())
+
+
+if __name__ == '__main__':
+    '''
+    The main code
+    Start by parsing the command line arguements and setting up logging.
+    Then assemble the jobs and check that they are unique.
+    Then run the stages, respecting the stage dependencies within each job and the limit on concurrent database writers.
+    Then report the timings.
+    '''
+
+    # Save the program name
+    progName = sys.argv[0]
+    progName = progName[0:-3]        # Strip off the .py ending
+
+    # Set the options
+    parser = argparse.ArgumentParser(description='Run the Clinical Costing stages for a batch of hospitals, models and runs')
+    parser.add_argument('job', nargs='*',
+                        help='A job to be run as hospital_code,model_code,run_code[,iterate]')
+    parser.add_argument('-j', '--jobsFile', dest='jobsFile',
+                        help='An Excel workbook or CSV file with the columns hospital_code, model_code, run_code and, optionally, iterate')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=os.cpu_count(),
+                        help='The maximum number of stages to run at the same time (default=number of CPUs)')
+    parser.add_argument('-W', '--writers', dest='writers', type=int,
+                        help='The maximum number of stages writing to the database at the same time (default=workers)')
+    parser.add_argument('-F', '--fixedPoint', dest='fixedPoint', action='store_true',
+                        help='Hold the costs as integer cost units and apportion them exactly')
+    cf.addConservationArguments(parser)   # Add the conservation command line arguments
+    tf.addTelemetryArguments(parser)  # Add the telemetry command line arguments
+    f.addCommonArguments(parser)      # Add the common command line arguments
+    args = parser.parse_args()
+
+    # Parse the command line options
+    jobArgs = args.job
+    jobsFile = args.jobsFile
+    workers = args.workers
+    writers = args.writers
+    fixedPoint = args.fixedPoint
+    costTolerance = args.costTolerance
+    configDir = args.configDir
+    configFile = args.configFile
+    DatabaseType = args.DatabaseType
+    server = args.server
+    username = args.username
+    password = args.password
+    databaseName = args.databaseName
+    logDir = args.logDir
+    logFile = args.logFile
+    loggingLevel = args.verbose
+    telemetryHistory = args.telemetryHistory
+    profile = args.profile
+    traceMemory = args.traceMemory
+    roundTripThreshold = args.roundTripThreshold
+
+    # Set up logging
+    f.setupLogging(progName, logDir, logFile, loggingLevel)
+
+    if (workers is None) or (workers < 1):
+        workers = 1
+    if (writers is None) or (writers > workers):
+        writers = workers
+    if writers < 1:
+        logging.critical('The number of writers (%d) must be at least 1', writers)
+        logging.shutdown()
+        sys.exit(d.EX_USAGE)
+
+    # Assemble the jobs
+    jobs = []
+    for job in jobArgs:
+        jobParts = job.split(',')
+        if len(jobParts) not in [3, 4]:
+            logging.critical('Invalid job (%s) - must be hospital_code,model_code,run_code[,iterate]', job)
+            logging.shutdown()
+            sys.exit(d.EX_USAGE)
+        iterate = False
+        if len(jobParts) == 4:
+            iterate = jobParts[3].strip().lower() in ['1', 'y', 'yes', 'true', 'iterate']
+        jobs.append({'hospital_code':jobParts[0].strip(), 'model_code':jobParts[1].strip(), 'run_code':jobParts[2].strip(), 'iterate':iterate})
+    if jobsFile is not None:
+        try:
+            if jobsFile.endswith('.csv'):
+                jobs_df = pd.read_csv(jobsFile, dtype=str, keep_default_na=False)
+            else:
+                jobs_df = pd.read_excel(jobsFile, dtype=str, keep_default_na=False)
+        except Exception as e:
+            logging.critical('Cannot read jobsFile (%s) - error(%s)', jobsFile, repr(e))
+            logging.shutdown()
+            sys.exit(d.EX_NOINPUT)
+        for column in ['hospital_code', 'model_code', 'run_code']:
+            if column not in jobs_df.columns:
+                logging.critical('jobsFile (%s) is missing column "%s"', jobsFile, column)
+                logging.shutdown()
+                sys.exit(d.EX_DATAERR)
+        if 'iterate' not in jobs_df.columns:
+            jobs_df['iterate'] = ''
+        for row in jobs_df.itertuples():
+            if row.hospital_code.strip() == '':
+                continue
+            jobs.append({'hospital_code':row.hospital_code.strip(), 'model_code':row.model_code.strip(), 'run_code':row.run_code.strip(),
+                         'iterate':row.iterate.strip().lower() in ['1', 'y', 'yes', 'true', 'iterate']})
+    if len(jobs) == 0:
+        logging.critical('No jobs to run')
+        logging.shutdown()
+        sys.exit(d.EX_USAGE)
+
+    # Check that each job is unique - two jobs for the same hospital/model/run would delete each other's results
+    jobKeys = set()
+    for job in jobs:
+        jobKey = (job['hospital_code'], job['model_code'], job['run_code'])
+        if jobKey in jobKeys:
+            logging.critical('Duplicate job (%s)', ','.join(jobKey))
+            logging.shutdown()
+            sys.exit(d.EX_USAGE)
+        jobKeys.add(jobKey)
+
+    # The common database arguments passed to every stage
+    commonArgs = []
+    for option, value in [('-C', configDir), ('-c', configFile), ('-D', DatabaseType), ('-s', server),
+                          ('-u', username), ('-p', password), ('-d', databaseName)]:
+        if value is not None:
+            commonArgs += [option, value]
+    if loggingLevel is not None:
+        commonArgs += ['-v', str(loggingLevel)]
+    if telemetryHistory:
+        commonArgs.append('-T')
+    if profile is not None:
+        commonArgs.append('--profile=' + profile)
+    if traceMemory:
+        commonArgs.append('--traceMemory')
+    if roundTripThreshold is not None:
+        commonArgs.append('--roundTripThreshold=' + str(roundTripThreshold))
+
+    # Each job logs to it's own sub-directory so that the stage log files (and undistributed_costs.xlsx) are not overwritten
+    for job in jobs:
+        job['logDir'] = os.path.join(logDir, job['hospital_code'] + '_' + job['model_code'] + '_' + job['run_code'])
+        os.makedirs(job['logDir'], exist_ok=True)
+
+    # Run the stages
+    status = {}         # The status of each stage of each job - pending, running, done, failed or skipped
+    timings = {}        # The start and end time of each completed stage of each job
+    for jobNo, job in enumerate(jobs):
+        for stage in stages:
+            status[(jobNo, stage)] = 'pending'
+    running = {}        # The stage for each running future
+    locks = set()       # The locks held by running stages
+    activeWriters = 0
+    batchStart = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            # Start every pending stage that is ready to run
+            for (jobNo, stage), stageStatus in status.items():
+                if stageStatus != 'pending':
+                    continue
+                if len(running) >= workers:
+                    break
+                job = jobs[jobNo]
+                after = [status[(jobNo, prior)] for prior in stages[stage]['after']]
+                if ('failed' in after) or ('skipped' in after):
+                    logging.warning('Skipping %s for job %s,%s,%s - a prior stage did not complete', stage, job['hospital_code'], job['model_code'], job['run_code'])
+                    status[(jobNo, stage)] = 'skipped'
+                    continue
+                if any(priorStatus != 'done' for priorStatus in after):
+                    continue
+                if stages[stage]['writer'] and (activeWriters >= writers):
+                    continue
+                lock = None
+                if stages[stage]['lock'] == 'model':
+                    lock = (stage, job['hospital_code'], job['model_code'])
+                    if lock in locks:
+                        continue
+                command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), stage + '.py'), job['hospital_code'], job['model_code'], job['run_code']] + commonArgs
+                command += ['-L', job['logDir'], '-l', stage + '.log']
+                if (stage == 'disburse_costs') and job['iterate']:
+                    command.append('-i')
+                if fixedPoint and (stage != 'build_events'):
+                    command.append('-F')
+                if stage != 'build_events':
+                    command += ['-t', str(costTolerance)]
+                logging.info('Starting %s for job %s,%s,%s', stage, job['hospital_code'], job['model_code'], job['run_code'])
+                future = executor.submit(runStage, command, os.path.join(job['logDir'], stage + '.out'))
+                running[future] = (jobNo, stage, lock)
+                status[(jobNo, stage)] = 'running'
+                if stages[stage]['writer']:
+                    activeWriters += 1
+                if lock is not None:
+                    locks.add(lock)
+            if len(running) == 0:
+                break
+
+            # Wait for a stage to finish
+            finished, notFinished = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                (jobNo, stage, lock) = running.pop(future)
+                job = jobs[jobNo]
+                if stages[stage]['writer']:
+                    activeWriters -= 1
+                if lock is not None:
+                    locks.discard(lock)
+                try:
+                    (returnCode, start, end) = future.result()
+                except Exception as e:
+                    logging.error('Cannot run %s for job %s,%s,%s - error(%s)', stage, job['hospital_code'], job['model_code'], job['run_code'], repr(e))
+                    status[(jobNo, stage)] = 'failed'
+                    continue
+                timings[(jobNo, stage)] = (start, end, returnCode)
+                if returnCode == d.EX_OK:
+                    status[(jobNo, stage)] = 'done'
+                    logging.info('Finished %s for job %s,%s,%s in %.1f seconds', stage, job['hospital_code'], job['model_code'], job['run_code'], end - start)
+                else:
+                    status[(jobNo, stage)] = 'failed'
+                    logging.error('%s for job %s,%s,%s failed with exit code %d - see %s', stage, job['hospital_code'], job['model_code'], job['run_code'],
+                                  returnCode, os.path.join(job['logDir'], stage + '.log'))
+    batchEnd = time.time()
+
+    # Assemble the timing summary
+    summary = []
+    for (jobNo, stage), stageStatus in status.items():
+        job = jobs[jobNo]
+        row = {'hospital_code':job['hospital_code'], 'model_code':job['model_code'], 'run_code':job['run_code'], 'stage':stage, 'status':stageStatus,
+               'exit_code':None, 'started':None, 'seconds':None}
+        if (jobNo, stage) in timings:
+            (start, end, returnCode) = timings[(jobNo, stage)]
+            row['exit_code'] = returnCode
+            row['started'] = round(start - batchStart, 1)
+            row['seconds'] = round(end - start, 1)
+        summary.append(row)
+    summary_df = pd.DataFrame(summary)
+    stageSeconds = summary_df['seconds'].sum()
+    batchSeconds = batchEnd - batchStart
+    print(summary_df.to_string(index=False))
+    print(f'{len(jobs)} jobs, {len(summary_df.index)} stages, {stageSeconds:.1f} stage seconds in {batchSeconds:.1f} seconds elapsed using {workers} workers and {writers} writers')
+    try:
+        summary_df.to_excel(os.path.join(logDir, 'batch_timings.xlsx'), index=False)
+    except Exception as e:
+        logging.warning('Cannot save batch timings to %s - error(%s)', os.path.join(logDir, 'batch_timings.xlsx'), repr(e))
+
+    # Wrap it up
+    logging.shutdown()
+    if (summary_df['status'] != 'done').any():
+        sys.exit(d.EX_SOFTWARE)
+    sys.exit(d.EX_OK)
@@ -9,6 +9,9 @@ by mapping, grouping and folding.
 
     SYNOPSIS:
     $ python build.py hospital_code model_code run_code
+        [-F|--fixedPoint]
+        [-t tolerance|--tolerance=tolerance]
+        [-T|--telemetryHistory]
         [-D DatabaseType|--DatabaseType=DatabaseType]
         [-C configDir|--configDir=configDir]
         [-c configFile|--configFile=configFile]
@@ -19,6 +22,9 @@ by mapping, grouping and folding.
         [-v loggingLevel|--verbose=logingLevel]
         [-L logDir|--logDir=logDir]
         [-l logfile|--logfile=logfile]
+        [--profile[=mode]]
+        [--traceMemory]
+        [--roundTripThreshold=threshold]
 
     REQUIRED
     hospital_code
@@ -32,10 +38,23 @@ by mapping, grouping and folding.
     The run code for the source data being used to build the general ledger costs.
 
     -D DatabaseType|--DatabaseType=DatabaseType
-    The type of database [choice:MSSQL/MySQL]
+    The type of database [choice:MSSQL/MySQL/SQLite]
 
 
     OPTIONS
+    -F|--fixedPoint
+    Hold the costs as integers (in units of 0.00001 dollars) rather than floating point numbers,
+    so that adjusting, mapping and grouping the costs conserves the total cost exactly.
+
+    -t tolerance|--tolerance=tolerance
+    The largest difference, in dollars, between the total cost saved and the total cost read from general_ledger_costs,
+    that is not a failure (default=0.01). The total is checked as each of general_ledger_adjusted, general_ledger_mapped
+    and general_ledger_built is saved.
+
+    -T|--telemetryHistory
+    Append the telemetry for this run (which is always written as a JSON report next to the log file)
+    to the stage_telemetry table
+
     -C configDir|--configDir=configDir
     The directory containing the database connection configuration file
     (default='databaseConfig')
@@ -66,11 +85,23 @@ by mapping, grouping and folding.
     -o logfile|--logfile=logfile
     The name of a log file where you want all messages captured.
 
+    --profile[=mode]
+    Profile this run [choice:cprofile/sampling] (default=cprofile) and save the pstats file (cprofile only)
+    and a collapsed-stack file (for flame graphs) in logDir, named after the stage, hospital, model and run.
+
+    --traceMemory
+    Trace memory allocations and save a memory report in logDir, with the top allocation sites
+    and the size of each DataFrame at each step of the stage.
+
+    --roundTripThreshold=threshold
+    When the SQL is profiled (INFO or DEBUG logging), report the SQL shapes executed more than threshold times
+    as possible N+1 patterns (default=100).
+
 
     THE MAIN CODE
     Start by parsing the command line arguements and setting up logging.
     Connect to the database and read the configuration from an Excel workbook.
-    Then assemble the build the cost data.
+    Then assemble the build the cost data, in the staging tables, and publish it in a single transaction.
 '''
 
 # pylint: disable=invalid-name, bare-except, pointless-string-statement, unspecified-encoding
@@ -79,8 +110,10 @@ import sys
 import argparse
 import logging
 import pandas as pd
-from sqlalchemy import text, delete
+from sqlalchemy import text
 import functions as f
+import telemetry_functions as tf
+import conservation_functions as cf
 import data as d
 
 
@@ -105,6 +138,10 @@ if __name__ == '__main__':
                         help='The model code for the clinical costing model that is being used to build the general ledger costs.')
     parser.add_argument('run_code',
                         help='The run code for the source data being used to built the general ledger costs for this hospital.')
+    parser.add_argument('-F', '--fixedPoint', dest='fixedPoint', action='store_true',
+                        help='Hold the costs as integer cost units and apportion them exactly')
+    cf.addConservationArguments(parser)   # Add the conservation command line arguments
+    tf.addTelemetryArguments(parser)  # Add the telemetry command line arguments
     f.addCommonArguments(parser)      # Add the common command line arguments
     args = parser.parse_args()
 
@@ -113,6 +150,8 @@ if __name__ == '__main__':
     d.hospital_code = args.hospital_code
     d.model_code = args.model_code
     d.run_code = args.run_code
+    d.fixedPoint = args.fixedPoint
+    d.costTolerance = args.costTolerance
     configDir = args.configDir
     configFile = args.configFile
     DatabaseType = args.DatabaseType
@@ -123,6 +162,7 @@ if __name__ == '__main__':
     logDir = args.logDir
     logFile = args.logFile
     loggingLevel = args.verbose
+    telemetryHistory = args.telemetryHistory
 
     # Set up logging
     f.setupLogging(progName, logDir, logFile, loggingLevel)
@@ -130,6 +170,9 @@ if __name__ == '__main__':
     # Read in the configuration file - which must exist if required - and create the database engine
     f.createEngine(configDir, configFile, DatabaseType, server, username, password, databaseName)
 
+    # Start collecting telemetry
+    tf.startStage(progName, logDir, logFile, telemetryHistory)
+
     # Check that the hospital_code is valid
     hospitals_df = pd.read_sql_query(text('SELECT hospital_code FROM hospitals'), d.engine.connect())
     hospitals = hospitals_df.values.tolist()      # convert rows/columns to a list of lists (will be [[hospital_code]] )
@@ -139,7 +182,7 @@ if __name__ == '__main__':
         sys.exit(d.EX_CONFIG)
 
     # Check that the model_code is valid
-    models_df = pd.read_sql_query(text(f'SELECT model_code FROM models WHERE hospital_code ="{d.hospital_code}"'), d.engine.connect())
+    models_df = pd.read_sql_query(text(f'SELECT model_code FROM models WHERE hospital_code ={f.sqlLiteral(d.hospital_code)}'), d.engine.connect())
     models = models_df.values.tolist()      # convert rows/columns to a list of lists (will be [[model_code]] )
     if not [d.model_code] in models:
         logging.critical('model code (%s) no in table "models"', d.model_code)
@@ -147,7 +190,7 @@ if __name__ == '__main__':
         sys.exit(d.EX_CONFIG)
 
     # Check that the run_code is valid
-    selectText = 'SELECT run_code FROM clinical_costing_runs WHERE hospital_code = "' + d.hospital_code + '"'
+    selectText = 'SELECT run_code FROM clinical_costing_runs WHERE hospital_code = ' + f.sqlLiteral(d.hospital_code)
     runs_df = pd.read_sql_query(text(selectText), d.engine.connect())
     runs = runs_df.values.tolist()      # convert rows/columns to a list of lists (will be [[run_code]] )
     if not [d.run_code] in runs:
@@ -156,65 +199,67 @@ if __name__ == '__main__':
         sys.exit(d.EX_CONFIG)
 
     # Build the 'where' clauses
-    where = 'hospital_code = "' + d.hospital_code + '" AND model_code = "' + d.model_code + '" AND run_code = "' + d.run_code + '"'
-    whereRun = 'hospital_code = "' + d.hospital_code + '" AND run_code = "' + d.run_code + '"'
-    whereModel = 'hospital_code = "' + d.hospital_code + '" AND model_code = "' + d.model_code + '"'
-    whereHospital = 'hospital_code = "' + d.hospital_code + '"'
-
-    # Delete any old data
-    with d.Session() as session:
-        session.execute(delete(d.metadata.tables['general_ledger_adjusted']).where(text(where)))
-        session.execute(delete(d.metadata.tables['general_ledger_mapped']).where(text(where)))
-        session.execute(delete(d.metadata.tables['general_ledger_built']).where(text(where)))
-        session.commit()
+    where = 'hospital_code = ' + f.sqlLiteral(d.hospital_code) + ' AND model_code = ' + f.sqlLiteral(d.model_code) + ' AND run_code = ' + f.sqlLiteral(d.run_code)
+    whereRun = 'hospital_code = ' + f.sqlLiteral(d.hospital_code) + ' AND run_code = ' + f.sqlLiteral(d.run_code)
+    whereModel = 'hospital_code = ' + f.sqlLiteral(d.hospital_code) + ' AND model_code = ' + f.sqlLiteral(d.model_code)
+    whereHospital = 'hospital_code = ' + f.sqlLiteral(d.hospital_code)
+
+    # Clear any old staged data (the old data stays visible until this run is published)
+    runTables = ['general_ledger_adjusted', 'general_ledger_mapped', 'general_ledger_built']
+    f.startStaging(runTables)
 
     # Start by reading in the General Ledger costs.
+    tf.startStep('read general_ledger_costs')
     selectText = 'SELECT * FROM general_ledger_costs WHERE ' + whereRun
-    glCosts_df = pd.read_sql_query(text(selectText), d.engine.connect())
+    glCosts_df = f.readFrame(selectText)
     glCosts_df.insert(2, 'model_code', d.model_code)
-    print(f"general_ledger_costs: ${glCosts_df['cost'].sum():.2f}")
+    glCosts_df['cost'] = f.toUnits(glCosts_df['cost'])
+    print(f"general_ledger_costs: ${f.toDollars(glCosts_df['cost'].sum()):.2f}")
+    cf.openLedger(glCosts_df)       # Adjusting, mapping and grouping must not change the total cost
+    tf.endStep(len(glCosts_df.index), f.toDollars(glCosts_df['cost'].sum()))
 
     # Then adjust for any cost based feeder costs
-    selectText = 'SELECT * FROM feeders WHERE ' + whereHospital
-    feeders_df = pd.read_sql_query(text(selectText), d.engine.connect())
-    selectText = 'SELECT * FROM feeder_model WHERE ' + whereModel
-    feederAccounts_df = pd.read_sql_query(text(selectText), d.engine.connect())
-    feederAccounts = {}
+    tf.startStep('feeder adjustments', len(glCosts_df.index), f.toDollars(glCosts_df['cost'].sum()))
     preservedCostTypes = set()
-    for row in feederAccounts_df.itertuples():
-        feeder_code = row.feeder_code
-        feederAccounts[feeder_code] = {}
-        feederAccounts[feeder_code]['new_department_code'] = row.new_department_code
-        feederAccounts[feeder_code]['new_cost_type_code'] = row. new_cost_type_code
-    selectText = 'SELECT * FROM itemized_costs WHERE ' + whereRun
-    items_df = pd.read_sql_query(text(selectText), d.engine.connect())
-    items_df = items_df.drop(columns=['hospital_code', 'run_code', 'who', 'invoice_no', 'invoice_line_no', 'service_code', 'episode_no', 'item_date', 'what'])
-    items_df = items_df.groupby(['feeder_code', 'department_code', 'cost_type_code']).sum('amount')
-    for groupTuple in items_df.index:
-        feeder_code, department_code, cost_type_code = groupTuple
-        # Check that this is a cost based feeder
-        if feeders_df[(feeders_df['feeder_code'] == feeder_code)]['feeder_type_code'].item() != 'C':
-            continue
-        if feeder_code not in feederAccounts:           # Some feeders are not in this model
+    # Total the itemized costs of the cost based feeders for each feeder and account in the database (one row per account, not per invoice line)
+    selectText = 'SELECT feeder_code, department_code, cost_type_code, COALESCE(SUM(amount), 0) AS amount FROM itemized_costs WHERE ' + whereRun
+    selectText += ' AND feeder_code IN (SELECT feeder_code FROM feeders WHERE ' + whereHospital + " AND feeder_type_code = 'C')"
+    selectText += ' GROUP BY feeder_code, department_code, cost_type_code ORDER BY feeder_code, department_code, cost_type_code'
+    items_df = f.readFrame(selectText)
+    items_df['amount'] = f.toUnits(items_df['amount'])
+    # And add the feeder account for each feeder in this model
+    selectText = 'SELECT feeder_code, new_department_code, new_cost_type_code FROM feeder_model WHERE ' + whereModel
+    feederAccounts_df = pd.read_sql_query(text(selectText), d.engine.connect())
+    items_df = items_df.merge(feederAccounts_df, how='left', on='feeder_code')
+    for itemRow in items_df.itertuples():
+        feeder_code = itemRow.feeder_code
+        department_code = itemRow.department_code
+        cost_type_code = itemRow.cost_type_code
+        if pd.isna(itemRow.new_department_code):           # Some feeders are not in this model
             logging.warning('No feeder account defined for feeder(%s) in model(%s)', feeder_code, d.model_code)
             continue
-        amount = items_df.loc[groupTuple]['amount']
-        new_department_code = feederAccounts[feeder_code]['new_department_code']
-        new_cost_type_code = feederAccounts[feeder_code]['new_cost_type_code']
+        amount = itemRow.amount
+        new_department_code = itemRow.new_department_code
+        new_cost_type_code = itemRow.new_cost_type_code
         preservedCostTypes.add(new_cost_type_code)
         glCosts_df = f.moveCosts(department_code, cost_type_code, amount, new_department_code, new_cost_type_code, 'A', glCosts_df)
 
     # Save the adjusted costs
     glCosts_df = glCosts_df[glCosts_df['cost'] != 0.0]
-    glCosts_df.to_sql('general_ledger_adjusted', d.engine, if_exists='append', index=False)
-    print(f"general_ledger_adjusted: ${glCosts_df['cost'].sum():.2f}")
+    cf.check('general_ledger_adjusted', glCosts_df)
+    glCosts_df.assign(cost=f.toDollars(glCosts_df['cost'])).to_sql(f.stagingTable('general_ledger_adjusted'), d.engine, if_exists='append', index=False)
+    print(f"general_ledger_adjusted: ${f.toDollars(glCosts_df['cost'].sum()):.2f}")
+    tf.endStep(len(glCosts_df.index), f.toDollars(glCosts_df['cost'].sum()))
 
     # Then do any General Ledger Run Adjustments
+    tf.startStep('run adjustments', len(glCosts_df.index), f.toDollars(glCosts_df['cost'].sum()))
     selectText = 'SELECT * FROM general_ledger_run_adjustments WHERE ' + whereRun
     glAdjust_df = pd.read_sql_query(text(selectText), d.engine.connect())
     glCosts_df, preservedCostTypes = f.generalLedgerAdjustOrMap(glAdjust_df, glCosts_df, preservedCostTypes)
+    tf.endStep(len(glCosts_df.index), f.toDollars(glCosts_df['cost'].sum()))
 
     # Then do any General Gedger Mappings
+    tf.startStep('mapping', len(glCosts_df.index), f.toDollars(glCosts_df['cost'].sum()))
     selectText = 'SELECT * FROM general_ledger_mapping WHERE ' + whereModel
     generalLedgerMapping_df = pd.read_sql_query(text(selectText), d.engine.connect())
     generalLedgerMapping_df.sort_values(by='mapping_order', inplace=True, ascending=True)
@@ -222,72 +267,64 @@ if __name__ == '__main__':
 
     # Save the mapped costs
     glCosts_df = glCosts_df[glCosts_df['cost'] != 0.0]
-    glCosts_df.to_sql('general_ledger_mapped', d.engine, if_exists='append', index=False)
-    print(f"general_ledger_mapped: ${glCosts_df['cost'].sum():.2f}")
+    cf.check('general_ledger_mapped', glCosts_df)
+    glCosts_df.assign(cost=f.toDollars(glCosts_df['cost'])).to_sql(f.stagingTable('general_ledger_mapped'), d.engine, if_exists='append', index=False)
+    print(f"general_ledger_mapped: ${f.toDollars(glCosts_df['cost'].sum()):.2f}")
+    tf.endStep(len(glCosts_df.index), f.toDollars(glCosts_df['cost'].sum()))
 
     # Next do any General Ledger Grouping - starting with department grouping
+    tf.startStep('department grouping', len(glCosts_df.index), f.toDollars(glCosts_df['cost'].sum()))
     selectText = 'SELECT * FROM department_grouping WHERE ' + whereModel
     departmentGrouping_df = pd.read_sql_query(text(selectText), d.engine.connect())
-    for groupingRow in departmentGrouping_df.itertuples():
-        from_department_code = groupingRow.from_department_code
-        to_department_code = groupingRow.to_department_code
-        glCostsTmp_df = glCosts_df[glCosts_df['department_code'] == from_department_code].copy()
-        if len(glCostsTmp_df.index) == 0:
-            logging.warning('No costs in general_ledger_mapped for department_code(%s)', from_department_code)
-            continue            # No costs for this department in the General Ledger
-        for glTmpRow in glCostsTmp_df.itertuples():
-            from_cost_type_code = glTmpRow.cost_type_code
-            to_cost_type_code = from_cost_type_code
-            amount = glTmpRow.cost
-            glCosts_df = f.moveCosts(from_department_code, from_cost_type_code, amount, to_department_code, to_cost_type_code, 'A', glCosts_df)
+    groupings = list(zip(departmentGrouping_df['from_department_code'], departmentGrouping_df['to_department_code']))
+    departmentMap, unmatched = f.groupCodes(glCosts_df['department_code'].unique(), groupings)
+    for from_department_code, to_department_code in unmatched:
+        logging.warning('No costs in general_ledger_mapped for department_code(%s)', from_department_code)
+    glCosts_df = f.regroupCosts(glCosts_df, 'department_code', departmentMap)
+    tf.endStep(len(glCosts_df.index), f.toDollars(glCosts_df['cost'].sum()))
 
     # Then cost type with in department grouping
+    tf.startStep('department cost type grouping', len(glCosts_df.index), f.toDollars(glCosts_df['cost'].sum()))
     selectText = 'SELECT * FROM department_cost_type_grouping WHERE ' + whereModel
     departmentCostTypeGrouping_df = pd.read_sql_query(text(selectText), d.engine.connect())
-    for groupingRow in departmentCostTypeGrouping_df.itertuples():
-        from_department_code = groupingRow.department_code
-        to_department_code = from_department_code
-        from_cost_type_code = groupingRow.from_cost_type_code
-        to_cost_type_code = groupingRow.to_cost_type_code
-        preservedCostTypes.add(to_cost_type_code)
-        fromCosts_df = glCosts_df[(glCosts_df['department_code'] == from_department_code) & (glCosts_df['cost_type_code'] == from_cost_type_code)]
-        if len(fromCosts_df.index) == 0:        # None of this cost in the General Ledger
-            logging.warning('No costs in general_ledger_mapped for account[department_code(%s), cost_type_code(%s)]', from_department_code, from_cost_type_code)
-            continue
-        amount = fromCosts_df['cost'].item()
-        glCosts_df = f.moveCosts(from_department_code, from_cost_type_code, amount, to_department_code, to_cost_type_code, 'A', glCosts_df)
+    preservedCostTypes.update(departmentCostTypeGrouping_df['to_cost_type_code'])
+    groupings = [((groupingRow.department_code, groupingRow.from_cost_type_code), (groupingRow.department_code, groupingRow.to_cost_type_code))
+                 for groupingRow in departmentCostTypeGrouping_df.itertuples()]
+    accounts = list(zip(glCosts_df['department_code'], glCosts_df['cost_type_code']))
+    accountMap, unmatched = f.groupCodes(accounts, groupings)
+    for (from_department_code, from_cost_type_code), toAccount in unmatched:
+        logging.warning('No costs in general_ledger_mapped for account[department_code(%s), cost_type_code(%s)]', from_department_code, from_cost_type_code)
+    glCosts_df = f.regroupCosts(glCosts_df, 'cost_type_code', [accountMap.get(account, account)[1] for account in accounts])
+    tf.endStep(len(glCosts_df.index), f.toDollars(glCosts_df['cost'].sum()))
 
     # Then simplify the cost types with cost type grouping
+    tf.startStep('cost type grouping', len(glCosts_df.index), f.toDollars(glCosts_df['cost'].sum()))
     selectText = 'SELECT * FROM cost_type_grouping WHERE ' + whereModel
     costTypeGrouping_df = pd.read_sql_query(text(selectText), d.engine.connect())
-    for groupingRow in costTypeGrouping_df.itertuples():
-        from_cost_type_code = groupingRow.from_cost_type_code
-        to_cost_type_code = groupingRow.to_cost_type_code
-        preservedCostTypes.add(to_cost_type_code)
-        glCostsTmp_df = glCosts_df[glCosts_df['cost_type_code'] == from_cost_type_code].copy()
-        if len(glCostsTmp_df.index) == 0:
-            logging.warning('No costs in general_ledger_mapped for cost_type_code(%s)', from_cost_type_code)
-            continue        # No costs of this cost type in the General Ledger
-        for glTmpRow in glCostsTmp_df.itertuples():
-            from_department_code = glTmpRow.department_code
-            to_department_code = from_department_code
-            amount = glTmpRow.cost
-            glCosts_df = f.moveCosts(from_department_code, from_cost_type_code, amount, to_department_code, to_cost_type_code, 'A', glCosts_df)
+    preservedCostTypes.update(costTypeGrouping_df['to_cost_type_code'])
+    groupings = list(zip(costTypeGrouping_df['from_cost_type_code'], costTypeGrouping_df['to_cost_type_code']))
+    costTypeMap, unmatched = f.groupCodes(glCosts_df['cost_type_code'].unique(), groupings)
+    for from_cost_type_code, to_cost_type_code in unmatched:
+        logging.warning('No costs in general_ledger_mapped for cost_type_code(%s)', from_cost_type_code)
+    glCosts_df = f.regroupCosts(glCosts_df, 'cost_type_code', costTypeMap)
+    tf.endStep(len(glCosts_df.index), f.toDollars(glCosts_df['cost'].sum()))
 
     # Finally, group all other cost types into 'other'
-    glCostsTmp_df = glCosts_df[~glCosts_df['cost_type_code'].isin(preservedCostTypes)].copy()
-    if len(glCostsTmp_df.index) != 0:
-        for glTmpRow in glCostsTmp_df.itertuples():
-            from_department_code = glTmpRow.department_code
-            to_department_code = from_department_code
-            from_cost_type_code = glTmpRow.cost_type_code
-            amount = glTmpRow.cost
-            glCosts_df = f.moveCosts(from_department_code, from_cost_type_code, amount, to_department_code, 'other', 'A', glCosts_df)
+    tf.startStep('fold into other', len(glCosts_df.index), f.toDollars(glCosts_df['cost'].sum()))
+    costTypes = glCosts_df['cost_type_code'].astype(object)
+    glCosts_df = f.regroupCosts(glCosts_df, 'cost_type_code', costTypes.where(costTypes.isin(preservedCostTypes), 'other'))
 
     # Save the built costs
     glCosts_df = glCosts_df[glCosts_df['cost'] != 0.0]
-    glCosts_df.to_sql('general_ledger_built', d.engine, if_exists='append', index=False)
-    print(f"general_ledger_built: ${glCosts_df['cost'].sum():.2f}")
+    cf.check('general_ledger_built', glCosts_df)
+    glCosts_df.assign(cost=f.toDollars(glCosts_df['cost'])).to_sql(f.stagingTable('general_ledger_built'), d.engine, if_exists='append', index=False)
+    print(f"general_ledger_built: ${f.toDollars(glCosts_df['cost'].sum()):.2f}")
+    tf.endStep(len(glCosts_df.index), f.toDollars(glCosts_df['cost'].sum()))
+
+    # Publish this run from the staging tables
+    tf.startStep('publish')
+    tf.endStep(f.publishRun(runTables))
 
+    tf.endStage()
     logging.shutdown()
     sys.exit(d.EX_OK)
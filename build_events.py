@@ -7,6 +7,7 @@ A python script to builds clinical events from feeders data and Patient Activity
 
     SYNOPSIS:
     $ python build_event.py hospital_code model_code run_code
+        [-T|--telemetryHistory]
         [-D DatabaseType|--DatabaseType=DatabaseType]
         [-C configDir|--configDir=configDir]
         [-c configFile|--configFile=configFile]
@@ -17,6 +18,9 @@ A python script to builds clinical events from feeders data and Patient Activity
         [-v loggingLevel|--verbose=logingLevel]
         [-L logDir|--logDir=logDir]
         [-l logfile|--logfile=logfile]
+        [--profile[=mode]]
+        [--traceMemory]
+        [--roundTripThreshold=threshold]
 
     REQUIRED
     hospital_code
@@ -32,10 +36,14 @@ A python script to builds clinical events from feeders data and Patient Activity
     to build the clinical events for this hospital.
 
     -D DatabaseType|--DatabaseType=DatabaseType
-    The type of database [choice:MSSQL/MySQL]
+    The type of database [choice:MSSQL/MySQL/SQLite]
 
 
     OPTIONS
+    -T|--telemetryHistory
+    Append the telemetry for this run (which is always written as a JSON report next to the log file)
+    to the stage_telemetry table
+
     -C configDir|--configDir=configDir
     The directory containing the database connection configuration file
     (default='databaseConfig')
@@ -66,12 +74,24 @@ A python script to builds clinical events from feeders data and Patient Activity
     -o logfile|--logfile=logfile
     The name of a log file where you want all messages captured.
 
+    --profile[=mode]
+    Profile this run [choice:cprofile/sampling] (default=cprofile) and save the pstats file (cprofile only)
+    and a collapsed-stack file (for flame graphs) in logDir, named after the stage, hospital, model and run.
+
+    --traceMemory
+    Trace memory allocations and save a memory report in logDir, with the top allocation sites
+    and the size of each DataFrame at each step of the stage.
+
+    --roundTripThreshold=threshold
+    When the SQL is profiled (INFO or DEBUG logging), report the SQL shapes executed more than threshold times
+    as possible N+1 patterns (default=100).
+
 
     THE MAIN CODE
     Start by parsing the command line arguements, setting up logging
     and connnect to the database.
     Then check that the hospital_code, model_code and run_code are valid.
-    Then build the clinical event.
+    Then build the clinical event, in a staging table, and publish them in a single transaction.
 '''
 
 # pylint: disable=invalid-name, bare-except, pointless-string-statement, unspecified-encoding
@@ -80,8 +100,9 @@ import sys
 import argparse
 import logging
 import pandas as pd
-from sqlalchemy import text, delete
+from sqlalchemy import text
 import functions as f
+import telemetry_functions as tf
 import build_events_functions as bf
 import data as d
 
@@ -109,6 +130,7 @@ if __name__ == '__main__':
                         help='The run code for the source data being used to assemble the clinical costing data for this hospital.')
     parser.add_argument('-i', '--iterate', dest='useIteration', action='store_true',
                         help='Use the iteration model for the disbursement.')
+    tf.addTelemetryArguments(parser)  # Add the telemetry command line arguments
     f.addCommonArguments(parser)      # Add the common command line arguments
     args = parser.parse_args()
 
@@ -128,6 +150,7 @@ if __name__ == '__main__':
     logDir = args.logDir
     logFile = args.logFile
     loggingLevel = args.verbose
+    telemetryHistory = args.telemetryHistory
 
     # Set up logging
     f.setupLogging(progName, logDir, logFile, loggingLevel)
@@ -135,6 +158,9 @@ if __name__ == '__main__':
     # Read in the configuration file - which must exist if required - and create the database engine
     f.createEngine(configDir, configFile, DatabaseType, server, username, password, databaseName)
 
+    # Start collecting telemetry
+    tf.startStage(progName, logDir, logFile, telemetryHistory)
+
     # Check that the hospital_code is valid
     hospitals_df = pd.read_sql_query(text('SELECT hospital_code FROM hospitals'), d.engine.connect())
     hospitals = hospitals_df.values.tolist()      # convert rows/columns to a list of lists (will be [[hospital_code]] )
@@ -144,7 +170,7 @@ if __name__ == '__main__':
         sys.exit(d.EX_CONFIG)
 
     # Check that the model_code is valid
-    models_df = pd.read_sql_query(text(f'SELECT model_code FROM models WHERE hospital_code = "{d.hospital_code}"'), d.engine.connect())
+    models_df = pd.read_sql_query(text(f'SELECT model_code FROM models WHERE hospital_code = {f.sqlLiteral(d.hospital_code)}'), d.engine.connect())
     models = models_df.values.tolist()      # convert rows/columns to a list of lists (will be [[model_code]] )
     if not [d.model_code] in models:
         logging.critical('model code (%s) no in table "models"', d.model_code)
@@ -152,7 +178,7 @@ if __name__ == '__main__':
         sys.exit(d.EX_CONFIG)
 
     # Check that the run_code is valid
-    selectText = 'SELECT run_code FROM clinical_costing_runs WHERE hospital_code = "' + d.hospital_code + '"'
+    selectText = 'SELECT run_code FROM clinical_costing_runs WHERE hospital_code = ' + f.sqlLiteral(d.hospital_code)
     runs_df = pd.read_sql_query(text(selectText), d.engine.connect())
     runs = runs_df.values.tolist()      # convert rows/columns to a list of lists (will be [[run_code]] )
     if not [d.run_code] in runs:
@@ -161,35 +187,32 @@ if __name__ == '__main__':
         sys.exit(d.EX_CONFIG)
 
     # Build the 'where' clauses
-    where = 'hospital_code = "' + d.hospital_code + '" AND model_code = "' + d.model_code + '" AND run_code = "' + d.run_code + '"'
+    where = 'hospital_code = ' + f.sqlLiteral(d.hospital_code) + ' AND model_code = ' + f.sqlLiteral(d.model_code) + ' AND run_code = ' + f.sqlLiteral(d.run_code)
     bf.SQLwhere = where
-    whereRun = 'hospital_code = "' + d.hospital_code + '" AND run_code = "' + d.run_code + '"'
+    whereRun = 'hospital_code = ' + f.sqlLiteral(d.hospital_code) + ' AND run_code = ' + f.sqlLiteral(d.run_code)
     bf.SQLwhereRun = whereRun
-    whereModel = 'hospital_code = "' + d.hospital_code + '" AND model_code = "' + d.model_code + '"'
+    whereModel = 'hospital_code = ' + f.sqlLiteral(d.hospital_code) + ' AND model_code = ' + f.sqlLiteral(d.model_code)
     bf.SQLwhereModel = whereModel
-    whereHospital = 'hospital_code = "' + d.hospital_code + '"'
+    whereHospital = 'hospital_code = ' + f.sqlLiteral(d.hospital_code)
     bf.SQLwhereHospital = whereHospital
 
-    # Delete any old data
-    with d.Session() as session:
-        session.execute(delete(d.metadata.tables['events']).where(text(where)))
-        session.commit()
+    # Clear any old staged data (the old data stays visible until this run is published)
+    f.startStaging(['events'])
+    bf.eventsTable = f.stagingTable('events')
 
     # Build the events from the feeder data
     # With cost based feeders the costs from the associated account won't be distributed over these events
     # (the costs will be subracted from the accounts and the remainder distributed over some other event),
     # but other accounts can be distributed over these events.
-    selectText = 'SELECT feeder_code FROM feeders WHERE ' + whereHospital
-    feeders_df = pd.read_sql_query(text(selectText), d.engine.connect())
-    selectText = f'SELECT hospital_code, run_code, "{d.model_code}" as model_code, feeder_code as event_code, '
+    tf.startStep('feeder events')
+    selectText = f'SELECT hospital_code, run_code, {f.sqlLiteral(d.model_code)} as model_code, feeder_code as event_code, '
     selectText += 'feeder_code as event_attribute_code, service_code, episode_no, invoice_line_no as event_seq, '
     selectText += 'invoice_no as event_what, feeder_code as distribution_code, amount as event_weight '
     selectText += 'FROM itemized_costs WHERE ' + bf.SQLwhereRun
-    for row in feeders_df.itertuples():
-        feeder_code = row.feeder_code
-        thisSelectText = selectText + f' AND feeder_code = "{feeder_code}"'
-        events_df = pd.read_sql_query(text(thisSelectText), d.engine.connect())
-        events_df.to_sql('events', d.engine, if_exists='append', index=False)
+    selectText += ' AND feeder_code IN (SELECT feeder_code FROM feeders WHERE ' + whereHospital + ')'
+    events_df = pd.read_sql_query(text(selectText), d.engine.connect())
+    events_df.to_sql(bf.eventsTable, d.engine, if_exists='append', index=False)
+    tf.endStep(len(events_df.index))
 
     # Cache event_codes, event_attributes, distribution_codes, ward_codes and clinic_codes
     # (We may have to build a new distribution code)
@@ -233,7 +256,14 @@ if __name__ == '__main__':
         eventBase = row.event_attribute_base
         eventWeight = row.event_attribute_weight
         eventAcuityScaling = row.event_acuity_scaling
+        tf.startStep(f'{eventSubroutine} {eventCode}/{eventAttribute}')
         bf.buildEvent(eventSubroutine, eventCode, eventAttribute, eventWhat, eventWhere, eventBase, eventWeight, eventAcuityScaling)
+        tf.endStep()
+
+    # Publish this run from the staging tables
+    tf.startStep('publish')
+    tf.endStep(f.publishRun(['events']))
 
+    tf.endStage()
     logging.shutdown()
     sys.exit(d.EX_OK)
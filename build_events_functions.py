@@ -9,12 +9,14 @@ import logging
 import inspect
 import pandas as pd
 from sqlalchemy import text, insert
+import functions as f
 import data as d
 
 SQLwhere = None
 SQLwhereRun = None
 SQLwhereModel = None
 SQLwhereHospital = None
+eventsTable = 'events'      # The table (or staging table) that the events are written to
 
 def buildEvent(eventFunc, eventCode, eventAttribute, eventWhat, eventWhere, eventBase, eventWeight, eventAcuityScaling):
     '''
@@ -24,6 +26,7 @@ def buildEvent(eventFunc, eventCode, eventAttribute, eventWhat, eventWhere, even
         logging.critical('Event function "%s" is not defined', eventFunc)
         logging.shutdown()
         sys.exit(d.EX_USAGE)
+    eventWhere = f.sqlPortable(eventWhere)      # Configured "where" clauses may use MySQL style double quoted literals
     globals()[eventFunc](eventCode, eventAttribute, eventWhat, eventWhere, eventBase, eventWeight, eventAcuityScaling)
 
 def baseParams(code, attribute, what):
@@ -98,7 +101,7 @@ def EDadmissions(code, attribute, what, where, base, weight, acuityScaling):
     for row in events_df.itertuples():
         params['episode_no'] = row.episode_no
         with d.Session() as session:
-            session.execute(insert(d.metadata.tables['events']).values(params))
+            session.execute(insert(d.metadata.tables[eventsTable]).values(params))
             session.commit()
 
 def EDdischarges(code, attribute, what, where, base, weight, acuityScaling):
@@ -116,7 +119,7 @@ def EDdischarges(code, attribute, what, where, base, weight, acuityScaling):
     for row in events_df.itertuples():
         params['episode_no'] = row.episode_no
         with d.Session() as session:
-            session.execute(insert(d.metadata.tables['events']).values(params))
+            session.execute(insert(d.metadata.tables[eventsTable]).values(params))
             session.commit()
 
 def EDattendmin(code, attribute, what, where, base, weight, acuityScaling):
@@ -139,7 +142,7 @@ def EDattendmin(code, attribute, what, where, base, weight, acuityScaling):
         thisWeight = (base + row.attend_min * thisAcuity) * weight
         params['event_weight'] = thisWeight
         with d.Session() as session:
-            session.execute(insert(d.metadata.tables['events']).values(params))
+            session.execute(insert(d.metadata.tables[eventsTable]).values(params))
             session.commit()
 
 def EDseenmin(code, attribute, what, where, base, weight, acuityScaling):
@@ -162,7 +165,7 @@ def EDseenmin(code, attribute, what, where, base, weight, acuityScaling):
         thisWeight = (base + row.seen_min * thisAcuity) * weight
         params['event_weight'] = thisWeight
         with d.Session() as session:
-            session.execute(insert(d.metadata.tables['events']).values(params))
+            session.execute(insert(d.metadata.tables[eventsTable]).values(params))
             session.commit()
 
 def EDtreatmin(code, attribute, what, where, base, weight, acuityScaling):
@@ -185,7 +188,7 @@ def EDtreatmin(code, attribute, what, where, base, weight, acuityScaling):
         thisWeight = (base + row.treat_min * thisAcuity) * weight
         params['event_weight'] = thisWeight
         with d.Session() as session:
-            session.execute(insert(d.metadata.tables['events']).values(params))
+            session.execute(insert(d.metadata.tables[eventsTable]).values(params))
             session.commit()
 
 def opclinicmin(code, attribute, what, where, base, weight, acuityScaling):
@@ -212,7 +215,7 @@ def opclinicmin(code, attribute, what, where, base, weight, acuityScaling):
             thisWeight = (base + row.attend_min * thisAcuity) * weight
             params['event_weight'] = thisWeight
             with d.Session() as session:
-                session.execute(insert(d.metadata.tables['events']).values(params))
+                session.execute(insert(d.metadata.tables[eventsTable]).values(params))
                 session.commit()
     else:
         selectText = 'SELECT episode_no, sum(attend_min * acuity) as eventWeight FROM clinic_activity_details WHERE ' + SQLwhereRun
@@ -231,7 +234,7 @@ def opclinicmin(code, attribute, what, where, base, weight, acuityScaling):
             thisWeight = (base + row.eventWeight) * weight
             params['event_weight'] = thisWeight
             with d.Session() as session:
-                session.execute(insert(d.metadata.tables['events']).values(params))
+                session.execute(insert(d.metadata.tables[eventsTable]).values(params))
                 session.commit()
 
 def ipadmissions(code, attribute, what, where, base, weight, acuityScaling):
@@ -243,8 +246,8 @@ def ipadmissions(code, attribute, what, where, base, weight, acuityScaling):
         selectText = 'SELECT inpat_episode_details.episode_no as episode_no, inpat_episode_details.admitting_ward_code as ward_code,'
         selectText += ' inpat_episode_details.acuity as acuity'
         selectText += ' FROM inpat_episode_details, inpat_admissions WHERE'
-        selectText += f' inpat_episode_details.hospital_code = "{d.hospital_code}" AND inpat_admissions.hospital_code = "{d.hospital_code}"'
-        selectText += f' AND inpat_episode_details.run_code = "{d.run_code}" AND inpat_admissions.run_code = "{d.run_code}"'
+        selectText += f' inpat_episode_details.hospital_code = {f.sqlLiteral(d.hospital_code)} AND inpat_admissions.hospital_code = {f.sqlLiteral(d.hospital_code)}'
+        selectText += f' AND inpat_episode_details.run_code = {f.sqlLiteral(d.run_code)} AND inpat_admissions.run_code = {f.sqlLiteral(d.run_code)}'
         selectText += ' AND inpat_episode_details.episode_no =  inpat_admissions.episode_no'
         if (where is not None) and (where != ''):
             selectText += ' AND ' + where
@@ -259,13 +262,13 @@ def ipadmissions(code, attribute, what, where, base, weight, acuityScaling):
             thisWeight = (base + thisAcuity) * weight
             params['event_weight'] = thisWeight
             with d.Session() as session:
-                session.execute(insert(d.metadata.tables['events']).values(params))
+                session.execute(insert(d.metadata.tables[eventsTable]).values(params))
                 session.commit()
     else:
         selectText = 'SELECT inpat_episode_details.episode_no as episode_no, inpat_episode_details.acuity as acuity'
         selectText += ' FROM inpat_episode_details, inpat_admissions WHERE'
-        selectText += f' inpat_episode_details.hospital_code = "{d.hospital_code}" AND inpat_admissions.hospital_code = "{d.hospital_code}"'
-        selectText += f' AND inpat_episode_details.run_code = "{d.run_code}" AND inpat_admissions.run_code = "{d.run_code}"'
+        selectText += f' inpat_episode_details.hospital_code = {f.sqlLiteral(d.hospital_code)} AND inpat_admissions.hospital_code = {f.sqlLiteral(d.hospital_code)}'
+        selectText += f' AND inpat_episode_details.run_code = {f.sqlLiteral(d.run_code)} AND inpat_admissions.run_code = {f.sqlLiteral(d.run_code)}'
         selectText += ' AND inpat_episode_details.episode_no =  inpat_admissions.episode_no'
         if (where is not None) and (where != ''):
             selectText += ' AND ' + where
@@ -282,7 +285,7 @@ def ipadmissions(code, attribute, what, where, base, weight, acuityScaling):
             thisWeight = (base + thisAcuity) * weight
             params['event_weight'] = thisWeight
             with d.Session() as session:
-                session.execute(insert(d.metadata.tables['events']).values(params))
+                session.execute(insert(d.metadata.tables[eventsTable]).values(params))
                 session.commit()
 
 def ipdischarges(code, attribute, what, where, base, weight, acuityScaling):
@@ -294,8 +297,8 @@ def ipdischarges(code, attribute, what, where, base, weight, acuityScaling):
         selectText = 'SELECT inpat_episode_details.episode_no as episode_no, inpat_episode_details.discharge_ward_code as ward_code,'
         selectText += ' inpat_episode_details.acuity as acuity'
         selectText += ' FROM inpat_episode_details, inpat_discharges WHERE'
-        selectText += f' inpat_episode_details.hospital_code = "{d.hospital_code}" AND inpat_discharges.hospital_code = "{d.hospital_code}"'
-        selectText += f' AND inpat_episode_details.run_code = "{d.run_code}" AND inpat_discharges.run_code = "{d.run_code}"'
+        selectText += f' inpat_episode_details.hospital_code = {f.sqlLiteral(d.hospital_code)} AND inpat_discharges.hospital_code = {f.sqlLiteral(d.hospital_code)}'
+        selectText += f' AND inpat_episode_details.run_code = {f.sqlLiteral(d.run_code)} AND inpat_discharges.run_code = {f.sqlLiteral(d.run_code)}'
         selectText += ' AND inpat_episode_details.episode_no =  inpat_discharges.episode_no'
         if (where is not None) and (where != ''):
             selectText += ' AND ' + where
@@ -310,13 +313,13 @@ def ipdischarges(code, attribute, what, where, base, weight, acuityScaling):
             thisWeight = (base + thisAcuity) * weight
             params['event_weight'] = thisWeight
             with d.Session() as session:
-                session.execute(insert(d.metadata.tables['events']).values(params))
+                session.execute(insert(d.metadata.tables[eventsTable]).values(params))
                 session.commit()
     else:
         selectText = 'SELECT inpat_episode_details.episode_no as episode_no, inpat_episode_details.acuity as acuity'
         selectText += ' FROM inpat_episode_details, inpat_discharges WHERE'
-        selectText += f' inpat_episode_details.hospital_code = "{d.hospital_code}" AND inpat_discharges.hospital_code = "{d.hospital_code}"'
-        selectText += f' AND inpat_episode_details.run_code = "{d.run_code}" AND inpat_discharges.run_code = "{d.run_code}"'
+        selectText += f' inpat_episode_details.hospital_code = {f.sqlLiteral(d.hospital_code)} AND inpat_discharges.hospital_code = {f.sqlLiteral(d.hospital_code)}'
+        selectText += f' AND inpat_episode_details.run_code = {f.sqlLiteral(d.run_code)} AND inpat_discharges.run_code = {f.sqlLiteral(d.run_code)}'
         selectText += ' AND inpat_episode_details.episode_no =  inpat_discharges.episode_no'
         if (where is not None) and (where != ''):
             selectText += ' AND ' + where
@@ -333,7 +336,7 @@ def ipdischarges(code, attribute, what, where, base, weight, acuityScaling):
             thisWeight = (base + thisAcuity) * weight
             params['event_weight'] = thisWeight
             with d.Session() as session:
-                session.execute(insert(d.metadata.tables['events']).values(params))
+                session.execute(insert(d.metadata.tables[eventsTable]).values(params))
                 session.commit()
 
 def ipwardbdays(code, attribute, what, where, base, weight, acuityScaling):
@@ -345,8 +348,8 @@ def ipwardbdays(code, attribute, what, where, base, weight, acuityScaling):
         selectText = 'SELECT inpat_episode_details.episode_no as episode_no, inpat_patient_location.location_seq as event_seq, inpat_patient_location.ward_code as ward_code,'
         selectText += ' inpat_patient_location.ward_days as ward_days, inpat_patient_location.acuity as acuity'
         selectText += ' FROM inpat_episode_details, inpat_patient_location WHERE'
-        selectText += f' inpat_episode_details.hospital_code = "{d.hospital_code}" AND inpat_patient_location.hospital_code = "{d.hospital_code}"'
-        selectText += f' AND inpat_episode_details.run_code = "{d.run_code}" AND inpat_patient_location.run_code = "{d.run_code}"'
+        selectText += f' inpat_episode_details.hospital_code = {f.sqlLiteral(d.hospital_code)} AND inpat_patient_location.hospital_code = {f.sqlLiteral(d.hospital_code)}'
+        selectText += f' AND inpat_episode_details.run_code = {f.sqlLiteral(d.run_code)} AND inpat_patient_location.run_code = {f.sqlLiteral(d.run_code)}'
         selectText += ' AND inpat_episode_details.episode_no =  inpat_patient_location.episode_no'
         if (where is not None) and (where != ''):
             selectText += ' AND ' + where
@@ -362,14 +365,14 @@ def ipwardbdays(code, attribute, what, where, base, weight, acuityScaling):
             thisWeight = (base + row.ward_days * thisAcuity) * weight
             params['event_weight'] = thisWeight
             with d.Session() as session:
-                session.execute(insert(d.metadata.tables['events']).values(params))
+                session.execute(insert(d.metadata.tables[eventsTable]).values(params))
                 session.commit()
     else:
         selectText = 'SELECT inpat_episode_details.episode_no as episode_no,'
         selectText += ' sum(inpat_patient_location.ward_days * inpat_patient_location.acuity) as eventWeight'
         selectText += ' FROM inpat_episode_details, inpat_patient_location WHERE'
-        selectText += f' inpat_episode_details.hospital_code = "{d.hospital_code}" AND inpat_patient_location.hospital_code = "{d.hospital_code}"'
-        selectText += f' AND inpat_episode_details.run_code = "{d.run_code}" AND inpat_patient_location.run_code = "{d.run_code}"'
+        selectText += f' inpat_episode_details.hospital_code = {f.sqlLiteral(d.hospital_code)} AND inpat_patient_location.hospital_code = {f.sqlLiteral(d.hospital_code)}'
+        selectText += f' AND inpat_episode_details.run_code = {f.sqlLiteral(d.run_code)} AND inpat_patient_location.run_code = {f.sqlLiteral(d.run_code)}'
         selectText += ' AND inpat_episode_details.episode_no =  inpat_patient_location.episode_no'
         if (where is not None) and (where != ''):
             selectText += ' AND ' + where
@@ -386,7 +389,7 @@ def ipwardbdays(code, attribute, what, where, base, weight, acuityScaling):
             thisWeight = (base + row.eventWeight) * weight
             params['event_weight'] = thisWeight
             with d.Session() as session:
-                session.execute(insert(d.metadata.tables['events']).values(params))
+                session.execute(insert(d.metadata.tables[eventsTable]).values(params))
                 session.commit()
 
 
@@ -417,7 +420,7 @@ def ipwardsday(code, attribute, what, where, base, weight, acuityScaling):
         thisWeight = (base + thisAcuity) * weight
         params['event_weight'] = thisWeight
         with d.Session() as session:
-            session.execute(insert(d.metadata.tables['events']).values(params))
+            session.execute(insert(d.metadata.tables[eventsTable]).values(params))
             session.commit()
 
 def ipwardbhrs(code, attribute, what, where, base, weight, acuityScaling):
@@ -429,8 +432,8 @@ def ipwardbhrs(code, attribute, what, where, base, weight, acuityScaling):
         selectText = 'SELECT inpat_episode_details.episode_no as episode_no, inpat_patient_location.location_seq as event_seq, inpat_patient_location.ward_code as ward_code,'
         selectText += ' inpat_patient_location.ward_hours as ward_hours, inpat_patient_location.acuity as acuity'
         selectText += ' FROM inpat_episode_details, inpat_patient_location WHERE'
-        selectText += f' inpat_episode_details.hospital_code = "{d.hospital_code}" AND inpat_patient_location.hospital_code = "{d.hospital_code}"'
-        selectText += f' AND inpat_episode_details.run_code = "{d.run_code}" AND inpat_patient_location.run_code = "{d.run_code}"'
+        selectText += f' inpat_episode_details.hospital_code = {f.sqlLiteral(d.hospital_code)} AND inpat_patient_location.hospital_code = {f.sqlLiteral(d.hospital_code)}'
+        selectText += f' AND inpat_episode_details.run_code = {f.sqlLiteral(d.run_code)} AND inpat_patient_location.run_code = {f.sqlLiteral(d.run_code)}'
         selectText += ' AND inpat_episode_details.episode_no =  inpat_patient_location.episode_no'
         if (where is not None) and (where != ''):
             selectText += ' AND ' + where
@@ -446,14 +449,14 @@ def ipwardbhrs(code, attribute, what, where, base, weight, acuityScaling):
             thisWeight = (base + row.ward_hours * thisAcuity) * weight
             params['event_weight'] = thisWeight
             with d.Session() as session:
-                session.execute(insert(d.metadata.tables['events']).values(params))
+                session.execute(insert(d.metadata.tables[eventsTable]).values(params))
                 session.commit()
     else:
         selectText = 'SELECT inpat_episode_details.episode_no as episode_no,'
         selectText += ' sum(inpat_patient_location.ward_hours * inpat_patient_location.acuity) as eventWeight'
         selectText += ' FROM inpat_episode_details, inpat_patient_location WHERE'
-        selectText += f' inpat_episode_details.hospital_code = "{d.hospital_code}" AND inpat_patient_location.hospital_code = "{d.hospital_code}"'
-        selectText += f' AND inpat_episode_details.run_code = "{d.run_code}" AND inpat_patient_location.run_code = "{d.run_code}"'
+        selectText += f' inpat_episode_details.hospital_code = {f.sqlLiteral(d.hospital_code)} AND inpat_patient_location.hospital_code = {f.sqlLiteral(d.hospital_code)}'
+        selectText += f' AND inpat_episode_details.run_code = {f.sqlLiteral(d.run_code)} AND inpat_patient_location.run_code = {f.sqlLiteral(d.run_code)}'
         selectText += ' AND inpat_episode_details.episode_no =  inpat_patient_location.episode_no'
         if (where is not None) and (where != ''):
             selectText += ' AND ' + where
@@ -470,7 +473,7 @@ def ipwardbhrs(code, attribute, what, where, base, weight, acuityScaling):
             thisWeight = (base + row.eventWeight) * weight
             params['event_weight'] = thisWeight
             with d.Session() as session:
-                session.execute(insert(d.metadata.tables['events']).values(params))
+                session.execute(insert(d.metadata.tables[eventsTable]).values(params))
                 session.commit()
 
 def anaesthmin(code, attribute, what, where, base, weight, acuityScaling):
@@ -492,7 +495,7 @@ def anaesthmin(code, attribute, what, where, base, weight, acuityScaling):
         thisWeight = (base + row.anaesthetic_mins * row.theatre_acuity) * weight
         params['event_weight'] = thisWeight
         with d.Session() as session:
-            session.execute(insert(d.metadata.tables['events']).values(params))
+            session.execute(insert(d.metadata.tables[eventsTable]).values(params))
             session.commit()
 
 def theatremin(code, attribute, what, where, base, weight, acuityScaling):
@@ -514,5 +517,5 @@ def theatremin(code, attribute, what, where, base, weight, acuityScaling):
         thisWeight = (base + row.theatre_mins * row.theatre_acuity) * weight
         params['event_weight'] = thisWeight
         with d.Session() as session:
-            session.execute(insert(d.metadata.tables['events']).values(params))
+            session.execute(insert(d.metadata.tables[eventsTable]).values(params))
             session.commit()
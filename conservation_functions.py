@@ -0,0 +1,134 @@
+'''
+The cost conservation functions for the Clinical Costing system.
+
+Each costing stage records the total cost that it reads, from it's input frame, with openLedger().
+Costs that legitimately leave the stage (such as the costs written to event_costs) are recorded with release(),
+from the rows being written, and the small costs dropped before a table is saved are recorded with drop().
+Before each table is saved, check() compares the total cost read with the total cost of the frame being saved
+plus the costs released - totals that are computed independently of the adjustments, mappings, groupings,
+disbursements and distributions being checked.
+A stage that never moves costs between accounts (distribute_costs.py) is also checked account by account -
+the cost read for each account (department_code, cost_type_code), less the costs released from that account,
+must be the cost saved (or dropped) for that account. The stages that do move costs between accounts are only checked in total,
+as an account by account check would need a ledger of the moves, kept by the very code being checked.
+Any difference greater than the tolerance (--tolerance) is a failure, and the stage exits before anything is published.
+Dropped costs that add up to more than the tolerance are not a failure (accounts of less than 10 cents have always been dropped),
+but they are logged as a warning.
+No tables are re-read - the totals are kept from the frames as they are read and written.
+'''
+
+# pylint: disable=invalid-name, line-too-long, global-statement
+
+import sys
+import logging
+import functions as f
+import data as d
+
+opening = None      # The total cost read by this stage (None if no costs have been read)
+outputs = {}        # The costs released from this stage. key=output name, value=cost
+dropped = 0         # The absolute total of the small costs dropped from the tables saved by this stage
+accounts = None     # The cost read, less the costs released, for each account. key=(department_code, cost_type_code), value=cost (None if not checked by account)
+droppedAccounts = {}    # The small costs dropped from each account. key=(department_code, cost_type_code), value=cost
+reportLimit = 10    # The number of accounts reported when a check fails
+
+
+def addConservationArguments(parser):
+    '''
+    Add the conservation command line arguments
+    '''
+    parser.add_argument('-t', '--tolerance', dest='costTolerance', type=float, default=d.costTolerance,
+                        help=f'The largest difference, in dollars, between the costs saved and the costs read that is not a failure (default={d.costTolerance})')
+    return
+
+
+def accountCosts(costs_df):
+    '''
+    The total cost of each account (department_code, cost_type_code) in costs_df
+    '''
+    totals = costs_df.groupby(['department_code', 'cost_type_code'], observed=True)['cost'].sum()
+    return {(str(departmentCode), str(costTypeCode)): cost for (departmentCode, costTypeCode), cost in totals.items()}
+
+
+def openLedger(costs_df, byAccount=False):
+    '''
+    Record the total cost read by this stage - and the cost read for each account, if this stage is to be checked by account
+    '''
+    global opening, outputs, dropped, accounts, droppedAccounts
+    opening = costs_df['cost'].sum()
+    outputs = {}
+    dropped = 0
+    accounts = accountCosts(costs_df) if byAccount else None
+    droppedAccounts = {}
+    return
+
+
+def release(output, cost, account=None):
+    '''
+    Record a cost released from this stage into an output - from this account (department_code, cost_type_code), if known
+    '''
+    if opening is None:
+        return
+    outputs[output] = outputs.get(output, 0) + cost
+    if (accounts is not None) and (account is not None):
+        accounts[account] = accounts.get(account, 0) - cost
+    return
+
+
+def drop(costs_df):
+    '''
+    Record the small costs in costs_df, that are being dropped from a table, as released
+    - they are logged as a warning if, all together, they are more than the tolerance
+    '''
+    global dropped
+    if opening is None:
+        return
+    release('dropped', costs_df['cost'].sum())
+    dropped += costs_df['cost'].abs().sum()
+    for account, cost in accountCosts(costs_df).items():
+        droppedAccounts[account] = droppedAccounts.get(account, 0) + cost
+    return
+
+
+def outputCost(output):
+    '''
+    The total cost released into an output
+    '''
+    return outputs.get(output, 0)
+
+
+def check(step, costs_df):
+    '''
+    Check that the costs in costs_df, about to be saved, plus the costs released, equal the costs read - in total and, if required, by account.
+    Any difference greater than the tolerance is a failure.
+    '''
+    if opening is None:
+        return
+    saved = costs_df['cost'].sum()
+    released = sum(outputs.values())
+    difference = f.toDollars(saved + released - opening)
+    differences = []
+    if accounts is not None:
+        actual = accountCosts(costs_df)
+        for account, cost in droppedAccounts.items():
+            actual[account] = actual.get(account, 0) + cost
+        for account in set(accounts) | set(actual):
+            accountDifference = f.toDollars(actual.get(account, 0) - accounts.get(account, 0))
+            if not abs(accountDifference) <= d.costTolerance:      # NaN costs are differences too
+                differences.append((account, accountDifference))
+    droppedDollars = f.toDollars(dropped)
+    if droppedDollars > d.costTolerance:
+        logging.warning('Small costs dropped at %s add up to $%.5f (tolerance $%.5f)', step, droppedDollars, d.costTolerance)
+    if (not differences) and (abs(difference) <= d.costTolerance):        # NaN costs fail
+        logging.info('Costs conserved at %s - read $%.2f, saved $%.2f, released $%.2f', step, f.toDollars(opening), f.toDollars(saved), f.toDollars(released))
+        return
+    logging.critical('Costs not conserved at %s - read $%.2f, saved $%.2f, released $%.2f (%s), difference $%.5f, dropped $%.5f (tolerance $%.5f)',
+                     step, f.toDollars(opening), f.toDollars(saved), f.toDollars(released),
+                     ', '.join([f'{output} ${f.toDollars(cost):.2f}' for output, cost in outputs.items()]), difference, droppedDollars, d.costTolerance)
+    if differences:
+        logging.critical('Accounts not conserved: %d (largest differences first)', len(differences))
+    differences.sort(key=lambda difference: (difference[1] == difference[1], -abs(difference[1])))       # NaN differences first
+    for (departmentCode, costTypeCode), accountDifference in differences[:reportLimit]:
+        logging.critical('Account[department_code(%s), cost_type_code(%s)] - the cost saved differs from the cost read, less the costs released, by $%.5f',
+                         departmentCode, costTypeCode, accountDifference)
+    logging.shutdown()
+    sys.exit(d.EX_DATAERR)
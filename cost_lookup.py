@@ -0,0 +1,289 @@
+# pylint: disable=line-too-long, broad-exception-caught
+'''
+Script cost_lookup.py
+
+A python script to run a small, local HTTP service that answers episode and DRG cost breakdown queries
+for a clinical costing run, from the episode and DRG cost rollups, through an LRU cache that is cleared
+whenever distribute_costs.py republishes, or import_parquet.py reloads, the run.
+
+    SYNOPSIS:
+    $ python cost_lookup.py hospital_code model_code run_code
+        [-H host|--host=host]
+        [-P port|--port=port]
+        [-z cacheSize|--cacheSize=cacheSize]
+        [-r recheck|--recheck=recheck]
+        [-D DatabaseType|--DatabaseType=DatabaseType]
+        [-C configDir|--configDir=configDir]
+        [-c configFile|--configFile=configFile]
+        [-s server|--server=server]
+        [-u username|--username=username]
+        [-p password|--password=password]
+        [-d databaseName|--databaseName=databaseName]
+        [-v loggingLevel|--verbose=logingLevel]
+        [-L logDir|--logDir=logDir]
+        [-l logfile|--logfile=logfile]
+        [--profile[=mode]]
+        [--traceMemory]
+        [--roundTripThreshold=threshold]
+
+    REQUIRED
+    hospital_code
+    The hospital code for the hospital whose clinical costing run is being looked up.
+
+    model_code
+    The model code for the clinical costing model that was used for the clinical costing run.
+
+    run_code
+    The run code for the clinical costing run being looked up.
+
+    -D DatabaseType|--DatabaseType=DatabaseType
+    The type of database [choice:MSSQL/MySQL/SQLite]
+
+
+    OPTIONS
+    -H host|--host=host
+    The address to listen on (default=localhost)
+
+    -P port|--port=port
+    The port to listen on (default=8000)
+
+    -z cacheSize|--cacheSize=cacheSize
+    The number of episode (and the number of DRG) breakdowns to cache (default=4096)
+
+    -r recheck|--recheck=recheck
+    How often, in seconds, to check whether the run has been republished (default=1.0)
+
+    -C configDir|--configDir=configDir
+    The directory containing the database connection configuration file
+    (default='databaseConfig')
+
+    -c configFile|--configFile=configFile
+    The database connection configuration file (default=clinical_costing.json)
+    which has the default database values for each Database Type.
+    These can be overwritten using command line options.
+
+    -s server|--server=server]
+    The address of the database server
+
+    -u userName|--userName=userName]
+    The user name require to access the database
+
+    -p password|--userName=userName]
+    The user password require to access the database
+
+    -d databaseName|--databaseName=databaseName]
+    The name of the database
+
+    -v loggingLevel|--verbose=loggingLevel
+    Set the level of logging that you want.
+
+    -L logDir|--logDir=logDir
+    The directory where the log file will be created (default=".").
+
+    -l logfile|--logfile=logfile
+    The name of a log file where you want all messages captured.
+
+    --profile[=mode]
+    Profile this run [choice:cprofile/sampling] (default=cprofile) and save the pstats file (cprofile only)
+    and a collapsed-stack file (for flame graphs) in logDir, named after the stage, hospital, model and run.
+
+    --traceMemory
+    Trace memory allocations and save a memory report in logDir, with the top allocation sites
+    and the size of each DataFrame at each step of the stage.
+
+    --roundTripThreshold=threshold
+    When the SQL is profiled (INFO or DEBUG logging), report the SQL shapes executed more than threshold times
+    as possible N+1 patterns (default=100).
+
+
+    REQUESTS
+    GET /episode/service_code/episode_no
+    The costed breakdown of an episode (by department, cost type and event code) as JSON
+
+    GET /drg/drg
+    The costed breakdown of a DRG (by department, cost type and event code, with the number of episodes) as JSON
+
+    GET /episodes
+    The service code and episode number of every costed episode
+
+    GET /drgs
+    Every costed DRG
+
+    GET /stats
+    The cache statistics (hits, misses, size) and the number of times the cache has been cleared
+
+
+    THE MAIN CODE
+    Start by parsing the command line arguements and setting up logging.
+    Connect to the database and check the hospital_code, model_code and run_code.
+    Then answer requests until interrupted.
+'''
+
+# pylint: disable=invalid-name, bare-except, pointless-string-statement, unspecified-encoding
+
+import sys
+import json
+import argparse
+import logging
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pandas as pd
+from sqlalchemy import text
+import functions as f
+import lookup_functions as lf
+import data as d
+
+
+class CostLookupHandler(BaseHTTPRequestHandler):
+    '''
+    Answer cost lookup requests
+    '''
+    lookup = None       # The CostLookup, set before the server is started
+
+    def sendJSON(self, status, body):
+        '''
+        Send a JSON response
+        '''
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        '''
+        Route the request
+        '''
+        path = [urllib.parse.unquote(part) for part in urllib.parse.urlsplit(self.path).path.strip('/').split('/')]
+        try:
+            if (len(path) == 3) and (path[0] == 'episode'):
+                try:
+                    episode_no = int(path[2])
+                except ValueError:
+                    self.sendJSON(400, {'error': f'Invalid episode_no({path[2]})'})
+                    return
+                result = self.lookup.episode(path[1], episode_no)
+            elif (len(path) == 2) and (path[0] == 'drg'):
+                result = self.lookup.drg(path[1])
+            elif path == ['episodes']:
+                result = self.lookup.episodes()
+            elif path == ['drgs']:
+                result = self.lookup.drgs()
+            elif path == ['stats']:
+                result = self.lookup.stats()
+            else:
+                self.sendJSON(404, {'error': f'Unknown request({self.path})'})
+                return
+        except Exception as e:
+            logging.error('Lookup (%s) failed - error(%s)', self.path, repr(e))
+            self.sendJSON(500, {'error': 'Lookup failed'})
+            return
+        if result is None:
+            self.sendJSON(404, {'error': f'No costs for {"/".join(path)}'})
+            return
+        self.sendJSON(200, result)
+
+    def log_message(self, format, *args):       # pylint: disable=redefined-builtin
+        logging.debug('%s - %s', self.address_string(), format % args)
+
+
+if __name__ == '__main__':
+    '''
+    The main code
+    Start by parsing the command line arguements and setting up logging.
+    Then check that the hospital_code, model_code and run_code are valid.
+    Then answer cost lookup requests.
+    '''
+
+    # Save the program name
+    progName = sys.argv[0]
+    progName = progName[0:-3]        # Strip off the .py ending
+
+    # Set the options
+    parser = argparse.ArgumentParser(description='Answer episode and DRG cost breakdown queries for a Clinical Costing run')
+    parser.add_argument('hospital_code',
+                        help='The hospital code for the hospital whose clinical costing run is being looked up.')
+    parser.add_argument('model_code',
+                        help='The model code for the clinical costing model that was used for the clinical costing run.')
+    parser.add_argument('run_code',
+                        help='The run code for the clinical costing run being looked up.')
+    parser.add_argument('-H', '--host', dest='host', default='localhost',
+                        help='The address to listen on (default=localhost)')
+    parser.add_argument('-P', '--port', dest='port', type=int, default=8000,
+                        help='The port to listen on (default=8000)')
+    parser.add_argument('-z', '--cacheSize', dest='cacheSize', type=int, default=4096,
+                        help='The number of episode (and DRG) breakdowns to cache (default=4096)')
+    parser.add_argument('-r', '--recheck', dest='recheck', type=float, default=1.0,
+                        help='How often, in seconds, to check if the run has been republished (default=1.0)')
+    f.addCommonArguments(parser)      # Add the common command line arguments
+    args = parser.parse_args()
+
+    # Parse the command line options
+    d.hospital_code = args.hospital_code
+    d.model_code = args.model_code
+    d.run_code = args.run_code
+    host = args.host
+    port = args.port
+    cacheSize = args.cacheSize
+    recheck = args.recheck
+    configDir = args.configDir
+    configFile = args.configFile
+    DatabaseType = args.DatabaseType
+    server = args.server
+    username = args.username
+    password = args.password
+    databaseName = args.databaseName
+    logDir = args.logDir
+    logFile = args.logFile
+    loggingLevel = args.verbose
+
+    # Set up logging
+    f.setupLogging(progName, logDir, logFile, loggingLevel)
+
+    # Read in the configuration file - which must exist if required - and create the database engine
+    f.createEngine(configDir, configFile, DatabaseType, server, username, password, databaseName)
+
+    # Check that the hospital_code is valid
+    hospitals_df = pd.read_sql_query(text('SELECT hospital_code FROM hospitals'), d.engine.connect())
+    hospitals = hospitals_df.values.tolist()      # convert rows/columns to a list of lists (will be [[hospital_code]] )
+    if not [d.hospital_code] in hospitals:
+        logging.critical('hospital code (%s) no in table "hospitals"', d.hospital_code)
+        logging.shutdown()
+        sys.exit(d.EX_CONFIG)
+
+    # Check that the model_code is valid
+    models_df = pd.read_sql_query(text(f'SELECT model_code FROM models WHERE hospital_code = {f.sqlLiteral(d.hospital_code)}'), d.engine.connect())
+    models = models_df.values.tolist()      # convert rows/columns to a list of lists (will be [[model_code]] )
+    if not [d.model_code] in models:
+        logging.critical('model code (%s) no in table "models"', d.model_code)
+        logging.shutdown()
+        sys.exit(d.EX_CONFIG)
+
+    # Check that the run_code is valid
+    selectText = 'SELECT run_code FROM clinical_costing_runs WHERE hospital_code = ' + f.sqlLiteral(d.hospital_code)
+    runs_df = pd.read_sql_query(text(selectText), d.engine.connect())
+    runs = runs_df.values.tolist()      # convert rows/columns to a list of lists (will be [[run_code]] )
+    if not [d.run_code] in runs:
+        logging.critical('run code (%s) no in table "clinical_costing_runs"', d.run_code)
+        logging.shutdown()
+        sys.exit(d.EX_CONFIG)
+
+    # Start the service
+    CostLookupHandler.lookup = lf.CostLookup(cacheSize, recheck)
+    try:
+        service = ThreadingHTTPServer((host, port), CostLookupHandler)
+    except OSError as e:
+        logging.critical('Cannot listen on %s:%d - error(%s)', host, port, repr(e))
+        logging.shutdown()
+        sys.exit(d.EX_UNAVAILABLE)
+    print(f'Answering cost lookups on http://{host}:{port}/')
+    sys.stdout.flush()
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    service.server_close()
+
+    logging.shutdown()
+    sys.exit(d.EX_OK)
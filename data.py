@@ -27,9 +27,16 @@ EX_CONFIG = 78        # configuration error
 
 
 codeTables = {}     # A dictionary of all the codesets. key=table name, value=set(of codes)
+codeCategories = {} # The shared categories for the code columns. key=(hospital_code, model_code, column name), value=pandas CategoricalDtype
 engine = None       # The database engine
 metadata = None     # The database metadata
 Session = None      # The database session maker
 hospital_code = None    # The code for this hospital
 model_code = None       # The code for this clinical costing model
 run_code = None         # The code for this clinical costing run
+roundTripThreshold = 100    # SQL shapes executed more than this many times are reported as possible N+1 patterns
+fixedPoint = False      # Costs are held as integer cost units (not dollars) by the costing stages
+costScale = 100000      # Cost units per dollar in fixed point mode (the 5 decimal places of the Numeric(15,5) cost columns)
+costTolerance = 0.01    # The largest difference (in dollars) between the costs saved and the costs read that is not a conservation failure
+iterationThreshold = 0.05   # Iterative disbursement stops when the indirect costs are down to this (in dollars)
+smallCost = 0.1         # Accounts with no more than this cost (in dollars) are dropped from the disbursed and undistributed costs
@@ -11,6 +11,9 @@ A python script to disburse cost from indirect general_ledger accounts.
         [-C configDir|--configDir=configDir]
         [-c configFile|--configFile=configFile]
         [-i|--iterate]
+        [-F|--fixedPoint]
+        [-t tolerance|--tolerance=tolerance]
+        [-T|--telemetryHistory]
         [-s server|--server=server]
         [-u username|--username=username]
         [-p password|--password=password]
@@ -18,6 +21,9 @@ A python script to disburse cost from indirect general_ledger accounts.
         [-v loggingLevel|--verbose=logingLevel]
         [-L logDir|--logDir=logDir]
         [-l logfile|--logfile=logfile]
+        [--profile[=mode]]
+        [--traceMemory]
+        [--roundTripThreshold=threshold]
 
     REQUIRED
     hospital_code
@@ -33,10 +39,24 @@ A python script to disburse cost from indirect general_ledger accounts.
     to assemble the clinical costing data for this hospital.
 
     -D DatabaseType|--DatabaseType=DatabaseType
-    The type of database [choice:MSSQL/MySQL]
+    The type of database [choice:MSSQL/MySQL/SQLite]
 
 
     OPTIONS
+    -F|--fixedPoint
+    Hold the costs as integers (in units of 0.00001 dollars) rather than floating point numbers,
+    and apportion each cost using the largest remainder method, so that every distribution of costs conserves the total cost exactly.
+    Only accounts with no cost are then dropped (rather than accounts with less than 10 cents).
+
+    -t tolerance|--tolerance=tolerance
+    The largest difference, in dollars, between the total cost saved in general_ledger_disbursed and the total cost read
+    from general_ledger_built, that is not a failure (default=0.01). If the small costs dropped from general_ledger_disbursed
+    add up to more than this, then a warning is logged.
+
+    -T|--telemetryHistory
+    Append the telemetry for this run (which is always written as a JSON report next to the log file)
+    to the stage_telemetry table
+
     -C configDir|--configDir=configDir
     The directory containing the database connection configuration file
     (default='databaseConfig')
@@ -70,11 +90,23 @@ A python script to disburse cost from indirect general_ledger accounts.
     -o logfile|--logfile=logfile
     The name of a log file where you want all messages captured.
 
+    --profile[=mode]
+    Profile this run [choice:cprofile/sampling] (default=cprofile) and save the pstats file (cprofile only)
+    and a collapsed-stack file (for flame graphs) in logDir, named after the stage, hospital, model and run.
+
+    --traceMemory
+    Trace memory allocations and save a memory report in logDir, with the top allocation sites
+    and the size of each DataFrame at each step of the stage.
+
+    --roundTripThreshold=threshold
+    When the SQL is profiled (INFO or DEBUG logging), report the SQL shapes executed more than threshold times
+    as possible N+1 patterns (default=100).
+
 
     THE MAIN CODE
     Start by parsing the command line arguements, setting up logging
     and connecting to the database.
-    Then disburse any indirect cost accounts to direct cost accounts.
+    Then disburse any indirect cost accounts to direct cost accounts, in a staging table, and publish them in a single transaction.
 '''
 
 # pylint: disable=invalid-name, bare-except, pointless-string-statement, unspecified-encoding
@@ -83,8 +115,10 @@ import sys
 import argparse
 import logging
 import pandas as pd
-from sqlalchemy import text, delete, update
+from sqlalchemy import text, update
 import functions as f
+import telemetry_functions as tf
+import conservation_functions as cf
 import data as d
 
 
@@ -93,7 +127,7 @@ if __name__ == '__main__':
     The main code
     Start by parsing the command line arguements, setting up logging
     and connecting to the database.
-    Then disburse any indirect cost accounts to direct cost accounts.
+    Then disburse any indirect cost accounts to direct cost accounts, in a staging table, and publish them in a single transaction.
     '''
 
     # Save the program name
@@ -110,6 +144,10 @@ if __name__ == '__main__':
                         help='The run code for the source data being used to assemble the clinical costing data for this hospital.')
     parser.add_argument('-i', '--iterate', dest='useIteration', action='store_true',
                         help='Use the iteration model for the disbursement.')
+    parser.add_argument('-F', '--fixedPoint', dest='fixedPoint', action='store_true',
+                        help='Hold the costs as integer cost units and apportion them exactly')
+    cf.addConservationArguments(parser)   # Add the conservation command line arguments
+    tf.addTelemetryArguments(parser)  # Add the telemetry command line arguments
     f.addCommonArguments(parser)      # Add the common command line arguments
     args = parser.parse_args()
 
@@ -118,6 +156,8 @@ if __name__ == '__main__':
     d.hospital_code = args.hospital_code
     d.model_code = args.model_code
     d.run_code = args.run_code
+    d.fixedPoint = args.fixedPoint
+    d.costTolerance = args.costTolerance
     useIteration = args.useIteration
     configDir = args.configDir
     configFile = args.configFile
@@ -129,6 +169,7 @@ if __name__ == '__main__':
     logDir = args.logDir
     logFile = args.logFile
     loggingLevel = args.verbose
+    telemetryHistory = args.telemetryHistory
 
     # Set up logging
     f.setupLogging(progName, logDir, logFile, loggingLevel)
@@ -136,6 +177,9 @@ if __name__ == '__main__':
     # Read in the configuration file - which must exist if required - and create the database engine
     f.createEngine(configDir, configFile, DatabaseType, server, username, password, databaseName)
 
+    # Start collecting telemetry
+    tf.startStage(progName, logDir, logFile, telemetryHistory)
+
     # Check that the hospital_code is valid
     hospitals_df = pd.read_sql_query(text('SELECT hospital_code FROM hospitals'), d.engine.connect())
     hospitals = hospitals_df.values.tolist()      # convert rows/columns to a list of lists (will be [[hospital_code]] )
@@ -145,7 +189,7 @@ if __name__ == '__main__':
         sys.exit(d.EX_CONFIG)
 
     # Check that the model_code is valid
-    models_df = pd.read_sql_query(text(f'SELECT model_code FROM models WHERE hospital_code = "{d.hospital_code}"'), d.engine.connect())
+    models_df = pd.read_sql_query(text(f'SELECT model_code FROM models WHERE hospital_code = {f.sqlLiteral(d.hospital_code)}'), d.engine.connect())
     models = models_df.values.tolist()      # convert rows/columns to a list of lists (will be [[model_code]] )
     if not [d.model_code] in models:
         logging.critical('model code (%s) no in table "models"', d.model_code)
@@ -153,7 +197,7 @@ if __name__ == '__main__':
         sys.exit(d.EX_CONFIG)
 
     # Check that the run_code is valid
-    selectText = 'SELECT run_code FROM clinical_costing_runs WHERE hospital_code = "' + d.hospital_code + '"'
+    selectText = 'SELECT run_code FROM clinical_costing_runs WHERE hospital_code = ' + f.sqlLiteral(d.hospital_code)
     runs_df = pd.read_sql_query(text(selectText), d.engine.connect())
     runs = runs_df.values.tolist()      # convert rows/columns to a list of lists (will be [[run_code]] )
     if not [d.run_code] in runs:
@@ -162,37 +206,40 @@ if __name__ == '__main__':
         sys.exit(d.EX_CONFIG)
 
     # Build the 'where' clauses
-    where = 'hospital_code = "' + d.hospital_code + '" AND model_code = "' + d.model_code + '" AND run_code = "' + d.run_code + '"'
-    whereRun = 'hospital_code = "' + d.hospital_code + '" AND run_code = "' + d.run_code + '"'
-    whereModel = 'hospital_code = "' + d.hospital_code + '" AND model_code = "' + d.model_code + '"'
-    whereHospital = 'hospital_code = "' + d.hospital_code + '"'
+    where = 'hospital_code = ' + f.sqlLiteral(d.hospital_code) + ' AND model_code = ' + f.sqlLiteral(d.model_code) + ' AND run_code = ' + f.sqlLiteral(d.run_code)
+    whereRun = 'hospital_code = ' + f.sqlLiteral(d.hospital_code) + ' AND run_code = ' + f.sqlLiteral(d.run_code)
+    whereModel = 'hospital_code = ' + f.sqlLiteral(d.hospital_code) + ' AND model_code = ' + f.sqlLiteral(d.model_code)
+    whereHospital = 'hospital_code = ' + f.sqlLiteral(d.hospital_code)
 
-    # Delete any old data
-    with d.Session() as session:
-        session.execute(delete(d.metadata.tables['general_ledger_disbursed']).where(text(where)))
-        session.commit()
+    # Clear any old staged data (the old data stays visible until this run is published)
+    f.startStaging(['general_ledger_disbursed'])
 
     # Start by reading in the General Ledger 'as built' costs.
+    tf.startStep('read general_ledger_built')
     selectText = 'SELECT * FROM general_ledger_built WHERE ' + where
-    glCosts_df = pd.read_sql_query(text(selectText), d.engine.connect())
-    print(f"general_ledger_built: ${glCosts_df['cost'].sum():.2f}")
+    glCosts_df = f.readFrame(selectText)
+    glCosts_df['cost'] = f.toUnits(glCosts_df['cost'])
+    print(f"general_ledger_built: ${f.toDollars(glCosts_df['cost'].sum()):.2f}")
+    cf.openLedger(glCosts_df)       # Disbursing must not change the total cost
+    tf.endStep(len(glCosts_df.index), f.toDollars(glCosts_df['cost'].sum()))
 
     # Next, update any 'total*' general ledger attributes with the total cost for the matching department
-    glTotalCosts_df = glCosts_df.groupby('department_code').sum('cost').reset_index()
+    tf.startStep('total attributes')
+    glTotalCosts_df = glCosts_df.groupby('department_code', observed=True).sum('cost').reset_index()
     departments = glTotalCosts_df['department_code'].tolist()
     selectText = 'SELECT * FROM general_ledger_attributes WHERE ' + whereModel
-    attributes_df = pd.read_sql_query(text(selectText), d.engine.connect())
+    attributes_df = f.readFrame(selectText)
     tmpAttributes_df = attributes_df[attributes_df['general_ledger_attribute_code'].str.startswith('total')].copy()
     for row in tmpAttributes_df.itertuples():
         department_code = row.department_code
         cost_type_code = row.cost_type_code
         attribute_code = row.general_ledger_attribute_code
-        where = whereModel + ' AND department_code = "' + department_code + '" AND cost_type_code = "' + cost_type_code + '"'
-        where += ' AND general_ledger_attribute_code = "' + attribute_code + '"'
+        where = whereModel + ' AND department_code = ' + f.sqlLiteral(department_code) + ' AND cost_type_code = ' + f.sqlLiteral(cost_type_code)
+        where += ' AND general_ledger_attribute_code = ' + f.sqlLiteral(attribute_code)
         if department_code not in departments:
             attribute_weight = 0.0
         else:
-            attribute_weight = glTotalCosts_df[glTotalCosts_df['department_code'] == department_code]['cost'].item()
+            attribute_weight = f.toDollars(glTotalCosts_df[glTotalCosts_df['department_code'] == department_code]['cost'].item())
         attributes_df.loc[(attributes_df['department_code'] == department_code) &
                       (attributes_df['cost_type_code'] == cost_type_code) &
                       (attributes_df['general_ledger_attribute_code'] == attribute_code), ['general_ledger_attribute_weight']] = attribute_weight
@@ -202,7 +249,10 @@ if __name__ == '__main__':
             session.execute(update(d.metadata.tables['general_ledger_attributes']).values(params).where(text(where)))
             session.commit()
 
+    tf.endStep(len(tmpAttributes_df.index))
+
     # Next update any general ledger attributes which start with a cost types
+    tf.startStep('cost type attributes', len(attributes_df.index))
     selectText = 'SELECT cost_type_code FROM cost_types WHERE ' + whereHospital
     costTypes_df = pd.read_sql_query(text(selectText), d.engine.connect())
     costTypes = costTypes_df.values.tolist()      # convert rows/columns to a list of lists (will be [[cost_type]] )
@@ -220,19 +270,22 @@ if __name__ == '__main__':
                                               (glCosts_df['cost_type_code'] == costType)]
                 if len(attribute_weight_df.index) == 0:
                     continue
-                attribute_weight = attribute_weight_df['cost'].iloc[0]
+                attribute_weight = f.toDollars(attribute_weight_df['cost'].iloc[0])
                 attributes_df.loc[(attributes_df['department_code'] == department_code) &
                               (attributes_df['cost_type_code'] == cost_type_code) &
                               (attributes_df['general_ledger_attribute_code'] == attribute_code), ['general_ledger_attribute_weight']] = attribute_weight
-                where = whereModel + ' AND department_code = "' + department_code + '" AND cost_type_code = "' + cost_type_code + '"'
-                where += ' AND general_ledger_attribute_code = "' + attribute_code + '"'
+                where = whereModel + ' AND department_code = ' + f.sqlLiteral(department_code) + ' AND cost_type_code = ' + f.sqlLiteral(cost_type_code)
+                where += ' AND general_ledger_attribute_code = ' + f.sqlLiteral(attribute_code)
                 params = {}
                 params['general_ledger_attribute_weight'] = float(attribute_weight)
                 with d.Session() as session:
                     session.execute(update(d.metadata.tables['general_ledger_attributes']).values(params).where(text(where)))
                     session.commit()
         
+    tf.endStep(len(attributes_df.index))
+
     # Next apply any gl_attributes_run_adjustments
+    tf.startStep('attribute run adjustments')
     selectText = 'SELECT * FROM gl_attributes_run_adjustments WHERE ' + whereRun
     adjustments_df = pd.read_sql_query(text(selectText), d.engine.connect())
     # We need to make sure that there aren't any attribute codes which aren't in the model
@@ -255,9 +308,11 @@ if __name__ == '__main__':
                       (attributes_df['cost_type_code'] == cost_type_code) &
                       (attributes_df['general_ledger_attribute_code'] == attribute_code), ['general_ledger_attribute_weight']] = attribute_weight
 
+    tf.endStep(len(adjustments_df.index))
+
     # Then read in the General Ledger Disbursement
     selectText = 'SELECT * FROM general_ledger_disbursement WHERE ' + whereModel
-    disbursement_df = pd.read_sql_query(text(selectText), d.engine.connect())
+    disbursement_df = f.readFrame(selectText)
 
     # Now workout the disbursment levels
     levels = {}
@@ -276,12 +331,14 @@ if __name__ == '__main__':
         indCost = glCosts_df[((glCosts_df['department_code'] == deptCode) & (glCosts_df['cost_type_code'] == ctypeCode))]
         if len(indCost.index) > 0:
             indCosts += indCost['cost'].item()
-    print(f'Initial indirect costs: ${indCosts:.2f}')
+    print(f'Initial indirect costs: ${f.toDollars(indCosts):.2f}')
 
     # Now disburse the indirect costs
+    tf.startStep('disbursement', len(glCosts_df.index), f.toDollars(indCosts))
     iterationNo = 1
-    while indCosts > 0.05:       # Down to the last 5 cents
+    while indCosts > f.toUnits(d.iterationThreshold):       # Down to the last 5 cents
         for level in sorted(levels):        # Process each level in order (in case we are cascading)
+            tf.startStep(f'iteration {iterationNo} level {level}', len(levels[level]))
             for deptCode, ctypeCode, attributeCode in levels[level]:
                 indCost = glCosts_df[((glCosts_df['department_code'] == deptCode) & (glCosts_df['cost_type_code'] == ctypeCode))]
                 if len(indCost.index) == 0:
@@ -304,6 +361,12 @@ if __name__ == '__main__':
                 if totalWeight == 0.0:
                     logging.warning('Cannot disburse department(%s), cost type(%s) as totalWeight is zero', deptCode, ctypeCode)
                     continue    # Nothing to distribute to
+                if d.fixedPoint:        # Apportion the whole cost, so nothing is lost to rounding
+                    thisCosts = f.apportion(thisIndCost, [targetWeight for targetDept, targetCtypeCode, targetWeight in targetAccounts])
+                    for (targetDept, targetCtypeCode, targetWeight), thisCost in zip(targetAccounts, thisCosts):
+                        glCosts_df = f.moveCosts(deptCode, ctypeCode, int(thisCost), targetDept, targetCtypeCode, 'A', glCosts_df)
+                        logging.info('Disbursed department(%s), cost type(%s), cost(%.2f) to department(%s), cost type(%s)', deptCode, ctypeCode, f.toDollars(thisCost), targetDept, targetCtypeCode)
+                    continue
                 for targetDept, targetCtypeCode, targetWeight in targetAccounts:
                     try:
                         thisFraction = targetWeight / totalWeight
@@ -313,6 +376,7 @@ if __name__ == '__main__':
                     thisCost = thisIndCost * thisFraction
                     glCosts_df = f.moveCosts(deptCode, ctypeCode, thisCost, targetDept, targetCtypeCode, 'A', glCosts_df)
                     logging.info('Disbursed department(%s), cost type(%s), cost(%.2f) to department(%s), cost type(%s)', deptCode, ctypeCode, thisCost, targetDept, targetCtypeCode)
+            tf.endStep(len(glCosts_df.index))
 
         # Compute the amount of remaining indirect costs
         indCosts = 0
@@ -324,7 +388,7 @@ if __name__ == '__main__':
             if len(indCost.index) > 0:
                 indCosts += indCost['cost'].item()
         if useIteration:
-            print(f'Remaining indirect costs (after iteration {iterationNo}): ${indCosts:.2f}')
+            print(f'Remaining indirect costs (after iteration {iterationNo}): ${f.toDollars(indCosts):.2f}')
             iterationNo += 1
             if lastIndCosts is None:
                 lastIndCosts = indCosts
@@ -337,12 +401,26 @@ if __name__ == '__main__':
             continue
         break
     if not useIteration:
-        print(f'Remaining indirect costs (after cascading): ${indCosts:.2f}')
+        print(f'Remaining indirect costs (after cascading): ${f.toDollars(indCosts):.2f}')
+    tf.endStep(len(glCosts_df.index), f.toDollars(indCosts))
 
     # Save the disbursed costs
-    glCosts_df = glCosts_df[glCosts_df['cost'].abs() > 0.1]
-    glCosts_df.to_sql('general_ledger_disbursed', d.engine, if_exists='append', index=False)
-    print(f"general_ledger_disbursed: ${glCosts_df['cost'].sum():.2f}")
-
+    tf.startStep('save general_ledger_disbursed', len(glCosts_df.index), f.toDollars(glCosts_df['cost'].sum()))
+    if d.fixedPoint:        # The costs are exact, so only the empty accounts are dropped
+        kept = glCosts_df['cost'] != 0
+    else:
+        kept = glCosts_df['cost'].abs() > d.smallCost
+    cf.drop(glCosts_df[~kept])
+    glCosts_df = glCosts_df[kept]
+    cf.check('general_ledger_disbursed', glCosts_df)
+    glCosts_df.assign(cost=f.toDollars(glCosts_df['cost'])).to_sql(f.stagingTable('general_ledger_disbursed'), d.engine, if_exists='append', index=False)
+    print(f"general_ledger_disbursed: ${f.toDollars(glCosts_df['cost'].sum()):.2f}")
+    tf.endStep(len(glCosts_df.index), f.toDollars(glCosts_df['cost'].sum()))
+
+    # Publish this run from the staging tables
+    tf.startStep('publish')
+    tf.endStep(f.publishRun(['general_ledger_disbursed']))
+
+    tf.endStage()
     logging.shutdown()
     sys.exit(d.EX_OK)
@@ -7,6 +7,9 @@ A python script to distribute costs from direct general_ledger accounts to clini
 
     SYNOPSIS:
     $ python distribute.py hospital_code model_code run_code
+        [-F|--fixedPoint]
+        [-t tolerance|--tolerance=tolerance]
+        [-T|--telemetryHistory]
         [-D DatabaseType|--DatabaseType=DatabaseType]
         [-C configDir|--configDir=configDir]
         [-c configFile|--configFile=configFile]
@@ -17,6 +20,9 @@ A python script to distribute costs from direct general_ledger accounts to clini
         [-v loggingLevel|--verbose=logingLevel]
         [-L logDir|--logDir=logDir]
         [-l logfile|--logfile=logfile]
+        [--profile[=mode]]
+        [--traceMemory]
+        [--roundTripThreshold=threshold]
 
 
     REQUIRED
@@ -33,10 +39,26 @@ A python script to distribute costs from direct general_ledger accounts to clini
     to calculate clinical costs by distributing costs to clinical events.
 
     -D DatabaseType|--DatabaseType=DatabaseType
-    The type of database [choice:MSSQL/MySQL]
+    The type of database [choice:MSSQL/MySQL/SQLite]
 
 
     OPTIONS
+    -F|--fixedPoint
+    Hold the costs as integers (in units of 0.00001 dollars) rather than floating point numbers,
+    and apportion each cost using the largest remainder method, so that every distribution of costs conserves the total cost exactly.
+    Only accounts with no cost are then dropped (rather than accounts with less than 10 cents).
+
+    -t tolerance|--tolerance=tolerance
+    The largest difference, in dollars, between the total cost read from general_ledger_disbursed and the total cost
+    written to event_costs (cost based feeder costs and distributed costs) plus the total cost saved in general_ledger_undistributed,
+    that is not a failure (default=0.01). The same difference is checked for each account - the cost read for the account,
+    less the costs written to event_costs from it, against the cost saved (or dropped) for it.
+    If the small costs dropped from general_ledger_undistributed add up to more than this, then a warning is logged.
+
+    -T|--telemetryHistory
+    Append the telemetry for this run (which is always written as a JSON report next to the log file)
+    to the stage_telemetry table
+
     -C configDir|--configDir=configDir
     The directory containing the database connection configuration file
     (default='databaseConfig')
@@ -67,11 +89,24 @@ A python script to distribute costs from direct general_ledger accounts to clini
     -o logfile|--logfile=logfile
     The name of a log file where you want all messages captured.
 
+    --profile[=mode]
+    Profile this run [choice:cprofile/sampling] (default=cprofile) and save the pstats file (cprofile only)
+    and a collapsed-stack file (for flame graphs) in logDir, named after the stage, hospital, model and run.
+
+    --traceMemory
+    Trace memory allocations and save a memory report in logDir, with the top allocation sites
+    and the size of each DataFrame at each step of the stage.
+
+    --roundTripThreshold=threshold
+    When the SQL is profiled (INFO or DEBUG logging), report the SQL shapes executed more than threshold times
+    as possible N+1 patterns (default=100).
+
 
     THE MAIN CODE
     Start by parsing the command line arguements, setting up logging
     and connect to the database.
-    Then distribute the costs data to clinical events.
+    Then distribute the costs data to clinical events, in the staging tables, and publish them,
+    with the rebuilt materialized cost rollups (by service, DRG, clinical specialty and episode) for this run, in a single transaction.
 '''
 
 # pylint: disable=invalid-name, bare-except, pointless-string-statement, unspecified-encoding
@@ -81,8 +116,10 @@ import os
 import argparse
 import logging
 import pandas as pd
-from sqlalchemy import text, delete, insert
+from sqlalchemy import text
 import functions as f
+import telemetry_functions as tf
+import conservation_functions as cf
 import build_events_functions as bf
 import data as d
 
@@ -92,7 +129,7 @@ if __name__ == '__main__':
     The main code
     Start by parsing the command line arguements, setting up logging
     and connect to the database.
-    Then distribute the costs data to clinical events.
+    Then distribute the costs data to clinical events, in the staging tables, and publish them in a single transaction.
     '''
 
     # Save the program name
@@ -109,6 +146,10 @@ if __name__ == '__main__':
                         help='The run code for the source data being used to assemble the clinical costing data for this hospital.')
     parser.add_argument('-i', '--iterate', dest='useIteration', action='store_true',
                         help='Use the iteration model for the disbursement.')
+    parser.add_argument('-F', '--fixedPoint', dest='fixedPoint', action='store_true',
+                        help='Hold the costs as integer cost units and apportion them exactly')
+    cf.addConservationArguments(parser)   # Add the conservation command line arguments
+    tf.addTelemetryArguments(parser)  # Add the telemetry command line arguments
     f.addCommonArguments(parser)      # Add the common command line arguments
     args = parser.parse_args()
 
@@ -117,6 +158,8 @@ if __name__ == '__main__':
     d.hospital_code = args.hospital_code
     d.model_code = args.model_code
     d.run_code = args.run_code
+    d.fixedPoint = args.fixedPoint
+    d.costTolerance = args.costTolerance
     useIteration = args.useIteration
     configDir = args.configDir
     configFile = args.configFile
@@ -128,6 +171,7 @@ if __name__ == '__main__':
     logDir = args.logDir
     logFile = args.logFile
     loggingLevel = args.verbose
+    telemetryHistory = args.telemetryHistory
 
     # Set up logging
     f.setupLogging(progName, logDir, logFile, loggingLevel)
@@ -135,6 +179,9 @@ if __name__ == '__main__':
     # Read in the configuration file - which must exist if required - and create the database engine
     f.createEngine(configDir, configFile, DatabaseType, server, username, password, databaseName)
 
+    # Start collecting telemetry
+    tf.startStage(progName, logDir, logFile, telemetryHistory)
+
     # Check that the hospital_code is valid
     hospitals_df = pd.read_sql_query(text('SELECT hospital_code FROM hospitals'), d.engine.connect())
     hospitals = hospitals_df.values.tolist()      # convert rows/columns to a list of lists (will be [[hospital_code]] )
@@ -144,7 +191,7 @@ if __name__ == '__main__':
         sys.exit(d.EX_CONFIG)
 
     # Check that the model_code is valid
-    models_df = pd.read_sql_query(text(f'SELECT model_code FROM models WHERE hospital_code = "{d.hospital_code}"'), d.engine.connect())
+    models_df = pd.read_sql_query(text(f'SELECT model_code FROM models WHERE hospital_code = {f.sqlLiteral(d.hospital_code)}'), d.engine.connect())
     models = models_df.values.tolist()      # convert rows/columns to a list of lists (will be [[model_code]] )
     if not [d.model_code] in models:
         logging.critical('model code (%s) no in table "models"', d.model_code)
@@ -152,7 +199,7 @@ if __name__ == '__main__':
         sys.exit(d.EX_CONFIG)
 
     # Check that the run_code is valid
-    selectText = 'SELECT run_code FROM clinical_costing_runs WHERE hospital_code = "' + d.hospital_code + '"'
+    selectText = 'SELECT run_code FROM clinical_costing_runs WHERE hospital_code = ' + f.sqlLiteral(d.hospital_code)
     runs_df = pd.read_sql_query(text(selectText), d.engine.connect())
     runs = runs_df.values.tolist()      # convert rows/columns to a list of lists (will be [[run_code]] )
     if not [d.run_code] in runs:
@@ -161,61 +208,62 @@ if __name__ == '__main__':
         sys.exit(d.EX_CONFIG)
 
     # Build the 'where' clauses
-    where = 'hospital_code = "' + d.hospital_code + '" AND model_code = "' + d.model_code + '" AND run_code = "' + d.run_code + '"'
+    where = 'hospital_code = ' + f.sqlLiteral(d.hospital_code) + ' AND model_code = ' + f.sqlLiteral(d.model_code) + ' AND run_code = ' + f.sqlLiteral(d.run_code)
     bf.SQLwhere = where
-    whereRun = 'hospital_code = "' + d.hospital_code + '" AND run_code = "' + d.run_code + '"'
+    whereRun = 'hospital_code = ' + f.sqlLiteral(d.hospital_code) + ' AND run_code = ' + f.sqlLiteral(d.run_code)
     bf.SQLwhereRun = whereRun
-    whereModel = 'hospital_code = "' + d.hospital_code + '" AND model_code = "' + d.model_code + '"'
+    whereModel = 'hospital_code = ' + f.sqlLiteral(d.hospital_code) + ' AND model_code = ' + f.sqlLiteral(d.model_code)
     bf.SQLwhereModel = whereModel
-    whereHospital = 'hospital_code = "' + d.hospital_code + '"'
+    whereHospital = 'hospital_code = ' + f.sqlLiteral(d.hospital_code)
     bf.SQLwhereHospital = whereHospital
 
-    # Delete any old data
-    with d.Session() as session:
-        session.execute(delete(d.metadata.tables['event_costs']).where(text(where)))
-        session.execute(delete(d.metadata.tables['general_ledger_undistributed']).where(text(where)))
-        session.commit()
+    # Clear any old staged data (the old data stays visible until this run is published)
+    runTables = ['event_costs', 'general_ledger_undistributed']
+    f.startStaging(runTables)
+    eventCostsTable = f.stagingTable('event_costs')
 
     # Start by reading in the General Ledger 'as disbursed' costs, ready for distribution.
+    tf.startStep('read general_ledger_disbursed')
     selectText = 'SELECT * FROM general_ledger_disbursed WHERE ' + where
-    glCosts_df = pd.read_sql_query(text(selectText), d.engine.connect())
-    print(f"general_ledger_disbursed: ${glCosts_df['cost'].sum():.2f}")
+    glCosts_df = f.readFrame(selectText)
+    glCosts_df['cost'] = f.toUnits(glCosts_df['cost'])
+    print(f"general_ledger_disbursed: ${f.toDollars(glCosts_df['cost'].sum()):.2f}")
+    cf.openLedger(glCosts_df, byAccount=True)       # Every cost written to event_costs from here on is released from it's account
+    tf.endStep(len(glCosts_df.index), f.toDollars(glCosts_df['cost'].sum()))
 
     # Then create the event_cost records from the invoice data
     # And clear down the associated General Ledger Accounts
     # Process each cost based feeder
-    selectText = 'SELECT feeder_code FROM feeders WHERE ' + whereHospital + ' AND feeder_type_code = "C"'
-    feeders_df = pd.read_sql_query(text(selectText), d.engine.connect())
-    selectText = 'SELECT * FROM feeder_model WHERE ' + whereModel
-    feederAccounts_df = pd.read_sql_query(text(selectText), d.engine.connect())
-    selectText = f'SELECT hospital_code, run_code, "{d.model_code}" as model_code, feeder_code as event_code, '
+    tf.startStep('feeder costs')
+    feeders = 'SELECT feeder_code FROM feeders WHERE ' + whereHospital + " AND feeder_type_code = 'C'"
+    selectText = f'SELECT hospital_code, run_code, {f.sqlLiteral(d.model_code)} as model_code, feeder_code as event_code, '
     selectText += 'feeder_code as event_attribute_code, service_code, episode_no, invoice_line_no as event_seq, '
     selectText += 'department_code, cost_type_code, invoice_no as event_what, feeder_code as distribution_code, amount as cost '
-    selectText += 'FROM itemized_costs WHERE ' + bf.SQLwhereRun
-    for row in feeders_df.itertuples():
-        feederCode = row.feeder_code
-        thisSelectText = selectText + f' AND feeder_code = "{feederCode}"'
-        eventCosts_df = pd.read_sql_query(text(thisSelectText), d.engine.connect())
-        eventCosts_df.to_sql('event_costs', d.engine, if_exists='append', index=False)
-        newAccounts_df = feederAccounts_df[feederAccounts_df['feeder_code'] == feederCode]
-        newDepartmentCode = newAccounts_df['new_department_code'].item()
-        newCostTypeCode = newAccounts_df['new_cost_type_code'].item()
-        glCosts_df.loc[(glCosts_df['department_code'] == newDepartmentCode) & (glCosts_df['cost_type_code'] == newCostTypeCode), 'cost'] = 0.0
+    selectText += 'FROM itemized_costs WHERE ' + bf.SQLwhereRun + ' AND feeder_code IN (' + feeders + ')'
+    eventCosts_df = pd.read_sql_query(text(selectText), d.engine.connect())
+    eventCosts_df.to_sql(eventCostsTable, d.engine, if_exists='append', index=False)
+    # The costs in the feeder accounts are now in the event costs
+    selectText = 'SELECT feeder_code, new_department_code, new_cost_type_code FROM feeder_model WHERE ' + whereModel + ' AND feeder_code IN (' + feeders + ')'
+    feederAccounts_df = pd.read_sql_query(text(selectText), d.engine.connect())
+    feederAccounts = pd.MultiIndex.from_frame(feederAccounts_df[['new_department_code', 'new_cost_type_code']])
+    feederAccount = {row.feeder_code: (str(row.new_department_code), str(row.new_cost_type_code)) for row in feederAccounts_df.itertuples()}
+    for feederCode, feederCost in f.toUnits(eventCosts_df['cost']).groupby(eventCosts_df['event_code']).sum().items():
+        cf.release('event_costs', feederCost, feederAccount.get(feederCode))     # Feeders not in this model have no account
+    glCosts_df.loc[pd.MultiIndex.from_frame(glCosts_df[['department_code', 'cost_type_code']]).isin(feederAccounts), 'cost'] = 0
+    tf.endStep(len(eventCosts_df.index), eventCosts_df['cost'].sum())
 
     # Next read in the general_ledger_distribution which tells how to distribute those costs
     selectText = 'SELECT * FROM general_ledger_distribution WHERE ' + whereModel
-    distribution_df = pd.read_sql_query(text(selectText), d.engine.connect())
+    distribution_df = f.readFrame(selectText)
 
     # And finally the event over which those costs will be distributed
     selectText = 'SELECT * FROM events WHERE ' + where
-    events_df = pd.read_sql_query(text(selectText), d.engine.connect())
+    events_df = f.readFrame(selectText)
 
     # Now create the event_cost records
-    params = {}
-    params['hospital_code'] = d.hospital_code
-    params['run_code'] = d.run_code
-    params['model_code'] = d.model_code
-    groupedDistribution_df = distribution_df.groupby(['department_code', 'cost_type_code'])
+    tf.startStep('distribution', len(events_df.index), f.toDollars(glCosts_df['cost'].sum()))
+    distributed = []        # The event_costs for each distribution code of each account - saved together once every account is distributed
+    groupedDistribution_df = distribution_df.groupby(['department_code', 'cost_type_code'], observed=True)
     for groupTuple, group_df in groupedDistribution_df:
         departmentCode, costTypeCode = groupTuple
         account_df = glCosts_df[(glCosts_df['department_code'] == departmentCode) & (glCosts_df['cost_type_code'] == costTypeCode)]
@@ -223,48 +271,84 @@ if __name__ == '__main__':
             logging.warning('No account [department_code(%s), cost_type_code(%s)] in general_ledger_disbursed', departmentCode, costTypeCode)
             continue
         originalCost = account_df['cost'].item()
-        params['department_code'] = departmentCode
-        params['cost_type_code'] = costTypeCode
-        for row in group_df.itertuples():
+        tf.startStep(f'{departmentCode}/{costTypeCode}', len(group_df.index), f.toDollars(originalCost))
+        accountRows = 0
+        accountCost = 0
+        fractions = group_df['distribution_fraction'].tolist()
+        if float(sum(fractions)) > 1.0 + 1e-9:
+            if d.fixedPoint:
+                logging.warning('Distribution fractions for department(%s), cost type(%s) sum to %f - scaled down to distribute exactly the account cost',
+                                departmentCode, costTypeCode, float(sum(fractions)))
+            else:
+                logging.warning('Distribution fractions for department(%s), cost type(%s) sum to %f - more than the account cost will be distributed',
+                                departmentCode, costTypeCode, float(sum(fractions)))
+        if d.fixedPoint:        # Apportion the whole cost - any fraction not distributed is left in the account
+            rowCosts = f.apportion(originalCost, fractions + [max(0.0, 1.0 - float(sum(fractions)))])
+        else:
+            rowCosts = [originalCost * fraction for fraction in fractions]
+        for row, rowCost in zip(group_df.itertuples(), rowCosts):
             distributionCode = row.distribution_code
-            distributionFraction = row.distribution_fraction
-            rowCost = originalCost * distributionFraction
             theseEvents_df = events_df[events_df['distribution_code'] == distributionCode]
             if len(theseEvents_df.index) == 0:
                 logging.warning('No events for distribution_code(%s) for department(%s)/cost type(%s)',
                                 distributionCode, departmentCode, costTypeCode)
                 continue
             # Get the total weight and distribute this cost over this weight
-            params['distribution_code'] = distributionCode
             totalWeight = theseEvents_df['event_weight'].sum()
             if totalWeight is None:
                 logging.critical('No event weights for distribution code(%s) no in table "events"', distributionCode)
                 logging.shutdown()
                 sys.exit(d.EX_CONFIG)
-            with d.Session() as session:
-                for eventRow in theseEvents_df.itertuples():
-                    fraction = eventRow.event_weight / totalWeight
-                    partCost = rowCost * fraction
-                    params['event_code'] = eventRow.event_code
-                    params['event_attribute_code'] = eventRow.event_attribute_code
-                    params['service_code'] = eventRow.service_code
-                    params['episode_no'] = eventRow.episode_no
-                    params['event_seq'] = eventRow.event_seq
-                    params['event_what'] = eventRow.event_what
-                    params['cost'] = float(partCost)
-                    session.execute(insert(d.metadata.tables['event_costs']).values(params))
-                session.commit()
-        glCosts_df.loc[(glCosts_df['department_code'] == departmentCode) & (glCosts_df['cost_type_code'] == costTypeCode), 'cost'] = 0.0
+            if d.fixedPoint:
+                if totalWeight == 0:
+                    logging.warning('Cannot distribute department(%s), cost type(%s) to distribution code(%s) as totalWeight is zero',
+                                    departmentCode, costTypeCode, distributionCode)
+                    continue
+                partCosts = f.apportion(rowCost, theseEvents_df['event_weight'])
+            else:
+                partCosts = rowCost * (theseEvents_df['event_weight'] / totalWeight)
+            cf.release('event_costs', partCosts.sum(), (str(departmentCode), str(costTypeCode)))
+            distributed.append(theseEvents_df[['event_code', 'event_attribute_code', 'service_code', 'episode_no', 'event_seq', 'event_what']].assign(
+                hospital_code=d.hospital_code, run_code=d.run_code, model_code=d.model_code, department_code=departmentCode, cost_type_code=costTypeCode,
+                distribution_code=distributionCode, cost=f.toDollars(partCosts)))
+            accountRows += len(theseEvents_df.index)
+            accountCost += rowCost
+        if d.fixedPoint:
+            glCosts_df.loc[(glCosts_df['department_code'] == departmentCode) & (glCosts_df['cost_type_code'] == costTypeCode), 'cost'] = originalCost - accountCost
+        else:
+            glCosts_df.loc[(glCosts_df['department_code'] == departmentCode) & (glCosts_df['cost_type_code'] == costTypeCode), 'cost'] = 0.0
+        tf.endStep(accountRows, f.toDollars(accountCost))
+    tf.endStep(None, f.toDollars(glCosts_df['cost'].sum()))
+
+    # Save the distributed event costs with one bulk write
+    tf.startStep('save event_costs')
+    distributedRows = 0
+    if len(distributed) > 0:
+        distributed_df = pd.concat(distributed, ignore_index=True)
+        distributed_df.to_sql(eventCostsTable, d.engine, if_exists='append', index=False)
+        distributedRows = len(distributed_df.index)
+    tf.endStep(distributedRows)
 
     # Save the undistributed costs
-    glCosts_df = glCosts_df[glCosts_df['cost'].abs() > 0.1]
-    glCosts_df.to_sql('general_ledger_undistributed', d.engine, if_exists='append', index=False)
+    tf.startStep('save general_ledger_undistributed', len(glCosts_df.index), f.toDollars(glCosts_df['cost'].sum()))
+    if d.fixedPoint:        # The costs are exact, so only the empty accounts are dropped
+        kept = glCosts_df['cost'] != 0
+    else:
+        kept = glCosts_df['cost'].abs() > d.smallCost
+    cf.drop(glCosts_df[~kept])
+    glCosts_df = glCosts_df[kept]
+    cf.check('general_ledger_undistributed', glCosts_df)
+    glCosts_df = glCosts_df.assign(cost=f.toDollars(glCosts_df['cost']))
+    glCosts_df.to_sql(f.stagingTable('general_ledger_undistributed'), d.engine, if_exists='append', index=False)
     undistributedCosts = glCosts_df['cost'].sum()
+    tf.endStep(len(glCosts_df.index), undistributedCosts)
+
+    # Publish this run from the staging tables, and rebuild the materialized cost rollups for this hospital, model and run, in one transaction
+    tf.startStep('publish')
+    tf.endStep(f.publishRun(runTables, refreshRollups=True))
 
-    # Report the distributed costs
-    selectText = 'SELECT sum(cost) as cost FROM event_costs WHERE ' + where
-    distributedCosts_df = pd.read_sql_query(text(selectText), d.engine.connect())
-    distributedCosts = distributedCosts_df['cost'].item()
+    # Report the distributed costs (the running total of the costs released into event_costs)
+    distributedCosts = f.toDollars(cf.outputCost('event_costs'))
     print(f"general_ledger_distributed: ${distributedCosts:.2f}")
 
     # And finally report an remaining undistributed costs
@@ -272,5 +356,6 @@ if __name__ == '__main__':
     # And save them as an Excel workbook
     glCosts_df.to_excel(os.path.join(logDir, 'undistributed_costs.xlsx'), index=False)
 
+    tf.endStage()
     logging.shutdown()
     sys.exit(d.EX_OK)
@@ -0,0 +1,332 @@
+# pylint: disable=line-too-long, broad-exception-caught
+'''
+Script export_duckdb.py
+
+A python script to mirror the results of a clinical costing run, and the matching activity and code tables,
+into a local DuckDB database file, where the cost reporting views can be queried in columnar form
+without loading the clinical costing database.
+
+    SYNOPSIS:
+    $ python export_duckdb.py [hospital_code model_code run_code]
+        [-o duckdbFile|--duckdbFile=duckdbFile]
+        [-k chunkSize|--chunkSize=chunkSize]
+        [-q query|--query=query]
+        [-x queryOutput|--queryOutput=queryOutput]
+        [-D DatabaseType|--DatabaseType=DatabaseType]
+        [-C configDir|--configDir=configDir]
+        [-c configFile|--configFile=configFile]
+        [-s server|--server=server]
+        [-u username|--username=username]
+        [-p password|--password=password]
+        [-d databaseName|--databaseName=databaseName]
+        [-v loggingLevel|--verbose=logingLevel]
+        [-L logDir|--logDir=logDir]
+        [-l logfile|--logfile=logfile]
+        [--profile[=mode]]
+        [--traceMemory]
+        [--roundTripThreshold=threshold]
+
+    REQUIRED
+    hospital_code
+    The hospital code for the hospital whose clinical costing run is being exported.
+
+    model_code
+    The model code for the clinical costing model that was used for the clinical costing run.
+
+    run_code
+    The run code for the clinical costing run being exported.
+
+    [hospital_code, model_code and run_code are only optional if a query is being run on an existing DuckDB file]
+
+    -D DatabaseType|--DatabaseType=DatabaseType
+    The type of database [choice:MSSQL/MySQL/SQLite]
+
+
+    OPTIONS
+    -o duckdbFile|--duckdbFile=duckdbFile
+    The DuckDB database file (default=clinical_costing.duckdb).
+    The file is created if it does not exist. Any existing data for this hospital_code/model_code/run_code is replaced.
+
+    -k chunkSize|--chunkSize=chunkSize
+    The number of rows to copy from the clinical costing database at a time (default=100000)
+
+    -q query|--query=query
+    An SQL query to be run against the DuckDB file, after any export
+    e.g. "SELECT drg, sum(cost) AS cost FROM inpatDRGcosts GROUP BY drg ORDER BY drg"
+
+    -x queryOutput|--queryOutput=queryOutput
+    Save the results of the query to this file (.xlsx or .csv), rather than printing them
+
+    -C configDir|--configDir=configDir
+    The directory containing the database connection configuration file
+    (default='databaseConfig')
+
+    -c configFile|--configFile=configFile
+    The database connection configuration file (default=clinical_costing.json)
+    which has the default database values for each Database Type.
+    These can be overwritten using command line options.
+
+    -s server|--server=server]
+    The address of the database server
+
+    -u userName|--userName=userName]
+    The user name require to access the database
+
+    -p password|--userName=userName]
+    The user password require to access the database
+
+    -d databaseName|--databaseName=databaseName]
+    The name of the database
+
+    -v loggingLevel|--verbose=loggingLevel
+    Set the level of logging that you want.
+
+    -L logDir|--logDir=logDir
+    The directory where the log file will be created (default=".").
+
+    -l logfile|--logfile=logfile
+    The name of a log file where you want all messages captured.
+
+    --profile[=mode]
+    Profile this run [choice:cprofile/sampling] (default=cprofile) and save the pstats file (cprofile only)
+    and a collapsed-stack file (for flame graphs) in logDir, named after the stage, hospital, model and run.
+
+    --traceMemory
+    Trace memory allocations and save a memory report in logDir, with the top allocation sites
+    and the size of each DataFrame at each step of the stage.
+
+    --roundTripThreshold=threshold
+    When the SQL is profiled (INFO or DEBUG logging), report the SQL shapes executed more than threshold times
+    as possible N+1 patterns (default=100).
+
+
+    THE MAIN CODE
+    Start by parsing the command line arguements and setting up logging.
+    If exporting, connect to the database, check the hospital_code, model_code and run_code,
+    then copy each mirrored table, chunk by chunk, into the DuckDB file and (re)create the cost reporting views.
+    Then run any query against the DuckDB file.
+'''
+
+# pylint: disable=invalid-name, bare-except, pointless-string-statement, unspecified-encoding
+
+import sys
+import argparse
+import logging
+import datetime
+import decimal
+import pandas as pd
+import duckdb
+from sqlalchemy import text
+import functions as f
+import data as d
+
+
+# The tables mirrored into DuckDB - the rows copied depend upon which of run_code and model_code are in each table
+mirrorTables = ['general_ledger_disbursed', 'general_ledger_undistributed', 'events', 'event_costs',
+                'inpat_episode_details', 'inpat_patient_location', 'inpat_theatre_details', 'clinic_activity_details', 'ed_episode_details',
+                'departments', 'cost_types', 'services', 'wards', 'theatres', 'clinics', 'clinicians',
+                'event_codes', 'event_attribute_codes', 'distribution_codes']
+
+# The cost reporting views (as per tools/createSQLAlchemyDBviews.py)
+duckdbViews = {
+    'inpatDRGcosts': '''
+        SELECT inpat_episode_details.drg AS drg, inpat_episode_details.hospital_code AS hospital_code, event_costs.model_code AS model_code,
+            inpat_episode_details.run_code AS run_code, event_costs.event_code AS event_code, event_costs.event_attribute_code AS event_attribute_code,
+            event_costs.service_code AS service_code, inpat_episode_details.episode_no AS episode_no, event_costs.event_seq AS event_seq,
+            event_costs.department_code AS department_code, event_costs.cost_type_code AS cost_type_code, event_costs.event_what AS event_what,
+            event_costs.distribution_code AS distribution_code, event_costs.cost AS cost
+        FROM inpat_episode_details JOIN event_costs ON inpat_episode_details.hospital_code = event_costs.hospital_code
+            AND inpat_episode_details.run_code = event_costs.run_code AND inpat_episode_details.episode_no = event_costs.episode_no
+        WHERE event_costs.service_code = 'Inpat'
+    ''',
+    'inpatClinicalSpecialtyCosts': '''
+        SELECT inpat_episode_details.clinical_specialty AS clinical_specialty, inpat_episode_details.hospital_code AS hospital_code, event_costs.model_code AS model_code,
+            inpat_episode_details.run_code AS run_code, event_costs.event_code AS event_code, event_costs.event_attribute_code AS event_attribute_code,
+            event_costs.service_code AS service_code, inpat_episode_details.episode_no AS episode_no, event_costs.event_seq AS event_seq,
+            event_costs.department_code AS department_code, event_costs.cost_type_code AS cost_type_code, event_costs.event_what AS event_what,
+            event_costs.distribution_code AS distribution_code, event_costs.cost AS cost
+        FROM inpat_episode_details JOIN event_costs ON inpat_episode_details.hospital_code = event_costs.hospital_code
+            AND inpat_episode_details.run_code = event_costs.run_code AND inpat_episode_details.episode_no = event_costs.episode_no
+        WHERE event_costs.service_code = 'Inpat'
+    ''',
+}
+
+
+def duckdbType(column):
+    '''
+    Return the DuckDB data type for a clinical costing database column
+    '''
+    pythonType = column.type.python_type
+    if pythonType == int:
+        return 'BIGINT'
+    if pythonType == float:
+        return 'DOUBLE'
+    if pythonType == decimal.Decimal:
+        if getattr(column.type, 'precision', None) is not None:
+            return f'DECIMAL({column.type.precision},{column.type.scale or 0})'
+        return 'DOUBLE'
+    if pythonType == datetime.datetime:
+        return 'TIMESTAMP'
+    if pythonType == datetime.date:
+        return 'DATE'
+    if pythonType == bool:
+        return 'BOOLEAN'
+    return 'VARCHAR'
+
+
+if __name__ == '__main__':
+    '''
+    The main code
+    Start by parsing the command line arguements and setting up logging.
+    Then, if exporting, check that the hospital_code, model_code and run_code are valid
+    and mirror the tables for this run into the DuckDB file.
+    Then run any query.
+    '''
+
+    # Save the program name
+    progName = sys.argv[0]
+    progName = progName[0:-3]        # Strip off the .py ending
+
+    # Set the options
+    parser = argparse.ArgumentParser(description='Export a Clinical Costing run to DuckDB and query it')
+    parser.add_argument('hospital_code', nargs='?',
+                        help='The hospital code for the hospital whose clinical costing run is being exported.')
+    parser.add_argument('model_code', nargs='?',
+                        help='The model code for the clinical costing model that was used for the clinical costing run.')
+    parser.add_argument('run_code', nargs='?',
+                        help='The run code for the clinical costing run being exported.')
+    parser.add_argument('-o', '--duckdbFile', dest='duckdbFile', default='clinical_costing.duckdb',
+                        help='The DuckDB database file (default=clinical_costing.duckdb)')
+    parser.add_argument('-k', '--chunkSize', dest='chunkSize', type=int, default=100000,
+                        help='The number of rows to copy at a time (default=100000)')
+    parser.add_argument('-q', '--query', dest='query', help='An SQL query to run against the DuckDB file')
+    parser.add_argument('-x', '--queryOutput', dest='queryOutput', help='The file (.xlsx or .csv) for the query results')
+    f.addCommonArguments(parser)      # Add the common command line arguments
+    args = parser.parse_args()
+
+    # Parse the command line options
+    d.hospital_code = args.hospital_code
+    d.model_code = args.model_code
+    d.run_code = args.run_code
+    duckdbFile = args.duckdbFile
+    chunkSize = args.chunkSize
+    query = args.query
+    queryOutput = args.queryOutput
+    configDir = args.configDir
+    configFile = args.configFile
+    DatabaseType = args.DatabaseType
+    server = args.server
+    username = args.username
+    password = args.password
+    databaseName = args.databaseName
+    logDir = args.logDir
+    logFile = args.logFile
+    loggingLevel = args.verbose
+
+    # Set up logging
+    f.setupLogging(progName, logDir, logFile, loggingLevel)
+
+    # Check that we have something to do
+    doExport = d.run_code is not None
+    if (not doExport) and (d.hospital_code is not None):
+        logging.critical('hospital_code, model_code and run_code are all required for an export')
+        logging.shutdown()
+        sys.exit(d.EX_USAGE)
+    if (not doExport) and (query is None):
+        logging.critical('Nothing to do - no hospital_code, model_code and run_code to export and no query')
+        logging.shutdown()
+        sys.exit(d.EX_USAGE)
+
+    # Open (or create) the DuckDB file
+    try:
+        duck = duckdb.connect(duckdbFile)
+    except Exception as e:
+        logging.critical('Cannot open DuckDB file (%s) - error(%s)', duckdbFile, repr(e))
+        logging.shutdown()
+        sys.exit(d.EX_CANTCREAT)
+
+    if doExport:
+        # Read in the configuration file - which must exist if required - and create the database engine
+        f.createEngine(configDir, configFile, DatabaseType, server, username, password, databaseName)
+
+        # Check that the hospital_code is valid
+        hospitals_df = pd.read_sql_query(text('SELECT hospital_code FROM hospitals'), d.engine.connect())
+        hospitals = hospitals_df.values.tolist()      # convert rows/columns to a list of lists (will be [[hospital_code]] )
+        if not [d.hospital_code] in hospitals:
+            logging.critical('hospital code (%s) no in table "hospitals"', d.hospital_code)
+            logging.shutdown()
+            sys.exit(d.EX_CONFIG)
+
+        # Check that the model_code is valid
+        models_df = pd.read_sql_query(text(f'SELECT model_code FROM models WHERE hospital_code = {f.sqlLiteral(d.hospital_code)}'), d.engine.connect())
+        models = models_df.values.tolist()      # convert rows/columns to a list of lists (will be [[model_code]] )
+        if not [d.model_code] in models:
+            logging.critical('model code (%s) no in table "models"', d.model_code)
+            logging.shutdown()
+            sys.exit(d.EX_CONFIG)
+
+        # Check that the run_code is valid
+        selectText = 'SELECT run_code FROM clinical_costing_runs WHERE hospital_code = ' + f.sqlLiteral(d.hospital_code)
+        runs_df = pd.read_sql_query(text(selectText), d.engine.connect())
+        runs = runs_df.values.tolist()      # convert rows/columns to a list of lists (will be [[run_code]] )
+        if not [d.run_code] in runs:
+            logging.critical('run code (%s) no in table "clinical_costing_runs"', d.run_code)
+            logging.shutdown()
+            sys.exit(d.EX_CONFIG)
+
+        # Build the 'where' clauses
+        where = 'hospital_code = ' + f.sqlLiteral(d.hospital_code) + ' AND model_code = ' + f.sqlLiteral(d.model_code) + ' AND run_code = ' + f.sqlLiteral(d.run_code)
+        whereRun = 'hospital_code = ' + f.sqlLiteral(d.hospital_code) + ' AND run_code = ' + f.sqlLiteral(d.run_code)
+        whereModel = 'hospital_code = ' + f.sqlLiteral(d.hospital_code) + ' AND model_code = ' + f.sqlLiteral(d.model_code)
+        whereHospital = 'hospital_code = ' + f.sqlLiteral(d.hospital_code)
+
+        # Mirror each table, replacing any existing rows for this hospital/model/run
+        for thisTable in mirrorTables:
+            columns = d.metadata.tables[thisTable].columns
+            if ('run_code' in columns) and ('model_code' in columns):
+                thisWhere = where
+            elif 'run_code' in columns:
+                thisWhere = whereRun
+            elif 'model_code' in columns:
+                thisWhere = whereModel
+            else:
+                thisWhere = whereHospital
+            columnNames = [column.name for column in columns]
+            columnDefinitions = ', '.join([column.name + ' ' + duckdbType(column) for column in columns])
+            duck.execute(f'CREATE TABLE IF NOT EXISTS {thisTable} ({columnDefinitions})')
+            duck.execute(f'DELETE FROM {thisTable} WHERE {thisWhere}')
+            rows = 0
+            selectText = 'SELECT ' + ', '.join(columnNames) + f' FROM {thisTable} WHERE {thisWhere}'
+            with d.engine.connect().execution_options(stream_results=True) as conn:     # Stream, so buffering drivers don't read the whole table
+                for chunk_df in pd.read_sql_query(text(selectText), conn, chunksize=chunkSize):
+                    duck.register('chunk_df', chunk_df)
+                    duck.execute(f'INSERT INTO {thisTable} ({", ".join(columnNames)}) SELECT {", ".join(columnNames)} FROM chunk_df')
+                    duck.unregister('chunk_df')
+                    rows += len(chunk_df.index)
+            logging.info('%d rows copied to %s', rows, thisTable)
+            print(f'{thisTable}: {rows} rows')
+
+        # (Re)create the cost reporting views
+        for viewName, viewSQL in duckdbViews.items():
+            duck.execute(f'CREATE OR REPLACE VIEW {viewName} AS {viewSQL}')
+        duck.execute('CHECKPOINT')
+
+    # Run any query
+    if query is not None:
+        try:
+            result_df = duck.execute(query).df()
+        except Exception as e:
+            logging.critical('Query (%s) failed - error(%s)', query, repr(e))
+            duck.close()
+            logging.shutdown()
+            sys.exit(d.EX_DATAERR)
+        if queryOutput is None:
+            print(result_df.to_string(index=False))
+        elif queryOutput.endswith('.csv'):
+            result_df.to_csv(queryOutput, index=False)
+        else:
+            result_df.to_excel(queryOutput, index=False)
+
+    duck.close()
+    logging.shutdown()
+    sys.exit(d.EX_OK)
@@ -0,0 +1,221 @@
+# pylint: disable=line-too-long, broad-exception-caught
+'''
+Script export_parquet.py
+
+A python script to export the results of a clinical costing run (events, event_costs,
+general_ledger_disbursed and general_ledger_undistributed) as a Parquet dataset,
+partitioned by hospital_code/model_code/run_code.
+
+    SYNOPSIS:
+    $ python export_parquet.py hospital_code model_code run_code
+        [-O outputDir|--outputDir=outputDir]
+        [-k chunkSize|--chunkSize=chunkSize]
+        [-z compression|--compression=compression]
+        [-D DatabaseType|--DatabaseType=DatabaseType]
+        [-C configDir|--configDir=configDir]
+        [-c configFile|--configFile=configFile]
+        [-s server|--server=server]
+        [-u username|--username=username]
+        [-p password|--password=password]
+        [-d databaseName|--databaseName=databaseName]
+        [-v loggingLevel|--verbose=logingLevel]
+        [-L logDir|--logDir=logDir]
+        [-l logfile|--logfile=logfile]
+        [--profile[=mode]]
+        [--traceMemory]
+        [--roundTripThreshold=threshold]
+
+    REQUIRED
+    hospital_code
+    The hospital code for the hospital whose clinical costing run is being exported.
+
+    model_code
+    The model code for the clinical costing model that was used for the clinical costing run.
+
+    run_code
+    The run code for the clinical costing run being exported.
+
+    -D DatabaseType|--DatabaseType=DatabaseType
+    The type of database [choice:MSSQL/MySQL/SQLite]
+
+
+    OPTIONS
+    -O outputDir|--outputDir=outputDir
+    The directory for the Parquet dataset (default='parquet').
+    Each table is written to outputDir/table/hospital_code=hospital_code/model_code=model_code/run_code=run_code/
+    and any existing Parquet files for this partition are replaced.
+
+    -k chunkSize|--chunkSize=chunkSize
+    The number of rows to read from the database, and write as a row group, at a time (default=100000)
+
+    -z compression|--compression=compression
+    The Parquet compression [choice:zstd/snappy/gzip/none] (default=zstd)
+
+    -C configDir|--configDir=configDir
+    The directory containing the database connection configuration file
+    (default='databaseConfig')
+
+    -c configFile|--configFile=configFile
+    The database connection configuration file (default=clinical_costing.json)
+    which has the default database values for each Database Type.
+    These can be overwritten using command line options.
+
+    -s server|--server=server]
+    The address of the database server
+
+    -u userName|--userName=userName]
+    The user name require to access the database
+
+    -p password|--userName=userName]
+    The user password require to access the database
+
+    -d databaseName|--databaseName=databaseName]
+    The name of the database
+
+    -v loggingLevel|--verbose=loggingLevel
+    Set the level of logging that you want.
+
+    -L logDir|--logDir=logDir
+    The directory where the log file will be created (default=".").
+
+    -l logfile|--logfile=logfile
+    The name of a log file where you want all messages captured.
+
+    --profile[=mode]
+    Profile this run [choice:cprofile/sampling] (default=cprofile) and save the pstats file (cprofile only)
+    and a collapsed-stack file (for flame graphs) in logDir, named after the stage, hospital, model and run.
+
+    --traceMemory
+    Trace memory allocations and save a memory report in logDir, with the top allocation sites
+    and the size of each DataFrame at each step of the stage.
+
+    --roundTripThreshold=threshold
+    When the SQL is profiled (INFO or DEBUG logging), report the SQL shapes executed more than threshold times
+    as possible N+1 patterns (default=100).
+
+
+    THE MAIN CODE
+    Start by parsing the command line arguements and setting up logging.
+    Connect to the database and check the hospital_code, model_code and run_code.
+    Then stream each result table, chunk by chunk, into a Parquet file in it's partition directory.
+'''
+
+# pylint: disable=invalid-name, bare-except, pointless-string-statement, unspecified-encoding
+
+import os
+import sys
+import argparse
+import logging
+import pandas as pd
+import pyarrow.parquet as pq
+from sqlalchemy import text
+import functions as f
+import parquet_functions as pf
+import data as d
+
+
+if __name__ == '__main__':
+    '''
+    The main code
+    Start by parsing the command line arguements and setting up logging.
+    Then check that the hospital_code, model_code and run_code are valid.
+    Then export each result table.
+    '''
+
+    # Save the program name
+    progName = sys.argv[0]
+    progName = progName[0:-3]        # Strip off the .py ending
+
+    # Set the options
+    parser = argparse.ArgumentParser(description='Export Clinical Costing run results as a partitioned Parquet dataset')
+    parser.add_argument('hospital_code',
+                        help='The hospital code for the hospital whose clinical costing run is being exported.')
+    parser.add_argument('model_code',
+                        help='The model code for the clinical costing model that was used for the clinical costing run.')
+    parser.add_argument('run_code',
+                        help='The run code for the clinical costing run being exported.')
+    parser.add_argument('-O', '--outputDir', dest='outputDir', default='parquet',
+                        help='The directory for the Parquet dataset (default=parquet)')
+    parser.add_argument('-k', '--chunkSize', dest='chunkSize', type=int, default=100000,
+                        help='The number of rows to read and write at a time (default=100000)')
+    parser.add_argument('-z', '--compression', dest='compression', choices=['zstd', 'snappy', 'gzip', 'none'], default='zstd',
+                        help='The Parquet compression (default=zstd)')
+    f.addCommonArguments(parser)      # Add the common command line arguments
+    args = parser.parse_args()
+
+    # Parse the command line options
+    d.hospital_code = args.hospital_code
+    d.model_code = args.model_code
+    d.run_code = args.run_code
+    outputDir = args.outputDir
+    chunkSize = args.chunkSize
+    compression = args.compression
+    configDir = args.configDir
+    configFile = args.configFile
+    DatabaseType = args.DatabaseType
+    server = args.server
+    username = args.username
+    password = args.password
+    databaseName = args.databaseName
+    logDir = args.logDir
+    logFile = args.logFile
+    loggingLevel = args.verbose
+
+    # Set up logging
+    f.setupLogging(progName, logDir, logFile, loggingLevel)
+
+    # Read in the configuration file - which must exist if required - and create the database engine
+    f.createEngine(configDir, configFile, DatabaseType, server, username, password, databaseName)
+
+    # Check that the hospital_code is valid
+    hospitals_df = pd.read_sql_query(text('SELECT hospital_code FROM hospitals'), d.engine.connect())
+    hospitals = hospitals_df.values.tolist()      # convert rows/columns to a list of lists (will be [[hospital_code]] )
+    if not [d.hospital_code] in hospitals:
+        logging.critical('hospital code (%s) no in table "hospitals"', d.hospital_code)
+        logging.shutdown()
+        sys.exit(d.EX_CONFIG)
+
+    # Check that the model_code is valid
+    models_df = pd.read_sql_query(text(f'SELECT model_code FROM models WHERE hospital_code = {f.sqlLiteral(d.hospital_code)}'), d.engine.connect())
+    models = models_df.values.tolist()      # convert rows/columns to a list of lists (will be [[model_code]] )
+    if not [d.model_code] in models:
+        logging.critical('model code (%s) no in table "models"', d.model_code)
+        logging.shutdown()
+        sys.exit(d.EX_CONFIG)
+
+    # Check that the run_code is valid
+    selectText = 'SELECT run_code FROM clinical_costing_runs WHERE hospital_code = ' + f.sqlLiteral(d.hospital_code)
+    runs_df = pd.read_sql_query(text(selectText), d.engine.connect())
+    runs = runs_df.values.tolist()      # convert rows/columns to a list of lists (will be [[run_code]] )
+    if not [d.run_code] in runs:
+        logging.critical('run code (%s) no in table "clinical_costing_runs"', d.run_code)
+        logging.shutdown()
+        sys.exit(d.EX_CONFIG)
+
+    # Build the 'where' clause
+    where = 'hospital_code = ' + f.sqlLiteral(d.hospital_code) + ' AND model_code = ' + f.sqlLiteral(d.model_code) + ' AND run_code = ' + f.sqlLiteral(d.run_code)
+
+    if compression == 'none':
+        compression = None
+
+    # Export each table
+    for thisTable in pf.resultTables:
+        schema = pf.arrowSchema(thisTable)
+        thisDir = pf.partitionDir(outputDir, thisTable)
+        os.makedirs(thisDir, exist_ok=True)
+        for oldFile in os.listdir(thisDir):     # Replace any previous export of this run
+            if oldFile.endswith('.parquet'):
+                os.remove(os.path.join(thisDir, oldFile))
+        dictionaryColumns = [field.name for field in schema if str(field.type).startswith('dictionary')]
+        rows = 0
+        selectText = f'SELECT * FROM {thisTable} WHERE {where}'
+        with pq.ParquetWriter(os.path.join(thisDir, 'part-0.parquet'), schema, compression=compression, use_dictionary=dictionaryColumns) as writer:
+            with d.engine.connect().execution_options(stream_results=True) as conn:     # Stream, so buffering drivers don't read the whole table
+                for chunk_df in pd.read_sql_query(text(selectText), conn, chunksize=chunkSize):
+                    writer.write_table(pf.toArrow(chunk_df, schema))
+                    rows += len(chunk_df.index)
+        logging.info('%d rows exported from %s to %s', rows, thisTable, thisDir)
+        print(f'{thisTable}: {rows} rows')
+
+    logging.shutdown()
+    sys.exit(d.EX_OK)
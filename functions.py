@@ -6,16 +6,22 @@ The common functions for the Clinical Costing system.
 
 import os
 import sys
+import re
 import logging
 import collections
 import json
 import decimal
+import hashlib
+import datetime
+import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine, MetaData, text, select, insert, update
+from sqlalchemy import create_engine, MetaData, text, select, insert, update, delete, func, and_
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import OperationalError
 from sqlalchemy_utils import database_exists
 import data as d
+import profiling_functions as prf
+import sheet_functions as sf
 
 
 def addCommonArguments(parser):
@@ -26,8 +32,8 @@ def addCommonArguments(parser):
                         help='The name of the directory containing the database connection configuration file (default=config)')
     parser.add_argument('-c', '--configFile', dest='configFile', default='clinical_costing.json',
                         help='The name of the configuration file (default clinical_costing.json)')
-    parser.add_argument('-D', '--DatabaseType', dest='DatabaseType', choices=['MSSQL', 'MySQL'],
-                        help='The Database Type [choices: MSSQL/MySQL]')
+    parser.add_argument('-D', '--DatabaseType', dest='DatabaseType', choices=['MSSQL', 'MySQL', 'SQLite'],
+                        help='The Database Type [choices: MSSQL/MySQL/SQLite]')
     parser.add_argument('-s', '--server', dest='server', help='The address of the database server')
     parser.add_argument('-u', '--username', dest='username', help='The user required to access the database')
     parser.add_argument('-p', '--password', dest='password', help='The user password required to access the database')
@@ -35,6 +41,12 @@ def addCommonArguments(parser):
     parser.add_argument ('-v', '--verbose', dest='verbose', type=int, choices=range(0,5), help='The level of logging\n\t0=CRITICAL,1=ERROR,2=WARNING,3=INFO,4=DEBUG')
     parser.add_argument ('-L', '--logDir', dest='logDir', default='.', metavar='logDir', help='The name of the directory where the logging file will be created')
     parser.add_argument ('-l', '--logFile', dest='logFile', metavar='logfile', help='The name of a logging file')
+    parser.add_argument ('--profile', dest='profile', nargs='?', const='cprofile', choices=['cprofile', 'sampling'], action=prf.ProfileAction,
+                         help='Profile this run and save the pstats and collapsed-stack (flame graph) files in logDir [choices: cprofile/sampling] (default=cprofile)')
+    parser.add_argument ('--traceMemory', dest='traceMemory', nargs=0, default=False, action=prf.TraceMemoryAction,
+                         help='Trace memory allocations and save a report of the top allocation sites and DataFrame sizes at each step in logDir')
+    parser.add_argument ('--roundTripThreshold', dest='roundTripThreshold', type=int, metavar='threshold', action=prf.RoundTripThresholdAction,
+                         help=f'Report SQL shapes executed more than threshold times as possible N+1 patterns (default={d.roundTripThreshold})')
     return
 
 
@@ -64,6 +76,10 @@ def setupLogging(progName, logDir, logFile, loggingLevel):
         logging.getLogger('sqlalchemy.engine').setLevel(logging_levels[loggingLevel])
     else:
         logging.getLogger('sqlalchemy.engine').setLevel(logging.WARN)
+
+    # Profile the SQL round trips if the -v verbose option asks for INFO or DEBUG logging
+    if (loggingLevel is not None) and (loggingLevel >= 3):
+        prf.startSQLProfile()
     return
 
 
@@ -99,16 +115,16 @@ def createEngine(configDir, configFile, DatabaseType, server, username, password
     if ('databaseName' in config[DatabaseType]) and (databaseName is None):
         databaseName = config[DatabaseType]['databaseName']
 
-    # Check that we have all the required paramaters
-    if username is None:
+    # Check that we have all the required paramaters (those used in the connectionString)
+    if (username is None) and ('{username}' in connectionString):
         logging.critical('Missing definition for "username"')
         logging.shutdown()
         sys.exit(d.EX_USAGE)
-    if password is None:
+    if (password is None) and ('{password}' in connectionString):
         logging.critical('Missing definition for "password"')
         logging.shutdown()
         sys.exit(d.EX_USAGE)
-    if server is None:
+    if (server is None) and ('{server}' in connectionString):
         logging.critical('Missing definition for "server"')
         logging.shutdown()
         sys.exit(d.EX_USAGE)
@@ -121,6 +137,8 @@ def createEngine(configDir, configFile, DatabaseType, server, username, password
     # Create the engine
     if DatabaseType == 'MSSQL':
         d.engine = create_engine(connectionString, use_setinputsizes=False, echo=False)
+    elif DatabaseType == 'SQLite':      # Wait for other writers (batch runs) rather than failing with "database is locked"
+        d.engine = create_engine(connectionString, connect_args={'timeout':300}, echo=False)
     else:
         d.engine = create_engine(connectionString, echo=False)
 
@@ -150,9 +168,77 @@ def createEngine(configDir, configFile, DatabaseType, server, username, password
     return
 
 
+def sqlLiteral(value):
+    '''
+    Return value as a portable SQL string literal (single quoted, with embedded single quotes doubled)
+    '''
+    value = str(value).replace("'", "''")
+    if (d.engine is not None) and (d.engine.dialect.name == 'mysql'):      # MySQL also treats backslash as an escape character
+        value = value.replace('\\', '\\\\')
+    return "'" + value + "'"
+
+
+def sqlPortable(sqlText):
+    '''
+    Convert any MySQL style double quoted string literals in some configured SQL (e.g. event_where)
+    to portable single quoted string literals. Single quoted string literals are left unchanged.
+    '''
+    if (sqlText is None) or ('"' not in sqlText):
+        return sqlText
+    return re.sub(r"('(?:[^']|'')*')|\"((?:[^\"]|\"\")*)\"",
+                  lambda match: match.group(1) if match.group(1) is not None else sqlLiteral(match.group(2).replace('""', '"')), sqlText)
+
+
+# The code columns that are read as categoricals - key=column name, value=(the code table, whether the codes are model specific)
+codeColumns = {
+    'department_code': ('departments', False),
+    'cost_type_code': ('cost_types', False),
+    'service_code': ('services', False),
+    'event_code': ('event_codes', True),
+    'event_attribute_code': ('event_attribute_codes', True),
+    'distribution_code': ('distribution_codes', True),
+}
+
+
+def codeCategories(column, codes):
+    '''
+    Return the categories shared by every DataFrame for this code column - the codes in it's code table for this hospital (and model).
+    Any codes not (yet) in the code table are added to the shared categories.
+    The categories are kept for each hospital and model, so the codes of one hospital or model never leak into the next.
+    '''
+    key = (d.hospital_code, d.model_code, column)
+    if key not in d.codeCategories:
+        codeTable, modelCodes = codeColumns[column]
+        selectText = f'SELECT DISTINCT {column} FROM {codeTable} WHERE hospital_code = {sqlLiteral(d.hospital_code)}'
+        if modelCodes:
+            selectText += f' AND model_code = {sqlLiteral(d.model_code)}'
+        codes_df = pd.read_sql_query(text(selectText), d.engine.connect())
+        d.codeCategories[key] = pd.CategoricalDtype(sorted(codes_df[column].dropna().unique()))
+    categories = d.codeCategories[key].categories
+    newCodes = codes[~codes.isin(categories)]
+    if len(newCodes) > 0:
+        d.codeCategories[key] = pd.CategoricalDtype(categories.append(pd.Index(sorted(newCodes))))
+    return d.codeCategories[key]
+
+
+def readFrame(selectText):
+    '''
+    Read the results of a query into a DataFrame, with the code columns (department_code, cost_type_code, event_code etc.)
+    as categoricals with shared categories, so that comparisons, merges and group-bys use the integer category codes.
+    Group-bys on these columns need observed=True (otherwise every combination of the categories becomes a group).
+    '''
+    frame_df = pd.read_sql_query(text(selectText), d.engine.connect())
+    for column in frame_df.columns:
+        if column in codeColumns:
+            frame_df[column] = frame_df[column].astype(codeCategories(column, pd.Index(frame_df[column].dropna().unique())))
+        elif column in ['hospital_code', 'run_code', 'model_code', 'event_what']:      # Not from a code table, but only a few distinct values
+            frame_df[column] = frame_df[column].astype('category')
+    return frame_df
+
+
 def checkWorksheet(wb, sheet, table, toBeAdded):
     '''
-    Check that a worksheet exist in the workbook and that the name of the sheet matches a database table,
+    Check that a worksheet exist in the workbook (or a sheet file in the directory of sheet files) and that the name of the sheet matches a database table,
     and that the sheet has column headings that match the database table column names,
     and that the data in this sheet matches the defined datatype for the columns in the table.
     '''
@@ -166,66 +252,22 @@ def checkWorksheet(wb, sheet, table, toBeAdded):
         logging.shutdown()
         sys.exit(d.EX_CONFIG)
 
-    # Check this worksheet
-    ws = wb[sheet]
-
-    # Make sure every column in the this worksheet matches a column name in this table
-    # and that every cell has data of the correct data type
-    found = []
-    for col in ws.columns:
-        heading = True
-        for cell in col:
-            if heading:
-                if not isinstance(cell.value, str):
-                    logging.critical('Invalid heading "%s" (not string) in worksheet "%s" at "%s"', cell.value, sheet, cell.coordinate)
-                    logging.shutdown()
-                    sys.exit(d.EX_CONFIG)
-                colName = cell.value
-                if colName in d.metadata.tables[table].columns:
-                    found.append(colName)
-                else:
-                    logging.critical('Extraneous column "%s" in worksheet "%s" at "%s"', colName, sheet, cell.coordinate)
-                    logging.shutdown()
-                    sys.exit(d.EX_CONFIG)
-                colType = d.metadata.tables[table].columns[colName].type.python_type
-                heading = False
-                continue
-            if cell.value is None:
-                break
-            if not isinstance(cell.value, colType):
-                failed = True
-                if isinstance(cell.value, int) and ((colType == float) or (colType == decimal.Decimal)):
-                    failed = False
-                elif isinstance(cell.value, float):
-                    if (colType == decimal.Decimal):
-                        failed = False
-                    elif (colType == int):
-                        try:
-                            x = int(cell.value)
-                            if x == cell.value:
-                                failed = False
-                        except Exception as e:
-                            pass
-                if failed:
-                    logging.critical('Invalid data "%s" (type %s not %s) in column "%s" in worksheet "%s" at "%s"',
-                                    cell.value, type(cell.value), colType, colName, sheet, cell.coordinate)
-                    logging.shutdown()
-                    sys.exit(d.EX_CONFIG)
-
-    # Check that every column in the database table has a column in the worksheet
-    for col in d.metadata.tables[table].columns:
-        column = col.name
-        if column in toBeAdded:
-            continue
-        if column not in found:
-            logging.critical('Database column (%s) in table "%s" not found in sheet "%s" headers', column, table, sheet)
-            logging.shutdown()
-            sys.exit(d.EX_CONFIG)
-
-    # Check any codes that need to be in a code table
-    data = ws.values
-    cols = next(data)
-    table_df = pd.DataFrame(list(data), columns=cols)
+    # Check this worksheet (or collect the check from the worker process that checked it)
+    if sheet in sf.sheetChecks:
+        table_df = sf.collectCheck(sheet)
+        if isinstance(wb, sf.SheetDirectory):
+            wb.checked[sheet] = table_df
+    elif isinstance(wb, sf.SheetDirectory):     # The codes are checked as each chunk of the sheet file is read
+        return sf.checkSheet(wb, sheet, table, toBeAdded, lambda chunk_df: checkCodes(chunk_df, sheet, table, toBeAdded))
+    else:
+        table_df = sf.checkWorkbookSheet(wb[sheet], sheet, table, toBeAdded)
+    return checkCodes(table_df, sheet, table, toBeAdded)
+
+
+def checkCodes(table_df, sheet, table, toBeAdded):
+    '''
+    Check any codes that need to be in a code table
+    '''
     for foreign_key in d.metadata.tables[table].foreign_key_constraints:
         codeColumn = foreign_key.column_keys[-1]
         if codeColumn in toBeAdded:
@@ -239,15 +281,15 @@ def checkWorksheet(wb, sheet, table, toBeAdded):
                 if column_key == 'hospital_code':
                     if where != '':
                         where += ' AND '
-                    where += f'hospital_code = "{d.hospital_code}"'
+                    where += f'hospital_code = {sqlLiteral(d.hospital_code)}'
                 if column_key == 'run_code':
                     if where != '':
                         where += ' AND '
-                    where += f'run_code = "{d.run_code}"'
+                    where += f'run_code = {sqlLiteral(d.run_code)}'
                 if column_key == 'model_code':
                     if where != '':
                         where += ' AND '
-                    where += f'model_code = "{d.model_code}"'
+                    where += f'model_code = {sqlLiteral(d.model_code)}'
             if where != '':
                 selectText += ' WHERE ' + where
             selected_df = pd.read_sql_query(text(selectText), d.engine.connect())
@@ -255,8 +297,8 @@ def checkWorksheet(wb, sheet, table, toBeAdded):
             d.codeTables[refered_table] = set()
             for codeRow in codes:
                 d.codeTables[refered_table].add(codeRow[0])
-        # Check every foreign key value to make sure that it is in the matching codeset
-        for code in table_df[codeColumn]:
+        # Check every foreign key value to make sure that it is in the matching codeset (each different value once)
+        for code in table_df[codeColumn].unique():
             if code not in d.codeTables[refered_table]:
                 logging.critical('Code "%s" in worksheet "%s" is not in database code table "%s"', code, sheet, refered_table)
                 logging.critical('table codes(%s)', d.codeTables[refered_table])
@@ -288,7 +330,7 @@ def addTableData(dfTable, thisTable):
             foundCols.add(col)
             if where != '':
                 where += ' AND '
-            where += col + ' = "' + getattr(row, col) + '"'
+            where += col + ' = ' + sqlLiteral(getattr(row, col))
         for col in d.metadata.tables[thisTable].primary_key.columns:
             colName = col.name
             if colName in indexedColumns:
@@ -301,10 +343,8 @@ def addTableData(dfTable, thisTable):
             value = getattr(row, colName)
             if isinstance(value, int) or isinstance(value, float):
                 where += colName + ' = ' + str(value)
-            elif isinstance(value, str):
-                where += colName + ' = "' + value.replace('"', '\\"') + '"'
             else:
-                where += colName + ' = "' + str(value).replace('"', '\\"') + '"'
+                where += colName + ' = ' + sqlLiteral(value)
         with d.Session() as session:
             results = session.scalars(select(d.metadata.tables[thisTable]).where(text(where))).all()
         logging.debug("table(%s), where(%s), results(%s)", thisTable, where, results)
@@ -319,6 +359,10 @@ def addTableData(dfTable, thisTable):
             if type(param) not in [int, float, str, decimal.Decimal]:
                 if param is None:
                     param = ''
+                elif isinstance(param, datetime.date) and (col.type.python_type in [datetime.date, datetime.datetime]):
+                    # Pass dates as dates - some databases (SQLite) will not accept a string for a date
+                    if (col.type.python_type == datetime.date) and isinstance(param, datetime.datetime):
+                        param = param.date()
                 else:
                     param = str(param)
             params[colName] = param
@@ -334,6 +378,62 @@ def addTableData(dfTable, thisTable):
                 session.commit()
     return
 
+def toUnits(costs):
+    '''
+    In fixed point mode, convert costs (in dollars) to integer cost units - costs can be a single cost or a Series of costs
+    '''
+    if not d.fixedPoint:
+        return costs
+    if isinstance(costs, pd.Series):
+        return (pd.to_numeric(costs).astype('float64') * d.costScale).round().astype('int64')
+    return int(round(float(costs) * d.costScale))
+
+
+def toDollars(costs):
+    '''
+    In fixed point mode, convert cost units back to dollars - costs can be a single cost or a Series of costs
+    '''
+    if not d.fixedPoint:
+        return costs
+    return costs / d.costScale
+
+
+def apportion(total, weights):
+    '''
+    Apportion an integer total (of cost units) in proportion to the weights, using the largest remainder method.
+    Each part is rounded down and the units lost to rounding go to the parts with the largest remainders,
+    so the parts always add up to exactly the total. The weights must not add up to zero.
+    '''
+    weights = np.asarray(weights, dtype='float64')
+    quotas = total * (weights / weights.sum())
+    parts = np.floor(quotas).astype('int64')
+    extra, shortfall = divmod(int(total - parts.sum()), len(parts))      # extra is only non-zero if the quotas drifted
+    parts += extra
+    parts[np.argsort(parts - quotas, kind='stable')[:shortfall]] += 1
+    return parts
+
+
+def sameCategories(frames):
+    '''
+    Return the frames with every categorical column of the first frame made categorical, with the same categories, in every frame,
+    so that pd.concat() keeps the categoricals (concatenating categoricals with different categories makes them objects)
+    '''
+    frames = [frame_df.copy(deep=False) for frame_df in frames]
+    for column in frames[0].columns:
+        if not isinstance(frames[0][column].dtype, pd.CategoricalDtype):
+            continue
+        codes = pd.Index(pd.concat([frame_df[column].astype(object) for frame_df in frames[1:] if column in frame_df.columns]).dropna().unique())
+        if column in codeColumns:
+            dtype = codeCategories(column, codes)
+        else:
+            categories = frames[0][column].cat.categories
+            dtype = pd.CategoricalDtype(categories.append(pd.Index(sorted(codes[~codes.isin(categories)]))))
+        for frame_df in frames:
+            if column in frame_df.columns:
+                frame_df[column] = frame_df[column].astype(dtype)
+    return frames
+
+
 def moveCosts(fromDeptCode, fromCostType, toAmount, toDeptCode, toCostType, mappingCode, dfCosts):
     '''
     Move a cost from one account to another
@@ -344,11 +444,13 @@ def moveCosts(fromDeptCode, fromCostType, toAmount, toDeptCode, toCostType, mapp
         oldFromAmount = dfFromCost['cost'].iloc[0]
         if mappingCode == 'F':        # This is a fractional cost (thisAmount is actually a fraction, not a cost)
             toAmount = oldFromAmount * toAmount
+            if d.fixedPoint:
+                toAmount = int(round(toAmount))
 
         #Check to see if this  requires a new thisRow
         if len(dfToCost.index) == 0:
             newRow = {'hospital_code': d.hospital_code, 'run_code': d.run_code, 'model_code': d.model_code, 'department_code': toDeptCode, 'cost_type_code': toCostType, 'cost': toAmount}
-            dfCosts = pd.concat([dfCosts, pd.DataFrame(newRow, index=[0])], ignore_index=True)
+            dfCosts = pd.concat(sameCategories([dfCosts, pd.DataFrame(newRow, index=[0])]), ignore_index=True)
         else:
             dfCosts.loc[(dfCosts.department_code == toDeptCode) & (dfCosts.cost_type_code == toCostType), 'cost'] += toAmount
         dfCosts.loc[(dfCosts.department_code == fromDeptCode) & (dfCosts.cost_type_code == fromCostType), 'cost'] -= toAmount
@@ -363,9 +465,220 @@ def generalLedgerAdjustOrMap(adjustMap_df, costs_df, preservedCostTypes):
         thisFromCostType = thisRow.from_cost_type_code
         thisMappingCode = thisRow.mapping_type_code
         thisAmount = thisRow.amount
+        if thisMappingCode != 'F':
+            thisAmount = toUnits(thisAmount)
         thisToDeptCode = thisRow.to_department_code
         thisToCostType = thisRow.to_cost_type_code
         preservedCostTypes.add(thisToCostType)
         costs_df = moveCosts(thisFromDeptCode, thisFromCostType, thisAmount, thisToDeptCode, thisToCostType, thisMappingCode, costs_df)
     return costs_df, preservedCostTypes
 
+
+def groupCodes(codes, groupings):
+    '''
+    Work out where each code ends up after a sequence of groupings [(from code, to code)] is applied in order
+    (the codes can be department codes, cost type codes or (department code, cost type code) accounts).
+    A grouping of a code that has already been grouped into another code matches nothing.
+    Return the map of each code that moves to it's new code, and the list of groupings that matched nothing
+    '''
+    members = {code: [code] for code in codes}       # key=code after grouping, value=the original codes now grouped in it
+    unmatched = []
+    for fromCode, toCode in groupings:
+        if fromCode not in members:
+            unmatched.append((fromCode, toCode))
+            continue
+        if fromCode != toCode:
+            members.setdefault(toCode, []).extend(members.pop(fromCode))
+    codeMap = {}
+    for toCode, fromCodes in members.items():
+        for fromCode in fromCodes:
+            if fromCode != toCode:
+                codeMap[fromCode] = toCode
+    return codeMap, unmatched
+
+
+def regroupCosts(costs_df, column, newCodes):
+    '''
+    Replace the department_code or cost_type_code (column) of every account with newCodes (a list of the new codes, or a map of the codes that change),
+    then total the costs of the accounts that are now the same account
+    '''
+    costs_df = costs_df.copy()
+    if isinstance(newCodes, dict):
+        codes = costs_df[column].astype(object)
+        newCodes = codes.map(newCodes).fillna(codes)
+    costs_df[column] = newCodes
+    accountColumns = [thisColumn for thisColumn in costs_df.columns if thisColumn != 'cost']
+    return costs_df.groupby(accountColumns, observed=True, sort=False, dropna=False, as_index=False)['cost'].sum()
+
+
+def refreshCostRollups(conn=None):
+    '''
+    Rebuild the materialized cost rollups (service_cost_rollups, inpat_drg_cost_rollups, inpat_specialty_cost_rollups
+    and, if it exists, episode_cost_rollups) for this hospital, model and run from the event_costs table,
+    and record the publication in run_publications (if it exists), in a single transaction.
+    If conn is given then the rollups are refreshed in it's transaction (as part of publishing the run)
+    '''
+    rollups = ['service_cost_rollups', 'inpat_drg_cost_rollups', 'inpat_specialty_cost_rollups']
+    for thisTable in rollups:
+        if thisTable not in d.metadata.tables:
+            logging.warning('No %s table in the database - cost rollups not refreshed', thisTable)
+            return
+    if 'episode_cost_rollups' in d.metadata.tables:     # Databases created before episode cost lookups don't have it
+        rollups.append('episode_cost_rollups')
+    eventCosts = d.metadata.tables['event_costs']
+    inpatEpisodes = d.metadata.tables['inpat_episode_details']
+    thisRun = and_(eventCosts.c.hospital_code == d.hospital_code, eventCosts.c.model_code == d.model_code, eventCosts.c.run_code == d.run_code)
+    accountColumns = [eventCosts.c.department_code, eventCosts.c.cost_type_code, eventCosts.c.event_code]
+    totals = [func.count(eventCosts.c.episode_no.distinct()), func.sum(eventCosts.c.cost)]
+    keyColumns = [eventCosts.c.hospital_code, eventCosts.c.run_code, eventCosts.c.model_code]
+    inpatJoin = eventCosts.join(inpatEpisodes, and_(inpatEpisodes.c.hospital_code == eventCosts.c.hospital_code,
+                                                    inpatEpisodes.c.run_code == eventCosts.c.run_code,
+                                                    inpatEpisodes.c.episode_no == eventCosts.c.episode_no))
+    selects = {}
+    selects['service_cost_rollups'] = select(*keyColumns, eventCosts.c.service_code, *accountColumns, *totals).where(thisRun) \
+        .group_by(*keyColumns, eventCosts.c.service_code, *accountColumns)
+    for thisTable, groupColumn in [('inpat_drg_cost_rollups', 'drg'), ('inpat_specialty_cost_rollups', 'clinical_specialty')]:
+        groupBy = func.coalesce(inpatEpisodes.c[groupColumn], '')
+        selects[thisTable] = select(*keyColumns, groupBy, *accountColumns, *totals).select_from(inpatJoin) \
+            .where(thisRun, eventCosts.c.service_code == 'Inpat').group_by(*keyColumns, groupBy, *accountColumns)
+    episodeColumns = [eventCosts.c.service_code, eventCosts.c.episode_no]
+    selects['episode_cost_rollups'] = select(*keyColumns, *episodeColumns, *accountColumns, func.sum(eventCosts.c.cost)).where(thisRun) \
+        .group_by(*keyColumns, *episodeColumns, *accountColumns)
+    if conn is None:
+        with d.engine.begin() as conn:
+            replaceRollups(conn, rollups, selects)
+    else:
+        replaceRollups(conn, rollups, selects)
+    return
+
+
+def replaceRollups(conn, rollups, selects):
+    '''
+    Replace this hospital, model and run in each rollup table with the rows from it's select,
+    then count the publication in run_publications (if it exists)
+    '''
+    for thisTable in rollups:
+        rollup = d.metadata.tables[thisTable]
+        conn.execute(delete(rollup).where(rollup.c.hospital_code == d.hospital_code, rollup.c.model_code == d.model_code, rollup.c.run_code == d.run_code))
+        conn.execute(insert(rollup).from_select([column.name for column in rollup.columns], selects[thisTable]))
+    if 'run_publications' in d.metadata.tables:
+        publications = d.metadata.tables['run_publications']
+        thisPublication = and_(publications.c.hospital_code == d.hospital_code, publications.c.model_code == d.model_code, publications.c.run_code == d.run_code)
+        published = datetime.datetime.now()
+        if conn.execute(update(publications).where(thisPublication).values(publication_no=publications.c.publication_no + 1, published=published)).rowcount == 0:
+            conn.execute(insert(publications).values(hospital_code=d.hospital_code, run_code=d.run_code, model_code=d.model_code, publication_no=1, published=published))
+    return
+
+
+def partitionName(hospital_code, run_code, model_code):
+    '''
+    Return the name of the partition for this hospital, run and model (a short, valid identifier whatever the codes contain)
+    '''
+    return 'p_' + hashlib.sha1('|'.join([hospital_code, run_code, model_code]).encode('utf-8')).hexdigest()[:20]
+
+
+def addRunPartitions(conn, tables):
+    '''
+    Make sure that each of these run-scoped tables, that was created partitioned by run (createSQLAlchemyDB.py -P),
+    has a partition for this hospital, model and run - adding it's (empty) partition the first time this run is costed.
+    Returns the name of this run's partition in each partitioned table.
+    NOTE: MySQL partition maintenance (ALTER TABLE) implicitly commits any open transaction
+    '''
+    partitions = {}
+    if 'partitioned_tables' not in d.metadata.tables:
+        return partitions
+    partitionedTables = d.metadata.tables['partitioned_tables']
+    partitionMethods = dict(conn.execute(select(partitionedTables.c.table_name, partitionedTables.c.partition_method)).all())
+    runPartitions = d.metadata.tables['run_partitions']
+    for thisTable in tables:
+        if partitionMethods.get(thisTable) != 'list':
+            continue
+        partition = conn.execute(select(runPartitions.c.partition_name).where(runPartitions.c.table_name == thisTable,
+                                                                              runPartitions.c.hospital_code == d.hospital_code,
+                                                                              runPartitions.c.model_code == d.model_code,
+                                                                              runPartitions.c.run_code == d.run_code)).scalar()
+        if partition is None:
+            partition = partitionName(d.hospital_code, d.run_code, d.model_code)
+            partitionValues = ', '.join([sqlLiteral(d.hospital_code), sqlLiteral(d.run_code), sqlLiteral(d.model_code)])
+            conn.execute(text(f'ALTER TABLE {thisTable} ADD PARTITION (PARTITION {partition} VALUES IN (({partitionValues})))'))
+            conn.execute(insert(runPartitions).values(table_name=thisTable, hospital_code=d.hospital_code, run_code=d.run_code,
+                                                      model_code=d.model_code, partition_name=partition))
+            logging.info('Partition %s added to %s', partition, thisTable)
+        partitions[thisTable] = partition
+    return partitions
+
+
+def clearRun(conn, tables, truncate=True):
+    '''
+    Clear this hospital, model and run from these run-scoped tables.
+    Tables created partitioned by run (createSQLAlchemyDB.py -P) have this run's partition truncated
+    (or added, the first time this run is costed) - other tables have this run's rows deleted.
+    If not truncate then existing partitions have their rows deleted, which, unlike a truncate, can be rolled back
+    - call addRunPartitions() first, in it's own transaction, so that no partition needs to be added.
+    NOTE: MySQL partition maintenance (ALTER TABLE) implicitly commits any open transaction
+    '''
+    partitions = addRunPartitions(conn, tables)
+    for thisTable in tables:
+        table = d.metadata.tables[thisTable]
+        if (thisTable in partitions) and truncate:
+            conn.execute(text(f'ALTER TABLE {thisTable} TRUNCATE PARTITION {partitions[thisTable]}'))
+            logging.info('Partition %s of %s truncated', partitions[thisTable], thisTable)
+            continue
+        conn.execute(delete(table).where(table.c.hospital_code == d.hospital_code, table.c.model_code == d.model_code, table.c.run_code == d.run_code))
+    return
+
+
+def stagingTable(thisTable):
+    '''
+    Return the name of the table that a costing stage writes this run-scoped table into
+    - it's staging table, unless the database was created before there were staging tables
+    '''
+    if 'staging_' + thisTable in d.metadata.tables:
+        return 'staging_' + thisTable
+    return thisTable
+
+
+def startStaging(tables):
+    '''
+    Get ready to write this hospital, model and run into these run-scoped tables.
+    Add any missing partitions for this run, to the tables and their staging tables, now
+    - so that publishRun() never has to add one (which, on MySQL, would commit part way through the publish).
+    Clear any rows for this run left in the staging tables by an earlier, failed run (a partition truncate, if the staging tables are partitioned).
+    Tables without a staging table are written directly, so this run is cleared from the table itself.
+    '''
+    staging = [stagingTable(thisTable) for thisTable in tables]
+    with d.engine.begin() as conn:
+        addRunPartitions(conn, tables + staging)
+    with d.engine.begin() as conn:
+        clearRun(conn, staging)
+    return
+
+
+def publishRun(tables, refreshRollups=False):
+    '''
+    Publish this hospital, model and run from the staging tables to these run-scoped tables in a single transaction
+    - delete this run from each table and copy in the staged rows.
+    If refreshRollups then the cost rollups are rebuilt, and the publication counted, in the same transaction.
+    Readers see either the previous run or this run (and it's rollups), never a partly built run.
+    Once the publish has committed, the staged rows are cleared (a partition truncate, if the staging tables are partitioned).
+    Returns the number of rows published.
+    NOTE: this is not a swap - the time taken (and the locks held) grows with the size of the run,
+    and this run's partitions of the tables are cleared with a delete, as a partition truncate would commit part way through the publish.
+    '''
+    rows = 0
+    staged = [thisTable for thisTable in tables if stagingTable(thisTable) != thisTable]
+    with d.engine.begin() as conn:
+        clearRun(conn, staged, truncate=False)
+        for thisTable in staged:
+            table = d.metadata.tables[thisTable]
+            staging = d.metadata.tables[stagingTable(thisTable)]
+            thisRun = and_(staging.c.hospital_code == d.hospital_code, staging.c.model_code == d.model_code, staging.c.run_code == d.run_code)
+            columns = [column.name for column in table.columns]
+            result = conn.execute(insert(table).from_select(columns, select(*[staging.c[column] for column in columns]).where(thisRun)))
+            rows += max(result.rowcount, 0)
+            logging.info('%s published from %s', thisTable, staging.name)
+        if refreshRollups:
+            refreshCostRollups(conn)
+    with d.engine.begin() as conn:
+        clearRun(conn, [stagingTable(thisTable) for thisTable in staged])
+    return rows
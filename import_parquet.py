@@ -0,0 +1,221 @@
+# pylint: disable=line-too-long, broad-exception-caught
+'''
+Script import_parquet.py
+
+A python script to reload the results of an archived clinical costing run (events, event_costs,
+general_ledger_disbursed and general_ledger_undistributed) from a Parquet dataset
+created by export_parquet.py.
+
+    SYNOPSIS:
+    $ python import_parquet.py hospital_code model_code run_code
+        [-I inputDir|--inputDir=inputDir]
+        [-k chunkSize|--chunkSize=chunkSize]
+        [-D DatabaseType|--DatabaseType=DatabaseType]
+        [-C configDir|--configDir=configDir]
+        [-c configFile|--configFile=configFile]
+        [-s server|--server=server]
+        [-u username|--username=username]
+        [-p password|--password=password]
+        [-d databaseName|--databaseName=databaseName]
+        [-v loggingLevel|--verbose=logingLevel]
+        [-L logDir|--logDir=logDir]
+        [-l logfile|--logfile=logfile]
+        [--profile[=mode]]
+        [--traceMemory]
+        [--roundTripThreshold=threshold]
+
+    REQUIRED
+    hospital_code
+    The hospital code for the hospital whose clinical costing run is being reloaded.
+
+    model_code
+    The model code for the clinical costing model that was used for the clinical costing run.
+
+    run_code
+    The run code for the clinical costing run being reloaded.
+
+    -D DatabaseType|--DatabaseType=DatabaseType
+    The type of database [choice:MSSQL/MySQL/SQLite]
+
+
+    OPTIONS
+    -I inputDir|--inputDir=inputDir
+    The directory containing the Parquet dataset (default='parquet')
+
+    -k chunkSize|--chunkSize=chunkSize
+    The number of rows to read from the Parquet files, and append to the database, at a time (default=100000)
+
+    -C configDir|--configDir=configDir
+    The directory containing the database connection configuration file
+    (default='databaseConfig')
+
+    -c configFile|--configFile=configFile
+    The database connection configuration file (default=clinical_costing.json)
+    which has the default database values for each Database Type.
+    These can be overwritten using command line options.
+
+    -s server|--server=server]
+    The address of the database server
+
+    -u userName|--userName=userName]
+    The user name require to access the database
+
+    -p password|--userName=userName]
+    The user password require to access the database
+
+    -d databaseName|--databaseName=databaseName]
+    The name of the database
+
+    -v loggingLevel|--verbose=loggingLevel
+    Set the level of logging that you want.
+
+    -L logDir|--logDir=logDir
+    The directory where the log file will be created (default=".").
+
+    -l logfile|--logfile=logfile
+    The name of a log file where you want all messages captured.
+
+    --profile[=mode]
+    Profile this run [choice:cprofile/sampling] (default=cprofile) and save the pstats file (cprofile only)
+    and a collapsed-stack file (for flame graphs) in logDir, named after the stage, hospital, model and run.
+
+    --traceMemory
+    Trace memory allocations and save a memory report in logDir, with the top allocation sites
+    and the size of each DataFrame at each step of the stage.
+
+    --roundTripThreshold=threshold
+    When the SQL is profiled (INFO or DEBUG logging), report the SQL shapes executed more than threshold times
+    as possible N+1 patterns (default=100).
+
+
+    THE MAIN CODE
+    Start by parsing the command line arguements and setting up logging.
+    Connect to the database and check the hospital_code, model_code and run_code,
+    and that the Parquet files exist for this run.
+    Then, in one transaction, delete any existing results for this run,
+    append the archived results, batch by batch, and rebuild the materialized cost rollups for this run.
+'''
+
+# pylint: disable=invalid-name, bare-except, pointless-string-statement, unspecified-encoding
+
+import os
+import sys
+import argparse
+import logging
+import pandas as pd
+import pyarrow.parquet as pq
+from sqlalchemy import text
+import functions as f
+import parquet_functions as pf
+import data as d
+
+
+if __name__ == '__main__':
+    '''
+    The main code
+    Start by parsing the command line arguements and setting up logging.
+    Then check that the hospital_code, model_code and run_code are valid.
+    Then replace the results for this run with the archived results.
+    '''
+
+    # Save the program name
+    progName = sys.argv[0]
+    progName = progName[0:-3]        # Strip off the .py ending
+
+    # Set the options
+    parser = argparse.ArgumentParser(description='Reload Clinical Costing run results from a partitioned Parquet dataset')
+    parser.add_argument('hospital_code',
+                        help='The hospital code for the hospital whose clinical costing run is being reloaded.')
+    parser.add_argument('model_code',
+                        help='The model code for the clinical costing model that was used for the clinical costing run.')
+    parser.add_argument('run_code',
+                        help='The run code for the clinical costing run being reloaded.')
+    parser.add_argument('-I', '--inputDir', dest='inputDir', default='parquet',
+                        help='The directory containing the Parquet dataset (default=parquet)')
+    parser.add_argument('-k', '--chunkSize', dest='chunkSize', type=int, default=100000,
+                        help='The number of rows to read and append at a time (default=100000)')
+    f.addCommonArguments(parser)      # Add the common command line arguments
+    args = parser.parse_args()
+
+    # Parse the command line options
+    d.hospital_code = args.hospital_code
+    d.model_code = args.model_code
+    d.run_code = args.run_code
+    inputDir = args.inputDir
+    chunkSize = args.chunkSize
+    configDir = args.configDir
+    configFile = args.configFile
+    DatabaseType = args.DatabaseType
+    server = args.server
+    username = args.username
+    password = args.password
+    databaseName = args.databaseName
+    logDir = args.logDir
+    logFile = args.logFile
+    loggingLevel = args.verbose
+
+    # Set up logging
+    f.setupLogging(progName, logDir, logFile, loggingLevel)
+
+    # Read in the configuration file - which must exist if required - and create the database engine
+    f.createEngine(configDir, configFile, DatabaseType, server, username, password, databaseName)
+
+    # Check that the hospital_code is valid
+    hospitals_df = pd.read_sql_query(text('SELECT hospital_code FROM hospitals'), d.engine.connect())
+    hospitals = hospitals_df.values.tolist()      # convert rows/columns to a list of lists (will be [[hospital_code]] )
+    if not [d.hospital_code] in hospitals:
+        logging.critical('hospital code (%s) no in table "hospitals"', d.hospital_code)
+        logging.shutdown()
+        sys.exit(d.EX_CONFIG)
+
+    # Check that the model_code is valid
+    models_df = pd.read_sql_query(text(f'SELECT model_code FROM models WHERE hospital_code = {f.sqlLiteral(d.hospital_code)}'), d.engine.connect())
+    models = models_df.values.tolist()      # convert rows/columns to a list of lists (will be [[model_code]] )
+    if not [d.model_code] in models:
+        logging.critical('model code (%s) no in table "models"', d.model_code)
+        logging.shutdown()
+        sys.exit(d.EX_CONFIG)
+
+    # Check that the run_code is valid
+    selectText = 'SELECT run_code FROM clinical_costing_runs WHERE hospital_code = ' + f.sqlLiteral(d.hospital_code)
+    runs_df = pd.read_sql_query(text(selectText), d.engine.connect())
+    runs = runs_df.values.tolist()      # convert rows/columns to a list of lists (will be [[run_code]] )
+    if not [d.run_code] in runs:
+        logging.critical('run code (%s) no in table "clinical_costing_runs"', d.run_code)
+        logging.shutdown()
+        sys.exit(d.EX_CONFIG)
+
+    # Check that we have the Parquet files for every table
+    parquetFiles = {}
+    for thisTable in pf.resultTables:
+        thisDir = pf.partitionDir(inputDir, thisTable)
+        if not os.path.isdir(thisDir):
+            logging.critical('No Parquet data for table "%s" (missing directory %s)', thisTable, thisDir)
+            logging.shutdown()
+            sys.exit(d.EX_NOINPUT)
+        parquetFiles[thisTable] = sorted([os.path.join(thisDir, thisFile) for thisFile in os.listdir(thisDir) if thisFile.endswith('.parquet')])
+
+    # Add any missing partitions for this run first (on MySQL adding a partition commits)
+    with d.engine.begin() as conn:
+        f.addRunPartitions(conn, pf.resultTables)
+
+    # Replace the results for this run in a single transaction (the run's partitions are cleared with a delete, not truncated,
+    # as a MySQL partition truncate commits, which would leave the run half deleted if the import failed)
+    with d.engine.begin() as conn:
+        f.clearRun(conn, list(reversed(pf.resultTables)), truncate=False)
+        for thisTable in pf.resultTables:
+            rows = 0
+            decimalTypes = pf.decimalTypes(thisTable)
+            for parquetFile in parquetFiles[thisTable]:
+                for batch in pq.ParquetFile(parquetFile).iter_batches(batch_size=chunkSize):
+                    batch_df = pf.fromArrow(batch)
+                    batch_df.to_sql(thisTable, conn, if_exists='append', index=False, dtype=decimalTypes)
+                    rows += len(batch_df.index)
+            logging.info('%d rows reloaded into %s', rows, thisTable)
+            print(f'{thisTable}: {rows} rows')
+
+        # Rebuild the materialized cost rollups from the reloaded event_costs, and count the publication, so cached cost lookups are cleared
+        f.refreshCostRollups(conn)
+
+    logging.shutdown()
+    sys.exit(d.EX_OK)
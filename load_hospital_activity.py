@@ -10,6 +10,8 @@ into the Clinical Costing tables, from an Excel workbook.
     $ python load_hospital_activity.py  
         [-I inputDir|--inputDir=inputDir]
         [-i inputWorkbook|--inputWorkbook=inputWorkbook]  
+        [-k chunkSize|--chunkSize=chunkSize]  
+        [-w workers|--workers=workers]  
         [-C configDir|--configDir=configDir]
         [-c configFile|--configFile=configFile]  
         [-D DatabaseType|--DatabaseType=DatabaseType]  
@@ -20,6 +22,9 @@ into the Clinical Costing tables, from an Excel workbook.
         [-v loggingLevel|--verbose=logingLevel]  
         [-L logDir|--logDir=logDir]
         [-l logfile|--logfile=logfile]
+        [--profile[=mode]]
+        [--traceMemory]
+        [--roundTripThreshold=threshold]
 
     OPTIONS  
     -I inputDir|--inputDir=inputDir  
@@ -29,6 +34,14 @@ into the Clinical Costing tables, from an Excel workbook.
     -i inputWorkbook|--inputWorkbook=inputWorkbook  
     The Excel workbook which contains
     the hospital patient activity data to be loaded.  
+    Or a directory of CSV, gzip compressed CSV or Parquet files, one for each worksheet,
+    named after the worksheet (e.g. 'hospital.csv', 'hospital.csv.gz' or 'hospital.parquet').  
+
+    -k chunkSize|--chunkSize=chunkSize  
+    The number of rows to read from each CSV or Parquet file at a time (default=100000)  
+
+    -w workers|--workers=workers  
+    The number of worker processes that check the worksheets, in parallel, before they are loaded (default=the number of CPUs)  
 
     -C configDir|--configDir=configDir  
     The directory containing the database connection configuration file
@@ -40,7 +53,7 @@ into the Clinical Costing tables, from an Excel workbook.
     These can be overwritten using command line options.
 
     -D DatabaseType|--DatabaseType=DatabaseType  
-    The type of database [choice:MSSQL/MySQL]
+    The type of database [choice:MSSQL/MySQL/SQLite]
 
     -s server|--server=server]  
     The address of the database server
@@ -64,6 +77,18 @@ into the Clinical Costing tables, from an Excel workbook.
     -o logfile|--logfile=logfile  
     The name of a log file where you want all messages captured.
 
+    --profile[=mode]
+    Profile this run [choice:cprofile/sampling] (default=cprofile) and save the pstats file (cprofile only)
+    and a collapsed-stack file (for flame graphs) in logDir, named after the stage, hospital, model and run.
+
+    --traceMemory
+    Trace memory allocations and save a memory report in logDir, with the top allocation sites
+    and the size of each DataFrame at each step of the stage.
+
+    --roundTripThreshold=threshold
+    When the SQL is profiled (INFO or DEBUG logging), report the SQL shapes executed more than threshold times
+    as possible N+1 patterns (default=100).
+
 
     THE MAIN CODE  
     Start by parsing the command line arguements, setting up logging.
@@ -84,8 +109,9 @@ import logging
 import datetime
 import pandas as pd
 from sqlalchemy import text, delete
-from openpyxl import load_workbook
 import functions as f
+import sheet_functions as sf
+import profiling_functions as prf
 import data as d
 
 
@@ -128,6 +154,10 @@ if __name__ == '__main__':
                         help='The directory containing the Excel workbook which contains the hospital patient activity data to be loaded.')
     parser.add_argument('-i', '--inputWorkbook', dest='inputWorkbook',
                         default='.', help='The name of the Excel workbook containing the hospital patient activity data to be loaded')
+    parser.add_argument('-k', '--chunkSize', dest='chunkSize', type=int, default=100000,
+                        help='The number of rows to read from each CSV or Parquet file at a time (default=100000)')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=os.cpu_count(),
+                        help='The number of worker processes that check the worksheets (default=the number of CPUs)')
     f.addCommonArguments(parser)      # Add the common command line arguments
     args = parser.parse_args()
 
@@ -135,6 +165,8 @@ if __name__ == '__main__':
     args = parser.parse_args()
     inputDir = args.inputDir
     inputWorkbook = args.inputWorkbook
+    chunkSize = args.chunkSize
+    workers = args.workers
     configDir = args.configDir
     configFile = args.configFile
     DatabaseType = args.DatabaseType
@@ -152,8 +184,12 @@ if __name__ == '__main__':
     # Read in the configuration file - which must exist if required - and create the database engine
     f.createEngine(configDir, configFile, DatabaseType, server, username, password, databaseName)
 
-    # Load the workbook
-    wb = load_workbook(os.path.join(inputDir, inputWorkbook))
+    # Load the workbook (or open the directory of sheet files)
+    wb = sf.openWorkbook(inputDir, inputWorkbook, chunkSize)
+    prf.memorySnapshot('workbook loaded')
+
+    # Start checking the worksheets of every tier in parallel (they are loaded, in tier order, as each check is collected)
+    sf.startChecks(wb, requiredSheets, ['hospital_code', 'run_code'], workers)
 
     # Check the 'hospital' worksheet
     table_df = f.checkWorksheet(wb, 'hospital', 'hospitals', [])
@@ -190,7 +226,7 @@ if __name__ == '__main__':
         table_df.to_sql('clinical_costing_runs', d.engine, if_exists='append', index=False)
     else:       # Check that this is the same run
         runs_df = pd.read_sql_query(text('SELECT * FROM clinical_costing_runs'), d.engine.connect())
-        thisRun_df = runs_df[runs_df['run_code'] == d.run_code]
+        thisRun_df = runs_df[runs_df['run_code'] == d.run_code].reset_index(drop=True)
         run_description = ws['B2'].value
         start_date = ws['C2'].value
         if isinstance(start_date, datetime.datetime):
@@ -202,17 +238,17 @@ if __name__ == '__main__':
             logging.critical('run_description differs in "clinical_costings_runs" table (%s) and "runs" worksheet (%s)', thisRun_df['run_description'][0], run_description)
             logging.shutdown()
             sys.exit(d.EX_CONFIG)
-        if start_date != thisRun_df['start_date'][0]:
+        if start_date != pd.to_datetime(thisRun_df['start_date'][0]).date():      # Some databases (SQLite) return dates as strings
             logging.critical('start_date differs in "clinical_costings_runs" table (%s) and "runs" worksheet (%s)', thisRun_df['start_date'][0], start_date)
             logging.shutdown()
             sys.exit(d.EX_CONFIG)
-        if end_date != thisRun_df['end_date'][0]:
+        if end_date != pd.to_datetime(thisRun_df['end_date'][0]).date():      # Some databases (SQLite) return dates as strings
             logging.critical('end_date differs in "clinical_costings_runs" table (%s) and "runs" worksheet (%s)', thisRun_df['end_date'][0], end_date)
             logging.shutdown()
             sys.exit(d.EX_CONFIG)
 
     # Create the general "where" clause
-    where = 'hospital_code = "' + d.hospital_code + '" AND run_code = "' + d.run_code + '"'
+    where = 'hospital_code = ' + f.sqlLiteral(d.hospital_code) + ' AND run_code = ' + f.sqlLiteral(d.run_code)
 
     # Check if we are replacing an old run
     if not newRun:
@@ -234,6 +270,7 @@ if __name__ == '__main__':
 
             # Append the data to the itemized_costs table
             f.addTableData(table_df, table)
+            prf.memorySnapshot(f'worksheet {sheet} added')
 
     logging.shutdown()
     sys.exit(d.EX_OK)
@@ -16,6 +16,7 @@ as itemized costs refer to episodes of activity.
         [-c configFile|--configFile=configFile]
         [-I inputDir|--inputDir=inputDir]
         [-i inputWorkbook|--inputWorkbook=inputWorkbook]
+        [-k chunkSize|--chunkSize=chunkSize]
         [-s server|--server=server]
         [-u username|--username=username]
         [-p password|--password=password]
@@ -23,10 +24,13 @@ as itemized costs refer to episodes of activity.
         [-v loggingLevel|--verbose=logingLevel]
         [-L logDir|--logDir=logDir]
         [-l logfile|--logfile=logfile]
+        [--profile[=mode]]
+        [--traceMemory]
+        [--roundTripThreshold=threshold]
 
     REQUIRED
     -D DatabaseType|--DatabaseType=DatabaseType
-    The type of database [choice:MSSQL/MySQL]
+    The type of database [choice:MSSQL/MySQL/SQLite]
 
 
     OPTIONS
@@ -45,6 +49,11 @@ as itemized costs refer to episodes of activity.
 
     -i inputWorkbook|--inputWorkbook=inputWorkbook
     The Excel workbook containing the hospital patient activity data to be loaded.
+    Or a directory of CSV, gzip compressed CSV or Parquet files, one for each worksheet,
+    named after the worksheet (e.g. 'hospital.csv', 'hospital.csv.gz' or 'hospital.parquet').
+
+    -k chunkSize|--chunkSize=chunkSize
+    The number of rows to read from each CSV or Parquet file at a time (default=100000)
 
     -s server|--server=server]
     The address of the database server
@@ -67,6 +76,18 @@ as itemized costs refer to episodes of activity.
     -o logfile|--logfile=logfile
     The name of a log file where you want all messages captured.
 
+    --profile[=mode]
+    Profile this run [choice:cprofile/sampling] (default=cprofile) and save the pstats file (cprofile only)
+    and a collapsed-stack file (for flame graphs) in logDir, named after the stage, hospital, model and run.
+
+    --traceMemory
+    Trace memory allocations and save a memory report in logDir, with the top allocation sites
+    and the size of each DataFrame at each step of the stage.
+
+    --roundTripThreshold=threshold
+    When the SQL is profiled (INFO or DEBUG logging), report the SQL shapes executed more than threshold times
+    as possible N+1 patterns (default=100).
+
 
     THE MAIN CODE
     Start by parsing the command line arguements, setting up logging
@@ -84,15 +105,15 @@ as itemized costs refer to episodes of activity.
 
 # pylint: disable=invalid-name, bare-except, pointless-string-statement, unspecified-encoding
 
-import os
 import sys
 import argparse
 import logging
 import datetime
 import pandas as pd
-from sqlalchemy import text, select, delete
-from openpyxl import load_workbook
+from sqlalchemy import text, delete
 import functions as f
+import sheet_functions as sf
+import profiling_functions as prf
 import data as d
 
 
@@ -122,6 +143,8 @@ if __name__ == '__main__':
                         help='The directory containing the Excel workbook which contains the hospital patient activity data to be loaded.')
     parser.add_argument('-i', '--inputWorkbook', dest='inputWorkbook',
                         default='.', help='The name of the Excel workbook containing the hospital patient activity data to be loaded')
+    parser.add_argument('-k', '--chunkSize', dest='chunkSize', type=int, default=100000,
+                        help='The number of rows to read from each CSV or Parquet file at a time (default=100000)')
     f.addCommonArguments(parser)      # Add the common command line arguments
     args = parser.parse_args()
 
@@ -129,6 +152,7 @@ if __name__ == '__main__':
     args = parser.parse_args()
     inputDir = args.inputDir
     inputWorkbook = args.inputWorkbook
+    chunkSize = args.chunkSize
     configDir = args.configDir
     configFile = args.configFile
     DatabaseType = args.DatabaseType
@@ -146,8 +170,9 @@ if __name__ == '__main__':
     # Read in the configuration file - which must exist if required - and create the database engine
     f.createEngine(configDir, configFile, DatabaseType, server, username, password, databaseName)
 
-    # Load the workbook
-    wb = load_workbook(os.path.join(inputDir, inputWorkbook))
+    # Load the workbook (or open the directory of sheet files)
+    wb = sf.openWorkbook(inputDir, inputWorkbook, chunkSize)
+    prf.memorySnapshot('workbook loaded')
 
     # Check the 'hospital' worksheet
     table_df = f.checkWorksheet(wb, 'hospital', 'hospitals', [])
@@ -172,7 +197,7 @@ if __name__ == '__main__':
     d.run_code = ws['A2'].value        # First (and only) run_code in the list
 
     # Create the general "where" clause
-    where = 'hospital_code = "' + d.hospital_code + '" AND run_code = "' + d.run_code + '"'
+    where = 'hospital_code = ' + f.sqlLiteral(d.hospital_code) + ' AND run_code = ' + f.sqlLiteral(d.run_code)
 
     # Check that we have an 'itemized costs' worksheet
     if 'itemized costs' not in wb:
@@ -193,38 +218,32 @@ if __name__ == '__main__':
         logging.critical('Missing "feeder_code" heading in "itemized costs" worksheet')
         logging.shutdown()
         sys.exit(d.EX_CONFIG)
+
+    # Fetch the episode numbers for each service for this run, once, to check the itemized costs against
+    episodeTables = {'Inpat': 'inpat_episode_details', 'Clinic': 'clinic_activity_details', 'ED': 'ed_episode_details'}
+    episodes = []
+    for service_code, table in episodeTables.items():
+        selectText = f'SELECT DISTINCT {f.sqlLiteral(service_code)} AS service_code, episode_no FROM {table} WHERE ' + where
+        episodes.append(pd.read_sql_query(text(selectText), d.engine.connect()))
+    knownEpisodes = pd.MultiIndex.from_frame(pd.concat(episodes, ignore_index=True))
     sheet_table_df = {}
     for sheet in itemized_costs_df['worksheet']:
         sheet_table_df[sheet] = f.checkWorksheet(wb, sheet, 'itemized_costs', ['hospital_code', 'run_code', 'feeder_code'])
-        # Now check that the episode numbers are valid
-        for row in sheet_table_df[sheet].itertuples(index=False):
-            service_code = getattr(row, 'service_code')
-            episode_no = getattr(row, 'episode_no')
-            thisWhere = where + ' AND episode_no = "' + str(episode_no) + '"'
-            found = True
-            if service_code == 'Inpat':
-                with d.Session() as session:
-                    results = session.scalars(select(d.metadata.tables['inpat_episode_details']).where(text(thisWhere))).all()
-                    if len(results) == 0:
-                        found = False
-            elif service_code == 'Clinic':
-                with d.Session() as session:
-                    results = session.scalars(select(d.metadata.tables['clinic_activity_details']).where(text(thisWhere))).all()
-                    if len(results) == 0:
-                        found = False
-            elif service_code == 'ED':
-                with d.Session() as session:
-                    results = session.scalars(select(d.metadata.tables['ed_episode_details']).where(text(thisWhere))).all()
-                    if len(results) == 0:
-                        found = False
-            else:
-                logging.critical('Invalid service_code (%s) in "itemized costs" worksheet(%s)', service_code, sheet)
-                logging.shutdown()
-                sys.exit(d.EX_CONFIG)
-            if not found:
-                logging.critical('Invalid episode_no (%s) for service (%s) in item costs worksheet (%s)', episode_no, service_code, sheet)
-                logging.shutdown()
-                sys.exit(d.EX_CONFIG)
+        # Now check that the service codes and episode numbers are valid
+        items_df = sheet_table_df[sheet][['service_code', 'episode_no']]
+        invalidServices = items_df.loc[~items_df['service_code'].isin(list(episodeTables)), 'service_code']
+        if len(invalidServices.index) > 0:
+            logging.critical('Invalid service_code (%s) in "itemized costs" worksheet(%s)', invalidServices.iloc[0], sheet)
+            logging.shutdown()
+            sys.exit(d.EX_CONFIG)
+        missing_df = items_df[~pd.MultiIndex.from_frame(items_df).isin(knownEpisodes)].drop_duplicates()
+        if len(missing_df.index) > 0:
+            for row in missing_df.itertuples(index=False):
+                logging.critical('Invalid episode_no (%s) for service (%s) in item costs worksheet (%s)', row.episode_no, row.service_code, sheet)
+            logging.critical('%d invalid (service_code, episode_no) pairs in item costs worksheet (%s)', len(missing_df.index), sheet)
+            logging.shutdown()
+            sys.exit(d.EX_CONFIG)
+        prf.memorySnapshot(f'itemized costs worksheet {sheet} checked')
 
     # Check the 'general ledger run adjustments' worksheet
     costAdjustments_df = f.checkWorksheet(wb, 'general ledger run adjustments', 'general_ledger_run_adjustments', ['hospital_code', 'run_code'])
@@ -239,6 +258,7 @@ if __name__ == '__main__':
 
     # Check the 'general ledger costs' worksheet
     general_ledger_table_df = f.checkWorksheet(wb, 'general ledger costs', 'general_ledger_costs', ['hospital_code', 'run_code'])
+    prf.memorySnapshot('worksheets checked')
 
     # If this is a new run_code then add it to the table
     run_df = run_df.truncate(after=0)       # We only want the first row
@@ -248,7 +268,7 @@ if __name__ == '__main__':
         run_df.to_sql('clinical_costing_runs', d.engine, if_exists='append', index=False)
     else:       # Check that this is the same run
         runs_df = pd.read_sql_query(text('SELECT * FROM clinical_costing_runs'), d.engine.connect())
-        thisRun_df = runs_df[runs_df['run_code'] == d.run_code]
+        thisRun_df = runs_df[runs_df['run_code'] == d.run_code].reset_index(drop=True)
         ws = wb['run']
         run_description = ws['B2'].value
         start_date = ws['C2'].value
@@ -261,11 +281,11 @@ if __name__ == '__main__':
             logging.critical('"run_description" differs between "runs" worksheet[%s] and  "clinical_costings_runs" table[%s]', run_description, thisRun_df['run_description'][0])
             logging.shutdown()
             sys.exit(d.EX_CONFIG)
-        if start_date != thisRun_df['start_date'][0]:
+        if start_date != pd.to_datetime(thisRun_df['start_date'][0]).date():      # Some databases (SQLite) return dates as strings
             logging.critical('"start_date" differs between "runs" worksheet[%s] and "clinical_costings_runs" table[%s]', start_date, thisRun_df['start_date'][0])
             logging.shutdown()
             sys.exit(d.EX_CONFIG)
-        if end_date != thisRun_df['end_date'][0]:
+        if end_date != pd.to_datetime(thisRun_df['end_date'][0]).date():      # Some databases (SQLite) return dates as strings
             logging.critical('"end_date" differs between "runs" worksheet[%s] and "clinical_costings_runs" table[%s]', end_date, thisRun_df['end_date'][0])
             logging.shutdown()
             sys.exit(d.EX_CONFIG)
@@ -300,6 +320,7 @@ if __name__ == '__main__':
 
         # Append the data to the itemized_costs table
         f.addTableData(table_df, 'itemized_costs')
+        prf.memorySnapshot(f'itemized costs worksheet {sheet} added')
 
     # Add any general ledger run adjustments
     # Prepend the hospital_code and run code
@@ -13,6 +13,8 @@ into the Clinical Costing tables, from an Excel workbook
         [-c configFile|--configFile=configFile]
         [-I inputDir|--inputDir=inputDir]
         [-i inputWorkbook|--inputWorkbook=inputWorkbook]
+        [-k chunkSize|--chunkSize=chunkSize]
+        [-w workers|--workers=workers]
         [-s server|--server=server]
         [-u username|--username=username]
         [-p password|--password=password]
@@ -20,11 +22,14 @@ into the Clinical Costing tables, from an Excel workbook
         [-v loggingLevel|--verbose=logingLevel]
         [-L logDir|--logDir=logDir]
         [-l logfile|--logfile=logfile]
+        [--profile[=mode]]
+        [--traceMemory]
+        [--roundTripThreshold=threshold]
 <br/>
 
     REQUIRED
     -D DatabaseType|--DatabaseType=DatabaseType
-    The type of database [choice:MSSQL/MySQL]
+    The type of database [choice:MSSQL/MySQL/SQLite]
 
 
     OPTIONS
@@ -44,6 +49,14 @@ into the Clinical Costing tables, from an Excel workbook
     -i inputWorkbook|--inputWorkbook=inputWorkbook
     The Excel workbook containing the clinical costing model configuration data
     to be loaded for this hospital.
+    Or a directory of CSV, gzip compressed CSV or Parquet files, one for each worksheet,
+    named after the worksheet (e.g. 'hospital.csv', 'hospital.csv.gz' or 'hospital.parquet').
+
+    -k chunkSize|--chunkSize=chunkSize
+    The number of rows to read from each CSV or Parquet file at a time (default=100000)
+
+    -w workers|--workers=workers
+    The number of worker processes that check the worksheets, in parallel, before they are loaded (default=the number of CPUs)
 
     -s server|--server=server]
     The address of the database server
@@ -66,6 +79,18 @@ into the Clinical Costing tables, from an Excel workbook
     -o logfile|--logfile=logfile
     The name of a log file where you want all messages captured.
 
+    --profile[=mode]
+    Profile this run [choice:cprofile/sampling] (default=cprofile) and save the pstats file (cprofile only)
+    and a collapsed-stack file (for flame graphs) in logDir, named after the stage, hospital, model and run.
+
+    --traceMemory
+    Trace memory allocations and save a memory report in logDir, with the top allocation sites
+    and the size of each DataFrame at each step of the stage.
+
+    --roundTripThreshold=threshold
+    When the SQL is profiled (INFO or DEBUG logging), report the SQL shapes executed more than threshold times
+    as possible N+1 patterns (default=100).
+
 
     THE MAIN CODE
     Start by parsing the command line arguements and setting up logging.
@@ -85,8 +110,8 @@ import argparse
 import logging
 import pandas as pd
 from sqlalchemy import text
-from openpyxl import load_workbook
 import functions as f
+import sheet_functions as sf
 import data as d
 
 
@@ -139,6 +164,10 @@ if __name__ == '__main__':
                         help='The directory containing the Excel workbook containing the clinical costing model to be loaded.')
     parser.add_argument('-i', '--inputWorkbook', dest='inputWorkbook',
                         default='.', help='The Excel workbook containing the clinical costing model configuration data to be loaded for this hospital.')
+    parser.add_argument('-k', '--chunkSize', dest='chunkSize', type=int, default=100000,
+                        help='The number of rows to read from each CSV or Parquet file at a time (default=100000)')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=os.cpu_count(),
+                        help='The number of worker processes that check the worksheets (default=the number of CPUs)')
     f.addCommonArguments(parser)      # Add the common command line arguments
     args = parser.parse_args()
 
@@ -146,6 +175,8 @@ if __name__ == '__main__':
     args = parser.parse_args()
     inputDir = args.inputDir
     inputWorkbook = args.inputWorkbook
+    chunkSize = args.chunkSize
+    workers = args.workers
     configDir = args.configDir
     configFile = args.configFile
     DatabaseType = args.DatabaseType
@@ -164,8 +195,11 @@ if __name__ == '__main__':
     # Read in the configuration file - which must exist if required - and create the database engine
     f.createEngine(configDir, configFile, DatabaseType, server, username, password, databaseName)
 
-    # Load the workbook
-    wb = load_workbook(os.path.join(inputDir, inputWorkbook))
+    # Load the workbook (or open the directory of sheet files)
+    wb = sf.openWorkbook(inputDir, inputWorkbook, chunkSize)
+
+    # Start checking the worksheets of every tier in parallel (they are loaded, in tier order, as each check is collected)
+    sf.startChecks(wb, requiredSheets, ['hospital_code', 'model_code'], workers)
 
     # Check the 'hospital' worksheet
     table_df = f.checkWorksheet(wb, 'hospital', 'hospitals', [])
@@ -192,7 +226,7 @@ if __name__ == '__main__':
     d.model_code = ws['A2'].value        # First (and only) model_code in the list
 
     # Check if this is a new model code, or upgraded configuration of an existing model
-    models_df = pd.read_sql_query(text(f'SELECT model_code FROM models WHERE hospital_code = "{d.hospital_code}"'), d.engine.connect())
+    models_df = pd.read_sql_query(text(f'SELECT model_code FROM models WHERE hospital_code = {f.sqlLiteral(d.hospital_code)}'), d.engine.connect())
     models = models_df.values.tolist()      # convert rows/columns to a list of lists (will be [[model_code]] )
     newModel = not [d.model_code] in models
 
@@ -217,7 +251,7 @@ if __name__ == '__main__':
 
     # Now use the hospital's feeder configuration data
     # to add codes to event_class_codes, event_attribute_code, distribution_codes and event_codes
-    feeders_df = pd.read_sql_query(text('SELECT * FROM feeders WHERE hospital_code = "' + d.hospital_code + '"'), d.engine.connect())
+    feeders_df = pd.read_sql_query(text('SELECT * FROM feeders WHERE hospital_code = ' + f.sqlLiteral(d.hospital_code)), d.engine.connect())
     event_class_codes_df = feeders_df[['hospital_code', 'event_class_code', 'event_class_seq', 'feeder_description']]
     event_class_codes_df = event_class_codes_df.rename(columns={'feeder_description': 'event_class_description'})
     event_class_codes_df.insert(1, 'model_code', d.model_code)
@@ -0,0 +1,137 @@
+'''
+The episode and DRG cost lookup functions for the Clinical Costing system.
+
+A CostLookup answers the costed breakdown (by department, cost type and event code) of an episode, or of a DRG,
+for d.hospital_code, d.model_code and d.run_code. Episodes are looked up in episode_cost_rollups and DRGs in inpat_drg_cost_rollups,
+both of which are keyed (primary key) on the hospital, run, model and episode or DRG, so each lookup is a single index range read.
+Databases created before episode_cost_rollups existed are looked up in event_costs (see the event_costs 'episode' index).
+
+The breakdowns are held in an LRU cache. distribute_costs.py and import_parquet.py count each publication of a run in run_publications
+(keyed on the hospital, run and model), and the breakdowns are cached by publication number, so a breakdown read before the run
+was republished is never returned after it (the publication number is checked, at most, once every checkInterval seconds).
+The cache is also cleared when the run is republished, to free the breakdowns of the earlier publication.
+'''
+
+# pylint: disable=invalid-name, line-too-long
+
+import time
+import logging
+import threading
+import functools
+from sqlalchemy import text
+import functions as f
+import data as d
+
+
+class CostLookup:
+    '''
+    The cached episode and DRG cost lookups for a hospital, model and run
+    '''
+    def __init__(self, cacheSize=4096, checkInterval=1.0):
+        self.where = 'hospital_code = ' + f.sqlLiteral(d.hospital_code) + ' AND model_code = ' + f.sqlLiteral(d.model_code) + ' AND run_code = ' + f.sqlLiteral(d.run_code)
+        if 'episode_cost_rollups' in d.metadata.tables:
+            self.episodeTable = 'episode_cost_rollups'
+        else:
+            logging.warning('No episode_cost_rollups table in the database - episodes will be looked up in event_costs')
+            self.episodeTable = 'event_costs'
+        self.checkInterval = checkInterval
+        self.checkLock = threading.Lock()
+        self.lastCheck = time.monotonic()
+        self.publication = self.readPublication()
+        self.invalidations = 0
+        self.cachedEpisode = functools.lru_cache(maxsize=cacheSize)(self.readEpisode)
+        self.cachedDrg = functools.lru_cache(maxsize=cacheSize)(self.readDrg)
+
+    def readPublication(self):
+        '''
+        Return the publication number of this run (None if it has never been published, or there is no run_publications table)
+        '''
+        if 'run_publications' not in d.metadata.tables:
+            return None
+        with d.engine.connect() as conn:
+            return conn.execute(text('SELECT publication_no FROM run_publications WHERE ' + self.where)).scalar()
+
+    def checkPublication(self):
+        '''
+        Return the publication number of this run, clearing the cache if this run has been republished (checking at most once every checkInterval seconds)
+        '''
+        now = time.monotonic()
+        if now - self.lastCheck < self.checkInterval:
+            return self.publication
+        with self.checkLock:
+            if now - self.lastCheck < self.checkInterval:      # Another thread has just checked
+                return self.publication
+            publication = self.readPublication()
+            if publication != self.publication:
+                logging.info('Run republished (publication %s, was %s) - cost lookup cache cleared', publication, self.publication)
+                self.cachedEpisode.cache_clear()
+                self.cachedDrg.cache_clear()
+                self.publication = publication
+                self.invalidations += 1
+            self.lastCheck = time.monotonic()
+            return publication
+
+    def readEpisode(self, publication, service_code, episode_no):      # pylint: disable=unused-argument
+        '''
+        Read the costs of an episode by department, cost type and event code (publication is only part of the cache key)
+        '''
+        selectText = 'SELECT department_code, cost_type_code, event_code, SUM(cost) AS cost FROM ' + self.episodeTable + ' WHERE ' + self.where
+        selectText += ' AND service_code = ' + f.sqlLiteral(service_code) + ' AND episode_no = ' + str(int(episode_no))
+        selectText += ' GROUP BY department_code, cost_type_code, event_code ORDER BY department_code, cost_type_code, event_code'
+        with d.engine.connect() as conn:
+            return tuple((row.department_code, row.cost_type_code, row.event_code, float(row.cost or 0.0)) for row in conn.execute(text(selectText)))
+
+    def readDrg(self, publication, drg):      # pylint: disable=unused-argument
+        '''
+        Read the costs of a DRG by department, cost type and event code (publication is only part of the cache key)
+        '''
+        selectText = 'SELECT department_code, cost_type_code, event_code, episodes, cost FROM inpat_drg_cost_rollups WHERE ' + self.where
+        selectText += ' AND drg = ' + f.sqlLiteral(drg) + ' ORDER BY department_code, cost_type_code, event_code'
+        with d.engine.connect() as conn:
+            return tuple((row.department_code, row.cost_type_code, row.event_code, int(row.episodes), float(row.cost or 0.0)) for row in conn.execute(text(selectText)))
+
+    def episode(self, service_code, episode_no):
+        '''
+        Return the costed breakdown of an episode (None if the episode has no costs in this run)
+        '''
+        breakdown = self.cachedEpisode(self.checkPublication(), service_code, int(episode_no))
+        if not breakdown:
+            return None
+        return {'service_code': service_code, 'episode_no': int(episode_no), 'cost': round(sum(row[3] for row in breakdown), 5),
+                'breakdown': [dict(zip(['department_code', 'cost_type_code', 'event_code', 'cost'], row)) for row in breakdown]}
+
+    def drg(self, drg):
+        '''
+        Return the costed breakdown of a DRG (None if the DRG has no costs in this run)
+        '''
+        breakdown = self.cachedDrg(self.checkPublication(), drg)
+        if not breakdown:
+            return None
+        return {'drg': drg, 'cost': round(sum(row[4] for row in breakdown), 5),
+                'breakdown': [dict(zip(['department_code', 'cost_type_code', 'event_code', 'episodes', 'cost'], row)) for row in breakdown]}
+
+    def episodes(self):
+        '''
+        Return the service code and episode number of every costed episode in this run (not cached)
+        '''
+        selectText = 'SELECT DISTINCT service_code, episode_no FROM ' + self.episodeTable + ' WHERE ' + self.where + ' ORDER BY service_code, episode_no'
+        with d.engine.connect() as conn:
+            return [[row.service_code, row.episode_no] for row in conn.execute(text(selectText))]
+
+    def drgs(self):
+        '''
+        Return every costed DRG in this run (not cached)
+        '''
+        selectText = 'SELECT DISTINCT drg FROM inpat_drg_cost_rollups WHERE ' + self.where + ' ORDER BY drg'
+        with d.engine.connect() as conn:
+            return [row.drg for row in conn.execute(text(selectText))]
+
+    def stats(self):
+        '''
+        Return the cache statistics
+        '''
+        stats = {'publication_no': self.publication, 'invalidations': self.invalidations}
+        for name, cache in [('episode', self.cachedEpisode), ('drg', self.cachedDrg)]:
+            info = cache.cache_info()
+            stats[name] = {'hits': info.hits, 'misses': info.misses, 'size': info.currsize, 'maxsize': info.maxsize}
+        return stats
@@ -0,0 +1,105 @@
+'''
+The Parquet archive functions for the Clinical Costing system.
+'''
+
+# pylint: disable=invalid-name, line-too-long, broad-exception-caught
+
+import os
+import datetime
+import decimal
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import data as d
+
+# The run result tables that are archived
+resultTables = ['events', 'event_costs', 'general_ledger_disbursed', 'general_ledger_undistributed']
+
+# The partitioning columns - these are in the directory names (hive style), not in the Parquet files
+partitionColumns = ['hospital_code', 'model_code', 'run_code']
+
+
+def partitionDir(baseDir, table):
+    '''
+    Return the directory for this hospital/model/run partition of table
+    '''
+    return os.path.join(baseDir, table, f'hospital_code={d.hospital_code}', f'model_code={d.model_code}', f'run_code={d.run_code}')
+
+
+def isCodeColumn(column):
+    '''
+    Code columns have a small number of distinct values, so they are dictionary encoded
+    '''
+    return column.name.endswith('_code') or (column.name in ['event_what'])
+
+
+def arrowSchema(table):
+    '''
+    Return the Arrow schema, for the Parquet files, for a clinical costing database table (less the partitioning columns)
+    '''
+    fields = []
+    for column in d.metadata.tables[table].columns:
+        if column.name in partitionColumns:
+            continue
+        pythonType = column.type.python_type
+        if pythonType == int:
+            arrowType = pa.int64()
+        elif pythonType == decimal.Decimal:         # Numeric(15,5) costs are archived as exact decimals
+            arrowType = pa.decimal128(column.type.precision or 15, column.type.scale or 5)
+        elif pythonType == float:
+            arrowType = pa.float64()
+        elif pythonType == datetime.datetime:
+            arrowType = pa.timestamp('us')
+        elif pythonType == datetime.date:
+            arrowType = pa.date32()
+        elif pythonType == bool:
+            arrowType = pa.bool_()
+        elif isCodeColumn(column):
+            arrowType = pa.dictionary(pa.int32(), pa.string())
+        else:
+            arrowType = pa.string()
+        fields.append(pa.field(column.name, arrowType, nullable=not column.primary_key))
+    return pa.schema(fields)
+
+
+def toArrow(chunk_df, schema):
+    '''
+    Convert a chunk of rows, read from the database, to an Arrow table
+    '''
+    chunk_df = chunk_df.drop(columns=[column for column in partitionColumns if column in chunk_df.columns])
+    decimals = {}
+    for field in schema:
+        if pa.types.is_floating(field.type):            # Some databases return Numeric columns as Decimal
+            chunk_df[field.name] = chunk_df[field.name].astype(float)
+        elif pa.types.is_decimal(field.type):           # Some databases (SQLite) return Numeric columns as float
+            # Rounding to the column's scale recovers the exact decimal, as a Numeric(15,5) value has no more significant digits than a float holds
+            decimals[field.name] = pc.round(pa.array(pd.to_numeric(chunk_df[field.name]).astype('float64')), field.type.scale).cast(field.type)
+            chunk_df[field.name] = None
+        elif pa.types.is_date32(field.type):            # Some databases (SQLite) return dates as strings
+            chunk_df[field.name] = pd.to_datetime(chunk_df[field.name]).dt.date
+    table = pa.Table.from_pandas(chunk_df, schema=schema, preserve_index=False)
+    for name, values in decimals.items():
+        table = table.set_column(schema.get_field_index(name), schema.field(name), values)
+    return table
+
+
+def fromArrow(batch):
+    '''
+    Convert a batch of rows, read from a Parquet file, to a dataframe that can be appended to the database table
+    '''
+    batch_df = batch.to_pandas()
+    for column in batch_df.columns:
+        if isinstance(batch_df[column].dtype, pd.CategoricalDtype):       # Dictionary encoded codes
+            batch_df[column] = batch_df[column].astype(object)
+    batch_df.insert(0, 'hospital_code', d.hospital_code)
+    batch_df.insert(1, 'run_code', d.run_code)
+    batch_df.insert(2, 'model_code', d.model_code)
+    return batch_df
+
+
+def decimalTypes(table):
+    '''
+    Return the database type of each Numeric column of table, so that the decimals read from a Parquet file
+    are bound as Numeric values (which converts them for databases, such as SQLite, that have no decimal type)
+    '''
+    return {column.name: column.type for column in d.metadata.tables[table].columns if column.type.python_type == decimal.Decimal}
@@ -0,0 +1,268 @@
+'''
+The profiling functions for the Clinical Costing system.
+
+The --profile option (added by functions.addCommonArguments) runs any script under a profiler.
+Profiling starts as soon as the command line is parsed and stops when the program exits,
+when the pstats file and a collapsed-stack file (for flame graph tools such as flamegraph.pl or speedscope)
+are written to the logging directory, labelled with the stage, hospital, model and run.
+The 'cprofile' mode is deterministic (every function call is timed), and writes both files.
+The 'sampling' mode only samples the stack of the main thread, which has much less overhead, and writes only the collapsed-stack file.
+
+The --traceMemory option (also added by functions.addCommonArguments) traces memory allocations with tracemalloc.
+memorySnapshot() is called at each stage step boundary (telemetry_functions.endStep) and at key points in the loaders.
+Each snapshot records the current and peak traced memory since the last snapshot, the top allocation sites
+and the footprint (memory_usage(deep=True)) of every DataFrame in the script (glCosts_df, events_df, attributes_df etc.).
+The snapshots are written to a memory report in the logging directory when the program exits.
+
+The SQL profiler is switched on by the -v flags (INFO or DEBUG logging).
+It counts and times every statement sent to the database, grouped by the shape of the SQL
+(the SQL with the literals and parameter lists removed), and reports the top shapes when the program exits.
+Shapes executed more than d.roundTripThreshold times (--roundTripThreshold, also added by functions.addCommonArguments)
+are flagged as possible N+1 patterns (a query or insert inside a loop that should have been a single set based statement).
+'''
+
+# pylint: disable=invalid-name, line-too-long, global-statement
+
+import os
+import re
+import sys
+import time
+import atexit
+import logging
+import argparse
+import threading
+import cProfile
+import tracemalloc
+import pandas as pd
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import data as d
+
+profiler = None     # The cProfile profiler
+sampler = None      # The stack sampling thread
+samples = {}        # key=collapsed stack, value=count of samples
+samplingInterval = 0.005    # Seconds between stack samples
+memoryNamespace = None  # The parsed command line (for logDir) if memory tracing
+memorySnapshots = []    # The memory report lines
+sqlShapes = {}      # key=normalized SQL, value=dict(statements, rows, seconds)
+sqlProfiling = False
+
+stringLiteral = re.compile(r"'(?:[^']|'')*'")
+numberLiteral = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])')
+namedParameter = re.compile(r'%\(\w+\)s|%s|(?<![:\w]):\w+')
+parameterList = re.compile(r'\?(?:\s*,\s*\?)+')
+valuesList = re.compile(r'(VALUES\s*\(\?\))(?:\s*,\s*\(\?\))+', re.IGNORECASE)
+whiteSpace = re.compile(r'\s+')
+
+
+class ProfileAction(argparse.Action):
+    '''
+    The --profile command line option - start profiling as soon as the option is parsed
+    '''
+    def __call__(self, parser, namespace, values, option_string=None):
+        setattr(namespace, self.dest, values)
+        startProfile(values, namespace)
+
+
+def sampleStacks(mainThreadId, stopSampling):
+    '''
+    Sample the stack of the main thread until told to stop
+    '''
+    while not stopSampling.wait(samplingInterval):
+        frame = sys._current_frames().get(mainThreadId)     # pylint: disable=protected-access
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+        if stack:
+            collapsed = ';'.join(reversed(stack))
+            samples[collapsed] = samples.get(collapsed, 0) + 1
+
+
+def startProfile(mode, namespace):
+    '''
+    Start the profiler and the stack sampler, and arrange for the profiles to be saved when the program exits
+    '''
+    global profiler, sampler
+    if sampler is not None:     # Already started (the command line can be parsed more than once)
+        return
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+    stopSampling = threading.Event()
+    sampler = threading.Thread(target=sampleStacks, args=(threading.main_thread().ident, stopSampling), daemon=True)
+    sampler.start()
+    atexit.register(saveProfile, namespace, stopSampling)
+    return
+
+
+def profileName(namespace):
+    '''
+    Return the base name for the profile files - the stage, hospital, model and run, in logDir
+    '''
+    label = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    for code in [d.hospital_code, d.model_code, d.run_code]:
+        if code is not None:
+            label += '_' + re.sub(r'[^\w.-]', '_', str(code))
+    return os.path.join(getattr(namespace, 'logDir', None) or '.', label)
+
+
+def saveProfile(namespace, stopSampling):
+    '''
+    Stop profiling and write the pstats and collapsed-stack files
+    '''
+    if profiler is not None:
+        profiler.disable()
+    stopSampling.set()
+    sampler.join()
+    profileBase = profileName(namespace)
+    try:
+        if profiler is not None:
+            profiler.dump_stats(profileBase + '.pstats')
+        with open(profileBase + '.collapsed', 'wt', encoding='utf-8', newline='') as collapsedOut:
+            for stack, count in sorted(samples.items()):
+                collapsedOut.write(f'{stack} {count}\n')
+    except OSError as e:
+        logging.warning('Cannot save profile(%s) - %s', profileBase, repr(e))
+        return
+    logging.info('Profile saved as %s.*', profileBase)
+    return
+
+
+class TraceMemoryAction(argparse.Action):
+    '''
+    The --traceMemory command line option - start tracing memory allocations as soon as the option is parsed
+    '''
+    def __call__(self, parser, namespace, values, option_string=None):
+        global memoryNamespace
+        setattr(namespace, self.dest, True)
+        if memoryNamespace is None:     # Not already started (the command line can be parsed more than once)
+            memoryNamespace = namespace
+            tracemalloc.start()
+            atexit.register(saveMemoryReport)
+
+
+class RoundTripThresholdAction(argparse.Action):
+    '''
+    The --roundTripThreshold command line option - set the number of executions of an SQL shape that is reported as a possible N+1 pattern
+    '''
+    def __call__(self, parser, namespace, values, option_string=None):
+        if values < 1:
+            parser.error(f'argument {option_string}: must be at least 1')
+        setattr(namespace, self.dest, values)
+        d.roundTripThreshold = values
+
+
+def memorySnapshot(label, sites=True, top=10):
+    '''
+    If tracing memory, record the traced memory, the top allocation sites (if sites) and the DataFrame footprints at this point
+    Snapshots of the allocation sites are slow, so they are skipped inside the heaviest loops
+    '''
+    if memoryNamespace is None:
+        return
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    memorySnapshots.append(f'{label}: current {current / 1048576.0:.1f}MB, peak since last snapshot {peak / 1048576.0:.1f}MB')
+    if sites:
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, '<frozen importlib._bootstrap*>')])
+        for stat in snapshot.statistics('lineno')[:top]:
+            memorySnapshots.append(f'    site {stat.size / 1048576.0:10.1f}MB {stat.count:10d} blocks  {stat.traceback[0].filename}:{stat.traceback[0].lineno}')
+    frames = []
+    for name, value in list(vars(sys.modules['__main__']).items()):
+        if isinstance(value, pd.DataFrame):
+            frames.append((int(value.memory_usage(index=True, deep=True).sum()), name, len(value.index)))
+        elif isinstance(value, dict):       # A dictionary of DataFrames (e.g. sheet_table_df)
+            for key, thisValue in list(value.items()):
+                if isinstance(thisValue, pd.DataFrame):
+                    frames.append((int(thisValue.memory_usage(index=True, deep=True).sum()), f'{name}[{key!r}]', len(thisValue.index)))
+    for size, name, rows in sorted(frames, reverse=True)[:top]:
+        memorySnapshots.append(f'    frame {size / 1048576.0:9.1f}MB {rows:10d} rows    {name}')
+    return
+
+
+def saveMemoryReport():
+    '''
+    Take a final snapshot and write the memory report
+    '''
+    memorySnapshot('exit')
+    reportFile = profileName(memoryNamespace) + '.memory.txt'
+    try:
+        with open(reportFile, 'wt', encoding='utf-8', newline='') as reportOut:
+            reportOut.write('\n'.join(memorySnapshots) + '\n')
+    except OSError as e:
+        logging.warning('Cannot save memory report(%s) - %s', reportFile, repr(e))
+        return
+    tracemalloc.stop()
+    logging.info('Memory report saved as %s', reportFile)
+    return
+
+
+def sqlShape(statement):
+    '''
+    Normalize a SQL statement to it's shape - replace literals and parameters with ?, collapse lists of parameters
+    '''
+    shape = stringLiteral.sub('?', statement)
+    shape = namedParameter.sub('?', shape)
+    shape = numberLiteral.sub('?', shape)
+    shape = parameterList.sub('?', shape)
+    shape = valuesList.sub(r'\1', shape)
+    return whiteSpace.sub(' ', shape).strip()
+
+
+def beforeExecute(conn, cursor, statement, parameters, context, executemany):
+    '''
+    Note when this statement was sent to the database
+    '''
+    conn.info.setdefault('sqlStarted', []).append(time.perf_counter())
+
+
+def afterExecute(conn, cursor, statement, parameters, context, executemany):
+    '''
+    Add this statement to the statistics for it's shape
+    '''
+    seconds = time.perf_counter() - conn.info['sqlStarted'].pop()
+    shape = sqlShape(statement)
+    if shape not in sqlShapes:
+        sqlShapes[shape] = {'statements':0, 'rows':0, 'seconds':0.0}
+    sqlShapes[shape]['statements'] += 1
+    if executemany and isinstance(parameters, (list, tuple)):
+        sqlShapes[shape]['rows'] += len(parameters)
+    else:
+        sqlShapes[shape]['rows'] += 1
+    sqlShapes[shape]['seconds'] += seconds
+
+
+def startSQLProfile():
+    '''
+    Start profiling every statement sent to the database by any engine
+    '''
+    global sqlProfiling
+    if sqlProfiling:
+        return
+    sqlProfiling = True
+    event.listen(Engine, 'before_cursor_execute', beforeExecute)
+    event.listen(Engine, 'after_cursor_execute', afterExecute)
+    atexit.register(reportSQLProfile)
+    return
+
+
+def reportSQLProfile(top=10):
+    '''
+    Log the top SQL shapes (by total time) and any shapes that look like N+1 patterns
+    '''
+    if not sqlShapes:
+        return
+    statements = sum(shape['statements'] for shape in sqlShapes.values())
+    seconds = sum(shape['seconds'] for shape in sqlShapes.values())
+    logging.info('SQL profile: %d statements, %d distinct shapes, %.3f seconds', statements, len(sqlShapes), seconds)
+    logging.info('SQL profile: %10s %10s %10s %10s  %s', 'statements', 'rows', 'seconds', 'ms/stmt', 'SQL shape')
+    ranked = sorted(sqlShapes.items(), key=lambda item: item[1]['seconds'], reverse=True)
+    for shape, stats in ranked[:top]:
+        logging.info('SQL profile: %10d %10d %10.3f %10.3f  %s', stats['statements'], stats['rows'], stats['seconds'],
+                     1000.0 * stats['seconds'] / stats['statements'], shape[:200])
+    for shape, stats in ranked:
+        if stats['statements'] > d.roundTripThreshold:
+            logging.warning('Possible N+1 pattern - %d round trips (%.3f seconds) for SQL shape: %s', stats['statements'], stats['seconds'], shape[:200])
+    sqlShapes.clear()
+    return
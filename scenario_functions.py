@@ -0,0 +1,303 @@
+'''
+The what-if scenario functions for the Clinical Costing system.
+
+A Scenario loads a clinical costing run once - the general ledger as built, the disbursement and distribution structure,
+and the events and their weights - and derives the baseline disbursed ledger and episode costs in memory,
+following the same rules as disburse_costs.py and distribute_costs.py (floating point mode).
+Each account of the ledger is a position in a numpy array of costs, the disbursement is a list of (source, targets, fractions)
+and the distribution is the share of each account that each episode receives (the distribution fraction times the event weight share).
+
+Scenario.run() applies overrides of general ledger attribute weights, distribution fractions and event attribute bases and weights
+in memory, and only re-derives what they affect. The disbursement is only redone if an attribute weight is overridden,
+and only the accounts whose disbursed cost or distribution changed are redistributed over the episodes.
+Event attribute overrides rescale the recorded event weights ((base + activity) * weight) without rebuilding the events.
+The department (disbursed), DRG and episode totals that changed are returned.
+'''
+
+# pylint: disable=invalid-name, line-too-long, too-many-instance-attributes, too-many-locals
+
+import time
+import logging
+import collections
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+import functions as f
+import data as d
+
+ScenarioResult = collections.namedtuple('ScenarioResult', ['departments', 'drgs', 'episodes', 'seconds'])
+changeThreshold = 0.005     # Totals that change by less than half a cent are not reported
+
+
+class Scenario:
+    '''
+    A clinical costing run, loaded once, over which what-if scenarios can be run
+    '''
+    def __init__(self, useIteration=False):
+        '''
+        Load the run for d.hospital_code, d.model_code and d.run_code and derive the baseline costs
+        '''
+        self.useIteration = useIteration
+        where = 'hospital_code = ' + f.sqlLiteral(d.hospital_code) + ' AND model_code = ' + f.sqlLiteral(d.model_code) + ' AND run_code = ' + f.sqlLiteral(d.run_code)
+        whereRun = 'hospital_code = ' + f.sqlLiteral(d.hospital_code) + ' AND run_code = ' + f.sqlLiteral(d.run_code)
+        whereModel = 'hospital_code = ' + f.sqlLiteral(d.hospital_code) + ' AND model_code = ' + f.sqlLiteral(d.model_code)
+        whereHospital = 'hospital_code = ' + f.sqlLiteral(d.hospital_code)
+        costFeeders = 'SELECT feeder_code FROM feeders WHERE ' + whereHospital + " AND feeder_type_code = 'C'"
+
+        # Read the run
+        built_df = f.readFrame('SELECT department_code, cost_type_code, cost FROM general_ledger_built WHERE ' + where)
+        attributes_df = f.readFrame('SELECT department_code, cost_type_code, general_ledger_attribute_code, general_ledger_attribute_weight FROM general_ledger_attributes WHERE ' + whereModel)
+        adjustments_df = f.readFrame('SELECT department_code, cost_type_code, general_ledger_attribute_code, general_ledger_attribute_weight FROM gl_attributes_run_adjustments WHERE ' + whereRun)
+        self.disbursement_df = f.readFrame('SELECT * FROM general_ledger_disbursement WHERE ' + whereModel)
+        distribution_df = f.readFrame('SELECT department_code, cost_type_code, distribution_code, distribution_fraction FROM general_ledger_distribution WHERE ' + whereModel)
+        self.events_df = f.readFrame('SELECT event_code, event_attribute_code, service_code, episode_no, distribution_code, event_weight FROM events WHERE ' + where)
+        self.eventAttributes_df = pd.read_sql_query(text('SELECT event_code, event_attribute_code, event_attribute_base, event_attribute_weight FROM event_attributes WHERE ' + whereModel), d.engine.connect())
+        feederCosts_df = pd.read_sql_query(text('SELECT service_code, episode_no, SUM(amount) AS cost FROM itemized_costs WHERE ' + whereRun + ' AND feeder_code IN (' + costFeeders + ') GROUP BY service_code, episode_no'), d.engine.connect())
+        feederAccounts_df = pd.read_sql_query(text('SELECT new_department_code AS department_code, new_cost_type_code AS cost_type_code FROM feeder_model WHERE ' + whereModel + ' AND feeder_code IN (' + costFeeders + ')'), d.engine.connect())
+        drgs_df = pd.read_sql_query(text('SELECT episode_no, drg FROM inpat_episode_details WHERE ' + whereRun), d.engine.connect())
+        costTypes_df = pd.read_sql_query(text('SELECT cost_type_code FROM cost_types WHERE ' + whereHospital), d.engine.connect())
+
+        # Number the accounts - every account in the ledger, or that can be disbursed from, disbursed to or distributed
+        accountColumns = ['department_code', 'cost_type_code']
+        accounts_df = pd.concat([thisFrame[accountColumns].astype(object) for thisFrame in [built_df, attributes_df, self.disbursement_df, distribution_df, feederAccounts_df]])
+        self.accounts = pd.MultiIndex.from_frame(accounts_df.drop_duplicates())
+        self.departmentNo, self.departments = pd.factorize(self.accounts.get_level_values('department_code'))
+        self.built = np.zeros(len(self.accounts))
+        np.add.at(self.built, self.accountNo(built_df), pd.to_numeric(built_df['cost']).astype('float64').to_numpy())
+        self.feederAccounts = self.accountNo(feederAccounts_df)
+        self.disbursement_df['account'] = self.accountNo(self.disbursement_df)
+        self.sources = self.disbursement_df['account'].to_numpy()
+
+        # The attribute weights, as disburse_costs.py sets them - 'total' attributes are the department total,
+        # attributes that start with a cost type are the cost of that cost type in the department, then any run adjustments
+        attributes_df = attributes_df.astype({'department_code': object, 'cost_type_code': object, 'general_ledger_attribute_code': object})
+        attributes_df['general_ledger_attribute_weight'] = pd.to_numeric(attributes_df['general_ledger_attribute_weight']).astype('float64')
+        departmentTotals = built_df.groupby('department_code', observed=True)['cost'].sum()
+        isTotal = attributes_df['general_ledger_attribute_code'].str.startswith('total')
+        attributes_df.loc[isTotal, 'general_ledger_attribute_weight'] = attributes_df.loc[isTotal, 'department_code'].map(departmentTotals).astype('float64').fillna(0.0)
+        builtCosts = built_df.astype({'department_code': object, 'cost_type_code': object}).drop_duplicates(subset=accountColumns).set_index(accountColumns)['cost']
+        for costType in costTypes_df['cost_type_code']:
+            isCostType = attributes_df['general_ledger_attribute_code'].str.startswith(costType)
+            if not isCostType.any():
+                continue
+            costs = pd.MultiIndex.from_arrays([attributes_df['department_code'], pd.Series(costType, index=attributes_df.index)]).map(builtCosts.get)
+            costs = pd.to_numeric(pd.Series(costs, index=attributes_df.index), errors='coerce').astype('float64')
+            isCostType &= costs.notna()
+            attributes_df.loc[isCostType, 'general_ledger_attribute_weight'] = costs[isCostType]
+        self.attributes_df = self.overrideAttributes(attributes_df, {(row.department_code, row.cost_type_code, row.general_ledger_attribute_code): row.general_ledger_attribute_weight
+                                                                     for row in adjustments_df.itertuples()}, False)
+
+        # Number the episodes (every episode with an event or a feeder cost) and find their DRGs (as the inpat_drg_cost_rollups do)
+        episodes_df = pd.concat([self.events_df[['service_code', 'episode_no']].astype({'service_code': object}), feederCosts_df[['service_code', 'episode_no']]]).drop_duplicates()
+        self.episodes = pd.MultiIndex.from_frame(episodes_df)
+        self.events_df['episode'] = self.episodes.get_indexer(pd.MultiIndex.from_frame(self.events_df[['service_code', 'episode_no']].astype({'service_code': object})))
+        self.events_df['event_weight'] = pd.to_numeric(self.events_df['event_weight']).astype('float64')
+        self.feederCosts = np.zeros(len(self.episodes))
+        np.add.at(self.feederCosts, self.episodes.get_indexer(pd.MultiIndex.from_frame(feederCosts_df[['service_code', 'episode_no']])),
+                  pd.to_numeric(feederCosts_df['cost']).astype('float64').to_numpy())
+        drgs_df['service_code'] = 'Inpat'       # Only inpatient episodes have a DRG
+        drgs = drgs_df.drop_duplicates(['service_code', 'episode_no']).set_index(['service_code', 'episode_no'])['drg'].fillna('')
+        episodeDrgs = drgs.reindex(self.episodes).to_numpy()       # ED and Clinic episodes, even with the same episode_no as an inpatient episode, have no DRG
+        self.drgNo, self.drgs = pd.factorize(episodeDrgs)       # Episodes without a DRG are -1
+
+        # The distribution - each account's distribution fractions, and each distribution code's share of each episode
+        distribution_df['account'] = self.accountNo(distribution_df)
+        distribution_df['distribution_code'] = distribution_df['distribution_code'].astype(object)
+        distribution_df['distribution_fraction'] = pd.to_numeric(distribution_df['distribution_fraction']).astype('float64')
+        self.distribution_df = distribution_df[['account', 'distribution_code', 'distribution_fraction']]
+        self.shares_df = self.episodeShares(self.events_df)
+        self.flows_df = self.episodeFlows(self.distribution_df, self.shares_df)
+
+        # And derive the baseline
+        self.baseDisbursed = self.disburse(self.disbursementPlan(self.attributes_df))
+        self.baseDistributable = self.distributable(self.baseDisbursed)
+        self.baseEpisodeCosts = self.feederCosts + self.episodeCosts(self.flows_df, self.baseDistributable)
+        logging.info('Scenario baseline: %d accounts, %d disbursements, %d events, %d episodes, $%.2f distributed',
+                     len(self.accounts), len(self.disbursement_df.index), len(self.events_df.index), len(self.episodes), self.baseEpisodeCosts.sum())
+
+    def accountNo(self, frame_df):
+        '''
+        Return the account number of each row (department_code, cost_type_code) of frame_df
+        '''
+        return self.accounts.get_indexer(pd.MultiIndex.from_frame(frame_df[['department_code', 'cost_type_code']].astype(object)))
+
+    def overrideAttributes(self, attributes_df, weights, warnUnknown=True):
+        '''
+        Return attributes_df with the weights overridden - key=(department_code, cost_type_code, general_ledger_attribute_code), value=weight.
+        Unknown attributes are only added if warnUnknown is set (disburse_costs.py ignores unknown run adjustments)
+        '''
+        if not weights:
+            return attributes_df
+        attributes_df = attributes_df.copy()
+        keys = pd.MultiIndex.from_frame(attributes_df[['department_code', 'cost_type_code', 'general_ledger_attribute_code']])
+        newRows = []
+        for key, weight in weights.items():
+            isKey = keys == key
+            if isKey.any():
+                attributes_df.loc[isKey, 'general_ledger_attribute_weight'] = float(weight)
+            elif warnUnknown:
+                logging.warning('Adding new general ledger attribute - department_code(%s), cost_type_code(%s), attribute_code(%s)', *key)
+                newRows.append(dict(zip(['department_code', 'cost_type_code', 'general_ledger_attribute_code'], key), general_ledger_attribute_weight=float(weight)))
+            else:
+                logging.warning('No account[department_code(%s), cost_type_code(%s)] with attribute_code(%s) in general_ledger_attributes', *key)
+        if newRows:
+            attributes_df = pd.concat([attributes_df, pd.DataFrame(newRows)], ignore_index=True)
+        return attributes_df
+
+    def disbursementPlan(self, attributes_df):
+        '''
+        Return the disbursement as a list of (source account, target accounts, fractions), in the order disburse_costs.py disburses them
+        '''
+        targetLevels = dict(zip(self.disbursement_df['account'], self.disbursement_df['disbursement_level']))
+        attributes_df = attributes_df.assign(account=self.accountNo(attributes_df))
+        byAttribute = {attributeCode: thisAttribute_df for attributeCode, thisAttribute_df in attributes_df.groupby('general_ledger_attribute_code')}
+        plan = []
+        for level in sorted(self.disbursement_df['disbursement_level'].unique()):
+            for row in self.disbursement_df[self.disbursement_df['disbursement_level'] == level].itertuples():
+                if row.general_ledger_attribute_code not in byAttribute:
+                    continue
+                targets_df = byAttribute[row.general_ledger_attribute_code]
+                if not self.useIteration:
+                    targets_df = targets_df[[(targetLevels.get(account, level + 1) > level) for account in targets_df['account']]]
+                totalWeight = targets_df['general_ledger_attribute_weight'].sum()
+                if totalWeight == 0.0:
+                    continue
+                plan.append((row.account, targets_df['account'].to_numpy(), targets_df['general_ledger_attribute_weight'].to_numpy() / totalWeight))
+        return plan
+
+    def disburse(self, plan):
+        '''
+        Disburse the built ledger (cascading, or iterating until the indirect costs are down to the last 5 cents)
+        and drop the accounts with less than 10 cents, as disburse_costs.py does
+        '''
+        costs = self.built.copy()
+        indCosts = costs[self.sources].sum()
+        lastIndCosts = None
+        while indCosts > d.iterationThreshold:
+            for source, targets, fractions in plan:
+                parts = costs[source] * fractions
+                np.add.at(costs, targets, parts)
+                costs[source] -= parts.sum()
+            indCosts = costs[self.sources].sum()
+            if not self.useIteration:
+                break
+            if (lastIndCosts is not None) and (lastIndCosts == indCosts):
+                raise ValueError('Faulty iteration disbursement model - indirect costs remaining in indirect cost account')
+            lastIndCosts = indCosts
+        costs[np.abs(costs) <= d.smallCost] = 0.0
+        return costs
+
+    def distributable(self, disbursed):
+        '''
+        The disbursed costs that are distributed (the costs in the cost based feeder accounts are already in the event costs)
+        '''
+        costs = disbursed.copy()
+        costs[self.feederAccounts] = 0.0
+        return costs
+
+    def episodeShares(self, events_df):
+        '''
+        Return each distribution code's share of each episode (the event weights as a fraction of the total weight for the distribution code)
+        '''
+        shares_df = events_df[['distribution_code', 'episode', 'event_weight']].astype({'distribution_code': object})
+        totalWeights = shares_df.groupby('distribution_code')['event_weight'].transform('sum')
+        shares_df = shares_df.assign(share=shares_df['event_weight'] / totalWeights)[totalWeights != 0.0]
+        return shares_df.groupby(['distribution_code', 'episode'], as_index=False)['share'].sum()
+
+    def episodeFlows(self, distribution_df, shares_df):
+        '''
+        Return the fraction of each account that flows to each episode
+        '''
+        flows_df = distribution_df.merge(shares_df, on='distribution_code')
+        return pd.DataFrame({'account': flows_df['account'].to_numpy(), 'episode': flows_df['episode'].to_numpy(),
+                             'fraction': (flows_df['distribution_fraction'] * flows_df['share']).to_numpy()})
+
+    def episodeCosts(self, flows_df, costs):
+        '''
+        Return the cost of each episode when costs (by account) flow to the episodes
+        '''
+        return np.bincount(flows_df['episode'], weights=costs[flows_df['account']] * flows_df['fraction'], minlength=len(self.episodes))
+
+    def run(self, attributeWeights=None, distributionFractions=None, eventAttributes=None):
+        '''
+        Run a scenario, with overrides of
+            attributeWeights - key=(department_code, cost_type_code, general_ledger_attribute_code), value=weight
+            distributionFractions - key=(department_code, cost_type_code, distribution_code), value=fraction
+            eventAttributes - key=(event_code, event_attribute_code), value=(base, weight), where None leaves the base or weight unchanged
+        and return the department, DRG and episode totals that changed
+        '''
+        started = time.perf_counter()
+
+        # Redo the disbursement if any attribute weights have changed
+        if attributeWeights:
+            disbursed = self.disburse(self.disbursementPlan(self.overrideAttributes(self.attributes_df, attributeWeights)))
+        else:
+            disbursed = self.baseDisbursed
+        distributable = self.distributable(disbursed)
+        changedAccounts = set(np.flatnonzero(distributable != self.baseDistributable))
+
+        # Override any distribution fractions
+        distribution_df = self.distribution_df
+        if distributionFractions:
+            distribution_df = distribution_df.copy()
+            for (departmentCode, costTypeCode, distributionCode), fraction in distributionFractions.items():
+                account = self.accounts.get_indexer([(departmentCode, costTypeCode)])[0]
+                if account < 0:
+                    raise ValueError(f'No account [department_code({departmentCode}), cost_type_code({costTypeCode})] in this run')
+                isRow = (distribution_df['account'] == account) & (distribution_df['distribution_code'] == distributionCode)
+                if isRow.any():
+                    distribution_df.loc[isRow, 'distribution_fraction'] = float(fraction)
+                else:
+                    distribution_df = pd.concat([distribution_df, pd.DataFrame({'account': [account], 'distribution_code': [distributionCode], 'distribution_fraction': [float(fraction)]})], ignore_index=True)
+                changedAccounts.add(account)
+
+        # Rescale the weights of the events of any overridden event attributes, and recalculate the shares of the affected distribution codes
+        shares_df = self.shares_df
+        if eventAttributes:
+            events_df = self.events_df.copy()
+            changedCodes = set()
+            for (eventCode, eventAttributeCode), (base, weight) in eventAttributes.items():
+                attribute_df = self.eventAttributes_df[(self.eventAttributes_df['event_code'] == eventCode) & (self.eventAttributes_df['event_attribute_code'] == eventAttributeCode)]
+                if len(attribute_df.index) == 0:
+                    raise ValueError(f'No event attribute - event_code({eventCode}), event_attribute_code({eventAttributeCode})')
+                oldBase = float(attribute_df['event_attribute_base'].iloc[0])
+                oldWeight = float(attribute_df['event_attribute_weight'].iloc[0])
+                if oldWeight == 0.0:
+                    raise ValueError(f'Cannot rescale the events of event_code({eventCode}), event_attribute_code({eventAttributeCode}) as their weight is zero')
+                newBase = oldBase if base is None else float(base)
+                newWeight = oldWeight if weight is None else float(weight)
+                isEvent = (events_df['event_code'] == eventCode) & (events_df['event_attribute_code'] == eventAttributeCode)
+                events_df.loc[isEvent, 'event_weight'] = (newBase + events_df.loc[isEvent, 'event_weight'] / oldWeight - oldBase) * newWeight
+                changedCodes.update(events_df.loc[isEvent, 'distribution_code'].astype(object).unique())
+            if changedCodes:
+                shares_df = pd.concat([shares_df[~shares_df['distribution_code'].isin(changedCodes)],
+                                       self.episodeShares(events_df[events_df['distribution_code'].isin(changedCodes)])], ignore_index=True)
+                changedAccounts.update(distribution_df.loc[distribution_df['distribution_code'].isin(changedCodes), 'account'])
+
+        # Redistribute only the changed accounts
+        episodeCosts = self.baseEpisodeCosts.copy()
+        if changedAccounts:
+            changedAccounts = np.fromiter(changedAccounts, dtype='int64')
+            oldFlows_df = self.flows_df[self.flows_df['account'].isin(changedAccounts)]
+            newFlows_df = self.episodeFlows(distribution_df[distribution_df['account'].isin(changedAccounts)], shares_df)
+            episodeCosts += self.episodeCosts(newFlows_df, distributable) - self.episodeCosts(oldFlows_df, self.baseDistributable)
+
+        # And report the totals that changed
+        departments_df = changes(pd.DataFrame({'department_code': self.departments}),
+                                 np.bincount(self.departmentNo, weights=self.baseDisbursed, minlength=len(self.departments)),
+                                 np.bincount(self.departmentNo, weights=disbursed, minlength=len(self.departments)))
+        hasDrg = self.drgNo >= 0
+        drgs_df = changes(pd.DataFrame({'drg': self.drgs}),
+                          np.bincount(self.drgNo[hasDrg], weights=self.baseEpisodeCosts[hasDrg], minlength=len(self.drgs)),
+                          np.bincount(self.drgNo[hasDrg], weights=episodeCosts[hasDrg], minlength=len(self.drgs)))
+        episodes_df = changes(self.episodes.to_frame(index=False), self.baseEpisodeCosts, episodeCosts)
+        return ScenarioResult(departments_df, drgs_df, episodes_df, time.perf_counter() - started)
+
+
+def changes(keys_df, baseline, scenario):
+    '''
+    Return the keys, baseline, scenario and change for the totals that changed, largest change first
+    '''
+    changes_df = keys_df.assign(baseline=baseline, scenario=scenario, change=scenario - baseline)
+    changes_df = changes_df[changes_df['change'].abs() >= changeThreshold]
+    return changes_df.iloc[changes_df['change'].abs().argsort()[::-1]].reset_index(drop=True)
@@ -0,0 +1,379 @@
+'''
+The input sheet functions for the Clinical Costing system.
+
+The loaders (load_hospital.py, load_model.py, load_hospital_activity.py and load_hospital_costs.py)
+read their worksheets from an Excel workbook, or from a directory of CSV, gzip compressed CSV or Parquet files
+(one file for each worksheet, named after the worksheet, e.g. 'Inpat episode details.csv.gz'),
+which is the layout that tools/generateHospitalData.py -F csv|parquet creates.
+A directory of sheet files is read in chunks, with each column parsed to the type of the matching database table column,
+and checked against the same rules (and with the same messages) as the worksheets in an Excel workbook.
+
+The sheets in each tier of a loader's requiredSheets do not depend on each other, and their headings and data types
+do not depend on the database, so startChecks() checks them all in a pool of worker processes.
+functions.checkWorksheet() then collects each checked sheet, in tier order, and checks it's codes against the database
+(which can hold codes added by the sheets of an earlier tier) before the loader writes it.
+A sheet file that is checked in this process (without worker processes) has it's codes checked chunk by chunk, as it is read.
+The checked sheets are handed back from the worker processes as Arrow IPC streams (or pickled, if Arrow cannot hold them).
+'''
+
+# pylint: disable=invalid-name, line-too-long, broad-exception-caught, global-statement
+
+import os
+import sys
+import logging
+import datetime
+import decimal
+import pickle
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from openpyxl import load_workbook
+from openpyxl.utils.cell import coordinate_from_string, column_index_from_string
+import data as d
+
+# The sheet file extensions, in order of preference
+sheetExtensions = ['.parquet', '.csv.gz', '.csv']
+
+Cell = collections.namedtuple('Cell', ['value'])
+
+inputArgs = None        # The inputDir, inputWorkbook and chunkSize of the open input (for the worker processes)
+workerInput = None      # The workbook, or directory of sheet files, that the worker processes are checking
+workerPool = None       # The pool of worker processes
+sheetChecks = {}        # The sheets being checked by the worker processes. key=sheet, value=future
+
+
+class SheetDirectory:
+    '''
+    A directory of sheet files, that can be used in place of an openpyxl workbook
+    '''
+    def __init__(self, directory, chunkSize):
+        self.directory = directory
+        self.chunkSize = chunkSize
+        self.files = {}         # key=sheet name, value=sheet file
+        self.checked = {}       # key=sheet name, value=the checked (typed) DataFrame
+        for extension in reversed(sheetExtensions):
+            for thisFile in sorted(os.listdir(directory)):
+                if thisFile.endswith(extension):
+                    self.files[thisFile[:-len(extension)]] = os.path.join(directory, thisFile)
+
+    @property
+    def sheetnames(self):
+        '''
+        The names of the sheets, as for an openpyxl workbook
+        '''
+        return list(self.files)
+
+    def __contains__(self, sheet):
+        return sheet in self.files
+
+    def __getitem__(self, sheet):
+        return SheetFile(self, sheet)
+
+
+class SheetFile:
+    '''
+    A sheet file, that can be used in place of an openpyxl worksheet (cell values by coordinate, and the rows of values)
+    '''
+    def __init__(self, sheetDir, sheet):
+        self.sheetDir = sheetDir
+        self.sheet = sheet
+
+    def __getitem__(self, coordinate):
+        column, row = coordinate_from_string(coordinate)
+        column = column_index_from_string(column) - 1
+        if self.sheet in self.sheetDir.checked:
+            sheet_df = self.sheetDir.checked[self.sheet]
+            headings = list(sheet_df.columns)
+        else:
+            headings = readHeadings(self.sheetDir.files[self.sheet])
+            sheet_df = None
+        if row == 1:
+            return Cell(headings[column] if column < len(headings) else None)
+        if sheet_df is None:
+            sheet_df = next(readChunks(self.sheetDir.files[self.sheet], row - 1), None)
+        if (sheet_df is None) or (row - 2 >= len(sheet_df.index)) or (column >= len(headings)):
+            return Cell(None)
+        value = sheet_df.iat[row - 2, column]
+        return Cell(None if pd.isna(value) else value)
+
+    @property
+    def values(self):
+        '''
+        The headings, then each row of values, as for an openpyxl worksheet
+        '''
+        sheetFile = self.sheetDir.files[self.sheet]
+        yield tuple(readHeadings(sheetFile))
+        for chunk_df in readChunks(sheetFile, self.sheetDir.chunkSize):
+            chunk_df = chunk_df.astype(object).where(chunk_df.notna(), None)
+            yield from chunk_df.itertuples(index=False, name=None)
+
+
+def openWorkbook(inputDir, inputWorkbook, chunkSize):
+    '''
+    Open the input - an Excel workbook, or a directory of sheet files
+    (inputWorkbook can be the directory, or a workbook name for which only the directory, without the .xlsx extension, exists)
+    '''
+    global inputArgs
+    inputArgs = (inputDir, inputWorkbook, chunkSize)
+    inputPath = os.path.join(inputDir, inputWorkbook)
+    if (not os.path.exists(inputPath)) and inputPath.endswith('.xlsx') and os.path.isdir(inputPath[:-5]):
+        inputPath = inputPath[:-5]
+    if os.path.isdir(inputPath):
+        logging.info('Reading sheet files from directory %s', inputPath)
+        return SheetDirectory(inputPath, chunkSize)
+    if not os.path.isfile(inputPath):
+        logging.critical('No workbook or directory of sheet files (%s)', inputPath)
+        logging.shutdown()
+        sys.exit(d.EX_NOINPUT)
+    return load_workbook(inputPath)
+
+
+def readHeadings(sheetFile):
+    '''
+    Read the column headings from a sheet file
+    '''
+    if sheetFile.endswith('.parquet'):
+        return pq.read_schema(sheetFile).names
+    return list(pd.read_csv(sheetFile, nrows=0, encoding='utf-8').columns)
+
+
+def readChunks(sheetFile, chunkSize):
+    '''
+    Read a sheet file in chunks of rows (CSV values are read as strings, for parsing to the column types)
+    '''
+    if sheetFile.endswith('.parquet'):
+        for batch in pq.ParquetFile(sheetFile).iter_batches(batch_size=chunkSize):
+            yield batch.to_pandas()
+        return
+    yield from pd.read_csv(sheetFile, dtype=str, keep_default_na=False, na_values=[''], chunksize=chunkSize, encoding='utf-8')
+
+
+def parseColumn(values, colType):
+    '''
+    Parse a column of values to a column type, returning the parsed values and a mask of the values that could not be parsed
+    '''
+    present = values.notna()
+    if colType == str:
+        if pd.api.types.is_numeric_dtype(values) or pd.api.types.is_datetime64_any_dtype(values):
+            return values, present        # Typed data (Parquet) that is not a string
+        return values.where(~present, values.astype(str)), present & False
+    if colType == int:
+        numbers = pd.to_numeric(values, errors='coerce')
+        invalid = present & (numbers.isna() | (numbers != numbers.round()))
+        return numbers.where(~invalid).astype('Int64'), invalid
+    if colType in [float, decimal.Decimal]:
+        numbers = pd.to_numeric(values, errors='coerce')
+        return numbers.astype('float64'), present & numbers.isna()
+    if colType in [datetime.date, datetime.datetime]:
+        dates = pd.to_datetime(values, errors='coerce', format='mixed')
+        invalid = present & dates.isna()
+        if colType == datetime.date:
+            return dates.dt.date.where(dates.notna(), None), invalid
+        return dates, invalid
+    return values, present & False
+
+
+def checkWorkbookSheet(ws, sheet, table, toBeAdded):
+    '''
+    Check the column headings, and the data type of every cell, in an Excel worksheet, and return the worksheet data
+    '''
+    # Make sure every column in the this worksheet matches a column name in this table
+    # and that every cell has data of the correct data type
+    found = []
+    for col in ws.columns:
+        heading = True
+        for cell in col:
+            if heading:
+                if not isinstance(cell.value, str):
+                    logging.critical('Invalid heading "%s" (not string) in worksheet "%s" at "%s"', cell.value, sheet, cell.coordinate)
+                    logging.shutdown()
+                    sys.exit(d.EX_CONFIG)
+                colName = cell.value
+                if colName in d.metadata.tables[table].columns:
+                    found.append(colName)
+                else:
+                    logging.critical('Extraneous column "%s" in worksheet "%s" at "%s"', colName, sheet, cell.coordinate)
+                    logging.shutdown()
+                    sys.exit(d.EX_CONFIG)
+                colType = d.metadata.tables[table].columns[colName].type.python_type
+                heading = False
+                continue
+            if cell.value is None:
+                break
+            if not isinstance(cell.value, colType):
+                failed = True
+                if isinstance(cell.value, int) and ((colType == float) or (colType == decimal.Decimal)):
+                    failed = False
+                elif isinstance(cell.value, float):
+                    if (colType == decimal.Decimal):
+                        failed = False
+                    elif (colType == int):
+                        try:
+                            x = int(cell.value)
+                            if x == cell.value:
+                                failed = False
+                        except Exception as e:
+                            pass
+                if failed:
+                    logging.critical('Invalid data "%s" (type %s not %s) in column "%s" in worksheet "%s" at "%s"',
+                                    cell.value, type(cell.value), colType, colName, sheet, cell.coordinate)
+                    logging.shutdown()
+                    sys.exit(d.EX_CONFIG)
+
+    # Check that every column in the database table has a column in the worksheet
+    for col in d.metadata.tables[table].columns:
+        column = col.name
+        if column in toBeAdded:
+            continue
+        if column not in found:
+            logging.critical('Database column (%s) in table "%s" not found in sheet "%s" headers', column, table, sheet)
+            logging.shutdown()
+            sys.exit(d.EX_CONFIG)
+
+    data = ws.values
+    cols = next(data)
+    return pd.DataFrame(list(data), columns=cols)
+
+
+def checkSheet(sheetDir, sheet, table, toBeAdded, checkChunk=None):
+    '''
+    Check that the headings of a sheet file match the database table column names,
+    and parse the data, chunk by chunk, to the datatype of each column in the table.
+    If checkChunk is given, then each parsed chunk is also passed to it, as it is read (functions.checkWorksheet() checks the codes),
+    so a bad code is reported without reading the rest of the sheet file.
+    Returns the sheet data (with None for missing values), as for an Excel worksheet.
+    '''
+    sheetFile = sheetDir.files[sheet]
+    columns = d.metadata.tables[table].columns
+
+    # Make sure every column in the this sheet matches a column name in this table
+    headings = readHeadings(sheetFile)
+    for colNo, colName in enumerate(headings):
+        if colName not in columns:
+            logging.critical('Extraneous column "%s" in sheet file "%s" at column %d', colName, sheetFile, colNo + 1)
+            logging.shutdown()
+            sys.exit(d.EX_CONFIG)
+
+    # Check that every column in the database table has a column in the sheet
+    for col in columns:
+        if (col.name not in toBeAdded) and (col.name not in headings):
+            logging.critical('Database column (%s) in table "%s" not found in sheet "%s" headers', col.name, table, sheet)
+            logging.shutdown()
+            sys.exit(d.EX_CONFIG)
+
+    # Parse every column to the data type of the matching database column
+    chunks = []
+    firstRow = 2        # The headings are row 1
+    for chunk_df in readChunks(sheetFile, sheetDir.chunkSize):
+        chunk_df = chunk_df.reset_index(drop=True)
+        for colName in headings:
+            colType = columns[colName].type.python_type
+            parsed, invalid = parseColumn(chunk_df[colName], colType)
+            if invalid.any():
+                badRow = invalid.idxmax()
+                value = chunk_df[colName].iat[badRow]
+                logging.critical('Invalid data "%s" (type %s not %s) in column "%s" in sheet file "%s" at row %d',
+                                 value, type(value), colType, colName, sheetFile, firstRow + badRow)
+                logging.shutdown()
+                sys.exit(d.EX_CONFIG)
+            chunk_df[colName] = parsed
+        chunk_df = chunk_df.astype(object).where(chunk_df.notna(), None)
+        if checkChunk is not None:
+            checkChunk(chunk_df)
+        chunks.append(chunk_df)
+        firstRow += len(chunk_df.index)
+    if chunks:
+        table_df = pd.concat(chunks, ignore_index=True)
+    else:
+        table_df = pd.DataFrame(columns=headings, dtype=object)
+    sheetDir.checked[sheet] = table_df
+    return table_df
+
+
+def toCompact(table_df):
+    '''
+    Convert a checked sheet to a compact form for handing back from a worker process - an Arrow IPC stream
+    (or a pickle, for data that Arrow cannot hold, such as a column of mixed types)
+    '''
+    try:
+        table = pa.Table.from_pandas(table_df, preserve_index=False)
+    except (pa.ArrowException, TypeError, ValueError):
+        return ('pickle', pickle.dumps(table_df, protocol=pickle.HIGHEST_PROTOCOL))
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return ('arrow', sink.getvalue().to_pybytes())
+
+
+def fromCompact(compact):
+    '''
+    Convert a checked sheet back from it's compact form (with None for missing values, as for an Excel worksheet)
+    '''
+    form, data = compact
+    if form == 'pickle':
+        return pickle.loads(data)
+    table_df = pa.ipc.open_stream(data).read_all().to_pandas(integer_object_nulls=True)
+    return table_df.astype(object).where(table_df.notna(), None)
+
+
+def initWorker(args, metadata, loggingLevel):
+    '''
+    Set up a worker process - open the input (unless inherited from the parent process) and take the database metadata
+    '''
+    global workerInput
+    if not logging.getLogger().hasHandlers():
+        logging.basicConfig(format='%(processName)s [%(asctime)s]: %(message)s', datefmt='%d/%m/%y %H:%M:%S %p', level=loggingLevel)
+    if d.engine is not None:        # Never use the parent's database connections
+        d.engine.dispose(close=False)
+    if d.metadata is None:
+        d.metadata = metadata
+    if workerInput is None:
+        workerInput = openWorkbook(*args)
+
+
+def checkInWorker(sheet, table, toBeAdded):
+    '''
+    Check the headings and data types of a sheet in a worker process, and return the checked sheet in it's compact form
+    '''
+    if isinstance(workerInput, SheetDirectory):
+        table_df = checkSheet(workerInput, sheet, table, toBeAdded)
+    else:
+        table_df = checkWorkbookSheet(workerInput[sheet], sheet, table, toBeAdded)
+    return toCompact(table_df)
+
+
+def startChecks(wb, requiredSheets, toBeAdded, workers):
+    '''
+    Start checking the headings and data types of every sheet in every tier of requiredSheets in a pool of worker processes
+    (sheets that are missing, or have no database table, are left for functions.checkWorksheet() to report, in order)
+    '''
+    global workerInput, workerPool
+    sheets = [(sheet, table) for theseSheets in requiredSheets for sheet, table in theseSheets.items()
+              if (sheet in wb.sheetnames) and (table in d.metadata.tables)]
+    if (workers is None) or (workers < 2) or (len(sheets) < 2):
+        return
+    workerInput = wb        # Inherited by the worker processes, where they are forked
+    workerPool = ProcessPoolExecutor(max_workers=min(workers, len(sheets)), initializer=initWorker,
+                                     initargs=(inputArgs, d.metadata, logging.getLogger().getEffectiveLevel()))
+    for sheet, table in sheets:
+        sheetChecks[sheet] = workerPool.submit(checkInWorker, sheet, table, toBeAdded)
+    logging.info('Checking %d sheets in %d worker processes', len(sheets), min(workers, len(sheets)))
+
+
+def collectCheck(sheet):
+    '''
+    Wait for a worker process to finish checking a sheet and return the checked sheet
+    (a worker that found an error has logged it and exited with it's exit code - which this process then does too)
+    '''
+    global workerPool
+    try:
+        table_df = fromCompact(sheetChecks.pop(sheet).result())
+    except BaseException:
+        workerPool.shutdown(wait=False, cancel_futures=True)
+        raise
+    if not sheetChecks:
+        workerPool.shutdown()
+        workerPool = None
+    return table_df
@@ -0,0 +1,162 @@
+'''
+The run telemetry functions for the Clinical Costing system.
+
+Each costing stage calls startStage() once the database engine has been created, then brackets each
+major step with startStep()/endStep(), and calls endStage() when it is finished.
+Each step records it's duration, input and output row counts, cost totals, database round trips
+and the peak memory of the process. The telemetry is written as a JSON run report next to the log file
+and, optionally, appended to the stage_telemetry table.
+If memory tracing (--traceMemory) each step also ends with a memory snapshot.
+'''
+
+# pylint: disable=invalid-name, line-too-long, broad-exception-caught, global-statement
+
+import os
+import sys
+import time
+import json
+import atexit
+import logging
+import datetime
+from sqlalchemy import event, insert
+import data as d
+import profiling_functions as prf
+try:
+    import resource         # Not available on Windows
+except ImportError:
+    resource = None
+
+stage = {}          # The stage being run
+openSteps = []      # The steps that have been started, but not yet ended (innermost last)
+steps = []          # The steps that have ended
+roundTrips = 0      # The number of statements sent to the database
+
+
+def addTelemetryArguments(parser):
+    '''
+    Add the telemetry command line arguments
+    '''
+    parser.add_argument('-T', '--telemetryHistory', dest='telemetryHistory', action='store_true',
+                        help='Append the telemetry for this run to the stage_telemetry table')
+    return
+
+
+def countRoundTrip(conn, cursor, statement, parameters, context, executemany):
+    '''
+    Count each statement sent to the database
+    '''
+    global roundTrips
+    roundTrips += 1
+
+
+def peakMemory():
+    '''
+    Return the peak memory (resident set size in kB) of this process so far
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':        # ru_maxrss is bytes on macOS, kB elsewhere
+        peak //= 1024
+    return peak
+
+
+def startStage(progName, logDir, logFile, history):
+    '''
+    Start collecting the telemetry for this stage - the stage itself is the outermost step
+    '''
+    stageName = os.path.basename(progName)
+    if logFile is not None:
+        reportFile = os.path.join(logDir, os.path.splitext(logFile)[0] + '.telemetry.json')
+    else:
+        reportFile = os.path.join(logDir, stageName + '.telemetry.json')
+    stage['stage'] = stageName
+    stage['reportFile'] = reportFile
+    stage['history'] = history
+    stage['started'] = datetime.datetime.now()
+    event.listen(d.engine, 'before_cursor_execute', countRoundTrip)
+    atexit.register(endStage)       # Report the steps that were completed if the stage exits early
+    startStep(stageName)
+    return
+
+
+def startStep(name, rowsIn=None, costIn=None):
+    '''
+    Start a step (nested inside any step that has not yet ended)
+    '''
+    path = name
+    if openSteps:
+        path = openSteps[-1]['step'] + '/' + name
+    openSteps.append({
+        'step_seq': len(steps) + len(openSteps) + 1,
+        'step': path,
+        'depth': len(openSteps),
+        'started': time.perf_counter(),
+        'roundTrips': roundTrips,
+        'rows_in': None if rowsIn is None else int(rowsIn),
+        'cost_in': None if costIn is None else round(float(costIn), 2),
+    })
+    return
+
+
+def endStep(rowsOut=None, costOut=None):
+    '''
+    End the innermost step
+    '''
+    thisStep = openSteps.pop()
+    thisStep['seconds'] = round(time.perf_counter() - thisStep.pop('started'), 6)
+    thisStep['round_trips'] = roundTrips - thisStep.pop('roundTrips')
+    thisStep['rows_out'] = None if rowsOut is None else int(rowsOut)
+    thisStep['cost_out'] = None if costOut is None else round(float(costOut), 2)
+    thisStep['peak_memory'] = peakMemory()
+    steps.append(thisStep)
+    logging.debug('telemetry: %s', thisStep)
+    prf.memorySnapshot(thisStep['step'], thisStep['depth'] <= 1)      # Allocation sites for the stage and it's major steps only
+    return
+
+
+def endStage():
+    '''
+    End the stage - write the JSON run report and, optionally, append the steps to the stage_telemetry table
+    '''
+    if 'reportFile' not in stage:       # Never started, or already reported
+        return
+    completed = (len(openSteps) == 1)       # Only the stage itself is still open
+    while openSteps:
+        endStep()
+    steps.sort(key=lambda thisStep: thisStep['step_seq'])
+    report = {
+        'stage': stage['stage'],
+        'hospital_code': d.hospital_code,
+        'model_code': d.model_code,
+        'run_code': d.run_code,
+        'started': stage['started'].isoformat(timespec='seconds'),
+        'completed': completed,
+        'steps': steps,
+    }
+    reportFile = stage.pop('reportFile')
+    try:
+        with open(reportFile, 'wt', encoding='utf-8', newline='') as reportOut:
+            json.dump(report, reportOut, indent=2)
+    except OSError as e:
+        logging.warning('Cannot write telemetry report(%s) - %s', reportFile, repr(e))
+    if not stage['history']:
+        return
+    if 'stage_telemetry' not in d.metadata.tables:
+        logging.warning('No stage_telemetry table in the database - telemetry history not saved')
+        return
+    history = []
+    for thisStep in steps:
+        row = dict(thisStep)
+        row['hospital_code'] = d.hospital_code
+        row['run_code'] = d.run_code
+        row['model_code'] = d.model_code
+        row['stage'] = stage['stage']
+        row['started'] = stage['started']
+        history.append(row)
+    try:
+        with d.engine.begin() as conn:
+            conn.execute(insert(d.metadata.tables['stage_telemetry']), history)
+    except Exception as e:
+        logging.warning('Cannot save telemetry history - %s', repr(e))
+    return
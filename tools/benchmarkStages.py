@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+
+# pylint: disable=unspecified-encoding, broad-exception-caught, line-too-long, invalid-name, pointless-string-statement
+
+'''
+Script benchmarkStages.py
+
+A python script to benchmark the Clinical Costing loaders and stages, on SQLite,
+using synthetic datasets (from generateHospitalData.py) of several sizes.
+The wall time, rows per second, SQL statement count and peak RSS of each loader and stage
+are compared with a stored baseline and any regression, past a threshold, is reported as a failure.
+
+    SYNOPSIS
+
+    $ python benchmarkStages.py
+             [-z sizes|--sizes=sizes]
+             [-x seed|--seed=seed]
+             [-W workDir|--workDir=workDir]
+             [-b baselineFile|--baselineFile=baselineFile]
+             [-t threshold|--threshold=threshold]
+             [-m minSeconds|--minSeconds=minSeconds]
+             [-U|--updateBaseline]
+             [-v loggingLevel|--verbose=logingLevel]
+             [-L logDir|--logDir=logDir]
+             [-l logfile|--logfile=logfile]
+
+    OPTIONS
+    -z sizes|--sizes=sizes
+    A comma separated list of dataset sizes, as numbers of inpatient episodes (default=200,1000).
+    Each dataset has five itemized cost lines per episode, one ward per 500 episodes (minimum 4)
+    and one clinic per 1000 episodes (minimum 2).
+
+    -x seed|--seed=seed
+    The seed for the synthetic data (default=1)
+
+    -W workDir|--workDir=workDir
+    The directory for the synthetic data, the SQLite databases and the output from each loader and stage (default='benchmark')
+
+    -b baselineFile|--baselineFile=baselineFile
+    The JSON file of baseline measurements (default='benchmark_baseline.json')
+
+    -t threshold|--threshold=threshold
+    The fractional increase, over the baseline, in wall time, SQL statements or peak RSS
+    that is reported as a regression (default=0.25)
+
+    -m minSeconds|--minSeconds=minSeconds
+    Increases in wall time of less than minSeconds are never regressions (timing noise) (default=0.5)
+
+    -U|--updateBaseline
+    Save these measurements as the new baseline (no regression checks are done)
+
+    -v loggingLevel|--verbose=loggingLevel
+    Set the level of logging that you want (defaut INFO).
+
+    -L logDir
+    The directory where the log file will be written (default='.')
+
+    -l logfile|--logfile=logfile
+    The name of a logging file where you want all messages captured
+    (default=None)
+
+    THE MAIN CODE
+    For each size, generate a synthetic dataset, create an empty SQLite database,
+    then run each loader and stage, as a separate process, measuring it.
+    Then either save the measurements as the baseline, or compare them with the baseline.
+'''
+
+# Import all the modules that make life easy
+import sys
+import os
+import argparse
+import logging
+import json
+import time
+import datetime
+import platform
+import subprocess
+from sqlalchemy import create_engine, text
+
+# This next section is plagurised from /usr/include/sysexits.h
+EX_OK = 0        # successful termination
+EX_WARN = 1        # non-fatal termination with warnings
+
+EX_USAGE = 64        # command line usage error
+EX_DATAERR = 65        # data format error
+EX_NOINPUT = 66        # cannot open input
+EX_NOUSER = 67        # addressee unknown
+EX_NOHOST = 68        # host name unknown
+EX_UNAVAILABLE = 69    # service unavailable
+EX_SOFTWARE = 70    # internal software error
+EX_OSERR = 71        # system error (e.g., can't fork)
+EX_OSFILE = 72        # critical OS file missing
+EX_CANTCREAT = 73    # can't create (user) output file
+EX_IOERR = 74        # input/output error
+EX_TEMPFAIL = 75    # temp failure; user is invited to retry
+EX_PROTOCOL = 76    # remote error in protocol
+EX_NOPERM = 77        # permission denied
+EX_CONFIG = 78        # configuration error
+
+# The synthetic hospital, model and run
+hospitalCode = 'hospitalS'
+modelCode = 'modelS'
+runCode = 'Jun-97'
+
+# The loaders and stages, in the order they are run, with the tables they write (for counting rows)
+steps = {
+    'load_hospital': ['departments', 'cost_types', 'wards', 'clinics', 'clinicians', 'feeders'],
+    'load_model': ['general_ledger_attributes', 'general_ledger_disbursement', 'general_ledger_distribution', 'event_attributes', 'distribution_codes'],
+    'load_hospital_activity': ['inpat_episode_details', 'inpat_patient_location', 'inpat_theatre_details', 'clinic_activity_details', 'ed_episode_details'],
+    'load_hospital_costs': ['general_ledger_costs', 'itemized_costs'],
+    'build_costs': ['general_ledger_adjusted', 'general_ledger_mapped', 'general_ledger_built'],
+    'disburse_costs': ['general_ledger_disbursed'],
+    'build_events': ['events'],
+    'distribute_costs': ['event_costs', 'general_ledger_undistributed'],
+}
+
+# The measurements that are checked for regressions
+gatedMeasures = ['seconds', 'statements', 'peakRSS']
+
+# Run a loader or stage with an SQLAlchemy event hook that counts every statement sent to the database
+# (argv[1] is the file for the count, argv[2] is the script and the rest are it's arguments)
+countingWrapper = '''
+import os, sys, atexit, runpy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+statements = [0]
+@event.listens_for(Engine, 'before_cursor_execute')
+def countStatement(conn, cursor, statement, parameters, context, executemany):
+    statements[0] += 1
+def saveCount(countFile=sys.argv[1]):
+    with open(countFile, 'wt') as countOut:
+        countOut.write(str(statements[0]))
+atexit.register(saveCount)
+sys.argv = sys.argv[2:]
+sys.path.insert(0, os.path.dirname(sys.argv[0]))
+runpy.run_path(sys.argv[0], run_name='__main__')
+'''
+
+
+def runStep(command, cwd, outFile, countFile):
+    '''
+    Run a loader or stage as a separate process, in cwd, capturing stdout and stderr in outFile,
+    and return the return code, wall time, statement count and peak RSS (kB) of the process
+    '''
+    if os.path.exists(countFile):
+        os.remove(countFile)
+    start = time.perf_counter()
+    peakRSS = None
+    with open(outFile, 'wt', encoding='utf-8', newline='') as output:
+        process = subprocess.Popen([sys.executable, '-c', countingWrapper, countFile] + command, cwd=cwd, stdout=output, stderr=subprocess.STDOUT)
+        if hasattr(os, 'wait4'):        # The resource usage of just this process (not available on Windows)
+            pid, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            peakRSS = usage.ru_maxrss
+            if sys.platform == 'darwin':        # ru_maxrss is bytes on macOS, kB elsewhere
+                peakRSS //= 1024
+        else:
+            process.wait()
+    seconds = time.perf_counter() - start
+    statements = None
+    if os.path.exists(countFile):
+        with open(countFile, 'rt') as countIn:
+            statements = int(countIn.read())
+    return process.returncode, seconds, statements, peakRSS
+
+
+def countRows(engine, tables):
+    '''
+    Count the rows, for the synthetic hospital, in a set of tables
+    '''
+    rows = 0
+    with engine.connect() as conn:
+        for table in tables:
+            rows += conn.execute(text(f"SELECT COUNT(*) FROM {table} WHERE hospital_code = '{hospitalCode}'")).scalar()
+    return rows
+
+
+def benchmarkSize(size, seed, workDir, toolsDir, repoDir):
+    '''
+    Generate a dataset of this size, load it into an empty SQLite database and run every stage
+    '''
+    sizeDir = os.path.abspath(os.path.join(workDir, f'size_{size}'))
+    dataDir = os.path.join(sizeDir, 'data')
+    os.makedirs(sizeDir, exist_ok=True)
+    databaseName = os.path.join(sizeDir, 'clinical_costing.db')
+    if os.path.exists(databaseName):
+        os.remove(databaseName)
+    configDir = os.path.join(repoDir, 'databaseConfig')
+    countFile = os.path.join(sizeDir, 'statements.txt')
+
+    # Generate the data and create the database
+    command = [sys.executable, os.path.join(toolsDir, 'generateHospitalData.py'), '-O', dataDir, '-x', str(seed), '-H', hospitalCode, '-M', modelCode, '-R', runCode,
+               '-e', str(size), '-i', str(size * 5), '-w', str(max(4, size // 500)), '-k', str(max(2, size // 1000))]
+    with open(os.path.join(sizeDir, 'generateHospitalData.out'), 'wt', encoding='utf-8', newline='') as output:
+        if subprocess.call(command, cwd=toolsDir, stdout=output, stderr=subprocess.STDOUT) != EX_OK:
+            logging.critical('Failed to generate the data for size(%d)', size)
+            return None
+    command = [sys.executable, os.path.join(toolsDir, 'createSQLAlchemyDB.py'), '-D', 'SQLite', '-C', configDir, '-d', databaseName, '-v', '0']
+    with open(os.path.join(sizeDir, 'createSQLAlchemyDB.out'), 'wt', encoding='utf-8', newline='') as output:
+        if subprocess.call(command, cwd=toolsDir, stdout=output, stderr=subprocess.STDOUT) != EX_OK:
+            logging.critical('Failed to create the database for size(%d)', size)
+            return None
+    engine = create_engine('sqlite:///' + databaseName)
+
+    # The arguments for each loader and stage
+    runName = runCode.replace('-', '')
+    stepArgs = {
+        'load_hospital': ['-I', os.path.join(dataDir, 'hospitalConfig', 'hospitals'), '-i', hospitalCode + '.xlsx'],
+        'load_model': ['-I', os.path.join(dataDir, 'hospitalConfig', 'models'), '-i', modelCode + '.xlsx'],
+        'load_hospital_activity': ['-I', os.path.join(dataDir, 'hospitalActivity', hospitalCode), '-i', runName + 'PatientActivity.xlsx'],
+        'load_hospital_costs': ['-I', os.path.join(dataDir, 'hospitalCosts', hospitalCode), '-i', runName + 'HospitalCostsAndAdjustments.xlsx'],
+    }
+    for step in ['build_costs', 'disburse_costs', 'build_events', 'distribute_costs']:
+        stepArgs[step] = [hospitalCode, modelCode, runCode]
+
+    results = {}
+    for step, tables in steps.items():
+        command = [os.path.join(repoDir, step + '.py')] + stepArgs[step] + ['-D', 'SQLite', '-C', configDir, '-d', databaseName]
+        returnCode, seconds, statements, peakRSS = runStep(command, sizeDir, os.path.join(sizeDir, step + '.out'), countFile)
+        if returnCode != EX_OK:
+            logging.critical('%s failed (return code %d) for size(%d) - see %s', step, returnCode, size, os.path.join(sizeDir, step + '.out'))
+            return None
+        rows = countRows(engine, tables)
+        results[step] = {'seconds': round(seconds, 3), 'rows': rows, 'rowsPerSecond': round(rows / seconds, 1) if seconds > 0 else None,
+                         'statements': statements, 'peakRSS': peakRSS}
+        logging.info('size(%d) %s: %.3f seconds, %d rows, %s statements, %s kB peak RSS', size, step, seconds, rows, statements, peakRSS)
+    engine.dispose()
+    return results
+
+
+# The main code
+if __name__ == '__main__':
+    '''
+    Benchmark the Clinical Costing loaders and stages
+    '''
+
+    # Get the script name (without the '.py' extension)
+    progName = os.path.basename(sys.argv[0])
+    progName = progName[0:-3]        # Strip off the .py ending
+
+    # Define the command line options
+    parser = argparse.ArgumentParser(prog=progName)
+    parser.add_argument('-z', '--sizes', dest='sizes', default='200,1000', help='A comma separated list of numbers of inpatient episodes (default=200,1000)')
+    parser.add_argument('-x', '--seed', dest='seed', type=int, default=1, help='The seed for the synthetic data (default=1)')
+    parser.add_argument('-W', '--workDir', dest='workDir', default='benchmark', help='The directory for the data, databases and output (default=benchmark)')
+    parser.add_argument('-b', '--baselineFile', dest='baselineFile', default='benchmark_baseline.json', help='The JSON file of baseline measurements (default=benchmark_baseline.json)')
+    parser.add_argument('-t', '--threshold', dest='threshold', type=float, default=0.25, help='The fractional increase that is a regression (default=0.25)')
+    parser.add_argument('-m', '--minSeconds', dest='minSeconds', type=float, default=0.5, help='Increases in wall time less than this are not regressions (default=0.5)')
+    parser.add_argument('-U', '--updateBaseline', dest='updateBaseline', action='store_true', help='Save these measurements as the new baseline')
+    parser.add_argument('-v', '--verbose', dest='verbose', type=int, choices=list(range(0, 5)),
+                        help='The level of logging\n\t0=CRITICAL,1=ERROR,2=WARNING,3=INFO,4=DEBUG')
+    parser.add_argument('-L', '--logDir', dest='logDir', default='.', help='The name of a logging directory')
+    parser.add_argument('-l', '--logFile', dest='logFile', default=None, help='The name of the logging file')
+    parser.add_argument('args', nargs=argparse.REMAINDER)
+
+    # Parse the command line options
+    args = parser.parse_args()
+    seed = args.seed
+    workDir = args.workDir
+    baselineFile = args.baselineFile
+    threshold = args.threshold
+    minSeconds = args.minSeconds
+    updateBaseline = args.updateBaseline
+    logDir = args.logDir
+    logFile = args.logFile
+    loggingLevel = args.verbose
+
+    # Set up logging
+    logging_levels = {0:logging.CRITICAL, 1:logging.ERROR, 2:logging.WARNING, 3:logging.INFO, 4:logging.DEBUG}
+    logfmt = progName + ' [%(asctime)s]: %(message)s'
+    if loggingLevel and (loggingLevel not in logging_levels) :
+        sys.stderr.write(f'Error - invalid logging verbosity ({loggingLevel})\n')
+        parser.print_usage(sys.stderr)
+        sys.stderr.flush()
+        sys.exit(EX_USAGE)
+    if logFile :        # If sending to a file then check if the log directory exists
+        # Check that the logDir exists
+        if not os.path.isdir(logDir) :
+            sys.stderr.write(f'Error - logDir ({logDir}) does not exits\n')
+            parser.print_usage(sys.stderr)
+            sys.stderr.flush()
+            sys.exit(EX_USAGE)
+        with open(os.path.join(logDir,logFile), 'w') as logfile :
+            pass
+        if loggingLevel :
+            logging.basicConfig(format=logfmt, datefmt='%d/%m/%y %H:%M:%S %p', level=logging_levels[loggingLevel], filename=os.path.join(logDir, logFile))
+        else :
+            logging.basicConfig(format=logfmt, datefmt='%d/%m/%y %H:%M:%S %p', filename=os.path.join(logDir, logFile))
+        print(f'Now logging to {os.path.join(logDir, logFile)}')
+        sys.stdout.flush()
+    else :
+        if loggingLevel :
+            logging.basicConfig(format=logfmt, datefmt='%d/%m/%y %H:%M:%S %p', level=logging_levels[loggingLevel])
+        else :
+            logging.basicConfig(format=logfmt, datefmt='%d/%m/%y %H:%M:%S %p')
+        print('Now logging to sys.stderr')
+        sys.stdout.flush()
+
+    # Check the sizes
+    try:
+        sizes = [int(size) for size in args.sizes.split(',')]
+    except ValueError:
+        logging.critical('Invalid sizes(%s) - must be a comma separated list of numbers', args.sizes)
+        logging.shutdown()
+        sys.exit(EX_USAGE)
+    if min(sizes) < 1:
+        logging.critical('Invalid sizes(%s) - every size must be at least 1', args.sizes)
+        logging.shutdown()
+        sys.exit(EX_USAGE)
+
+    # Read the baseline - which must exist if we are checking for regressions
+    baseline = None
+    if not updateBaseline:
+        try:
+            with open(baselineFile, 'rt', encoding='utf-8') as baselineIn:
+                baseline = json.load(baselineIn)
+        except (OSError, ValueError) as e:
+            logging.critical('Cannot read baselineFile(%s) - %s (use -U to create a baseline)', baselineFile, repr(e))
+            logging.shutdown()
+            sys.exit(EX_NOINPUT)
+
+    toolsDir = os.path.dirname(os.path.abspath(__file__))
+    repoDir = os.path.dirname(toolsDir)
+
+    # Benchmark each size
+    measurements = {}
+    failed = False
+    for size in sizes:
+        results = benchmarkSize(size, seed, workDir, toolsDir, repoDir)
+        if results is None:
+            failed = True
+            continue
+        measurements[str(size)] = results
+
+    # Report the measurements, and any regressions
+    regressions = []
+    print(f"{'size':>8} {'step':<24} {'seconds':>10} {'rows':>10} {'rows/sec':>12} {'statements':>11} {'peak RSS kB':>12}")
+    for size, results in measurements.items():
+        for step, result in results.items():
+            print(f"{size:>8} {step:<24} {result['seconds']:>10.3f} {result['rows']:>10} {str(result['rowsPerSecond']):>12} {str(result['statements']):>11} {str(result['peakRSS']):>12}")
+            if (baseline is None) or (size not in baseline['sizes']) or (step not in baseline['sizes'][size]):
+                continue
+            for measure in gatedMeasures:
+                was = baseline['sizes'][size][step].get(measure)
+                now = result[measure]
+                if (was is None) or (now is None):
+                    continue
+                limit = was * (1.0 + threshold)
+                if measure == 'seconds':
+                    limit = max(limit, was + minSeconds)
+                if now > limit:
+                    regressions.append((size, step, measure, was, now))
+
+    if updateBaseline:
+        if failed:
+            logging.critical('Not saving the baseline as some loaders or stages failed')
+            logging.shutdown()
+            sys.exit(EX_SOFTWARE)
+        baseline = {'created': datetime.datetime.now().isoformat(timespec='seconds'), 'seed': seed, 'python': platform.python_version(),
+                    'platform': platform.platform(), 'sizes': measurements}
+        try:
+            with open(baselineFile, 'wt', encoding='utf-8') as baselineOut:
+                json.dump(baseline, baselineOut, indent=2)
+        except OSError as e:
+            logging.critical('Cannot write baselineFile(%s) - %s', baselineFile, repr(e))
+            logging.shutdown()
+            sys.exit(EX_CANTCREAT)
+        print(f'Baseline saved to {baselineFile}')
+        logging.shutdown()
+        sys.exit(EX_OK)
+
+    if baseline.get('seed') != seed:
+        logging.warning('The baseline was measured with seed(%s), not seed(%d)', baseline.get('seed'), seed)
+    for size, step, measure, was, now in regressions:
+        print(f'REGRESSION: size({size}) {step} {measure} was {was}, now {now} (threshold {threshold:.0%})')
+    if failed or regressions:
+        logging.shutdown()
+        sys.exit(EX_SOFTWARE)
+    print(f'No regressions (threshold {threshold:.0%})')
+    logging.shutdown()
+    sys.exit(EX_OK)
@@ -16,13 +16,14 @@ A python script to create the Clinical Costing database tables using SQLAlchemy
              [-s Server|--Server=Server]
              [-d databaseName|--databaseName=databaseName]
              [-N|--noKeys]
+             [-P|--partitioned]
              [-v loggingLevel|--verbose=logingLevel]
              [-L logDir|--logDir=logDir]
              [-l logfile|--logfile=logfile]
 
     REQUIRED
     -D databaseType|--databaseType=databaseType
-    The type of database [eg:MSSQL/MySQL]
+    The type of database [eg:MSSQL/MySQL/SQLite]
 
 
     OPTIONS
@@ -50,6 +51,13 @@ A python script to create the Clinical Costing database tables using SQLAlchemy
     -N|--noKeys
     Create the tables with no primary keys and no foreign keys
 
+    -P|--partitioned
+    Create the run-scoped tables that the costing stages rebuild (events, event_costs and the general_ledger_* stage tables),
+    and their staging tables, partitioned by hospital_code, run_code and model_code, so that clearing a run is a partition truncate.
+    MySQL uses native LIST COLUMNS partitions (and these tables have no foreign keys, which MySQL does not allow on partitioned tables,
+    so indexSQLAlchemyDB.py does not add them).
+    Other databases create the tables unpartitioned.
+
     -v loggingLevel|--verbose=loggingLevel
     Set the level of logging that you want (defaut INFO).
 
@@ -71,7 +79,7 @@ import argparse
 import logging
 import collections
 import json
-from sqlalchemy import create_engine, MetaData, Table, Column
+from sqlalchemy import create_engine, MetaData, Table, Column, text, insert
 from sqlalchemy.exc import OperationalError
 from sqlalchemy_utils import database_exists
 import defineSQLAlchemyDB as dbConfig
@@ -111,7 +119,7 @@ if __name__ == '__main__':
 
     # Define the command line options
     parser = argparse.ArgumentParser(prog=progName)
-    parser.add_argument('-D', '--databaseType', dest='databaseType', required=True, help='The database Type [e.g.: MSSQL/MySQL]')
+    parser.add_argument('-D', '--databaseType', dest='databaseType', required=True, help='The database Type [e.g.: MSSQL/MySQL/SQLite]')
     parser.add_argument('-C', '--configDir', dest='configDir', default='../databaseConfig',
                         help='The name of the directory containing the database connection configuration file (default=config)')
     parser.add_argument('-c', '--configFile', dest='configFile', default='clinical_costing.json',
@@ -121,6 +129,7 @@ if __name__ == '__main__':
     parser.add_argument('-s', '--server', dest='server', help='The address of the database server')
     parser.add_argument('-d', '--databaseName', dest='databaseName', help='The name of the database')
     parser.add_argument('-N', '--noKeys', dest='noKeys', action='store_true', help='Create the tables with no primary/foreign keys')
+    parser.add_argument('-P', '--partitioned', dest='partitioned', action='store_true', help='Create the run-scoped stage tables partitioned by run')
     parser.add_argument('-v', '--verbose', dest='verbose', type=int, choices=list(range(0, 5)),
                         help='The level of logging\n\t0=CRITICAL,1=ERROR,2=WARNING,3=INFO,4=DEBUG')
     parser.add_argument('-L', '--logDir', dest='logDir', default='.', help='The name of a logging directory')
@@ -137,6 +146,7 @@ if __name__ == '__main__':
     server = args.server
     databaseName = args.databaseName
     noKeys = args.noKeys
+    partitioned = args.partitioned
     logDir = args.logDir
     logFile = args.logFile
     loggingLevel = args.verbose
@@ -201,16 +211,16 @@ if __name__ == '__main__':
     if ('databaseName' in config[databaseType]) and (databaseName is None):
         databaseName = config[databaseType]['databaseName']
 
-    # Check that we have all the required paramaters
-    if username is None:
+    # Check that we have all the required paramaters (those used in the connectionString)
+    if (username is None) and ('{username}' in connectionString):
         logging.critical('Missing definition for "username"')
         logging.shutdown()
         sys.exit(EX_USAGE)
-    if password is None:
+    if (password is None) and ('{password}' in connectionString):
         logging.critical('Missing definition for "password"')
         logging.shutdown()
         sys.exit(EX_USAGE)
-    if server is None:
+    if (server is None) and ('{server}' in connectionString):
         logging.critical('Missing definition for "server"')
         logging.shutdown()
         sys.exit(EX_USAGE)
@@ -228,9 +238,12 @@ if __name__ == '__main__':
 
     # Check if the database exists
     if not database_exists(engine.url):
-        logging.critical('Database %s does not exist', databaseName)
-        logging.shutdown()
-        sys.exit(EX_CONFIG)
+        if databaseType == 'SQLite':        # SQLite creates the database file when we first connect
+            logging.info('Creating SQLite database %s', databaseName)
+        else:
+            logging.critical('Database %s does not exist', databaseName)
+            logging.shutdown()
+            sys.exit(EX_CONFIG)
 
     # Connect to the database
     try:
@@ -268,6 +281,22 @@ if __name__ == '__main__':
         newMetaData = dbConfig.Base.metadata
         newMetaData.naming_convention = convention
 
+    # Work out how to partition the run-scoped tables
+    partitionMethod = None
+    partitionedTables = dbConfig.runPartitionedTables + ['staging_' + thisTable for thisTable in dbConfig.runPartitionedTables]
+    if partitioned:
+        if engine.dialect.name == 'mysql':
+            partitionMethod = 'list'
+            # MySQL does not support foreign keys on partitioned tables
+            for thisTable in dbConfig.runPartitionedTables:
+                table = newMetaData.tables[thisTable]
+                for constraint in list(table.foreign_key_constraints):
+                    table.constraints.discard(constraint)
+                for column in table.columns:
+                    column.foreign_keys.clear()
+        else:
+            logging.warning('Partitioning is not supported for %s - the run-scoped tables will not be partitioned', databaseType)
+
     # Create all the tables
     try:
         newMetaData.create_all(engine, newMetaData.tables.values())
@@ -276,6 +305,20 @@ if __name__ == '__main__':
         logging.shutdown()
         sys.exit(EX_UNAVAILABLE)
 
+    # Partition the run-scoped tables and record them in the partition catalog
+    if partitionMethod is not None:
+        try:
+            with engine.begin() as conn:
+                for thisTable in partitionedTables:
+                    # Every LIST partitioned table needs at least one partition
+                    conn.execute(text(f"ALTER TABLE {thisTable} PARTITION BY LIST COLUMNS(hospital_code, run_code, model_code) (PARTITION p_none VALUES IN (('', '', '')))"))
+                    conn.execute(insert(newMetaData.tables['partitioned_tables']).values(table_name=thisTable, partition_method=partitionMethod))
+        except Exception as e:
+            print('Exception:', e)
+            logging.shutdown()
+            sys.exit(EX_UNAVAILABLE)
+        print(f'The run-scoped tables have been partitioned ({partitionMethod})')
+
     print('All tables have been created')
     logging.shutdown()
     sys.exit(EX_OK)
@@ -21,7 +21,7 @@ A python script to create views on the Clinical Costing database tables using SQ
 
     REQUIRED
     -D databaseType|--databaseType=databaseType
-    The type of database [eg:MSSQL/MySQL]
+    The type of database [eg:MSSQL/MySQL/SQLite]
 
 
     OPTIONS
@@ -158,7 +158,7 @@ if __name__ == '__main__':
 
     # Define the command line options
     parser = argparse.ArgumentParser(prog=progName)
-    parser.add_argument('-D', '--databaseType', dest='databaseType', required=True, help='The database Type [e.g.: MSSQL/MySQL]')
+    parser.add_argument('-D', '--databaseType', dest='databaseType', required=True, help='The database Type [e.g.: MSSQL/MySQL/SQLite]')
     parser.add_argument('-C', '--configDir', dest='configDir', default='../databaseConfig',
                         help='The name of the directory containing the database connection configuration file (default=config)')
     parser.add_argument('-c', '--configFile', dest='configFile', default='clinical_costing.json',
@@ -246,16 +246,16 @@ if __name__ == '__main__':
     if ('databaseName' in config[databaseType]) and (databaseName is None):
         databaseName = config[databaseType]['databaseName']
 
-    # Check that we have all the required paramaters
-    if username is None:
+    # Check that we have all the required paramaters (those used in the connectionString)
+    if (username is None) and ('{username}' in connectionString):
         logging.critical('Missing definition for "username"')
         logging.shutdown()
         sys.exit(EX_USAGE)
-    if password is None:
+    if (password is None) and ('{password}' in connectionString):
         logging.critical('Missing definition for "password"')
         logging.shutdown()
         sys.exit(EX_USAGE)
-    if server is None:
+    if (server is None) and ('{server}' in connectionString):
         logging.critical('Missing definition for "server"')
         logging.shutdown()
         sys.exit(EX_USAGE)
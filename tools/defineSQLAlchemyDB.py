@@ -8,7 +8,7 @@ A Python script containing the SQLAchemy definitions of the Clinical Costing dat
 # pylint: disable=unused-private-member, missing-class-docstring, line-too-long, invalid-name
 
 import datetime
-from sqlalchemy import String, Date, Integer, Float, Numeric, Index, ForeignKeyConstraint
+from sqlalchemy import Table, String, Date, DateTime, Integer, Float, Numeric, Index, ForeignKeyConstraint
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
 
@@ -857,6 +857,113 @@ class event_costs(Base):
         ForeignKeyConstraint(['hospital_code', 'cost_type_code'], ['cost_types.hospital_code', 'cost_types.cost_type_code']),
         ForeignKeyConstraint(['hospital_code', 'model_code', 'distribution_code'], ['distribution_codes.hospital_code', 'distribution_codes.model_code', 'distribution_codes.distribution_code']),
     )
+# The materialized cost rollups - rebuilt for each hospital, model and run by distribute_costs.py
+class service_cost_rollups(Base):
+    """
+    The event costs for this hospital, during this clinical costing run, according to this clinical costing model,
+    summarised by service, department, cost type and event code
+    """
+    __tablename__ = 'service_cost_rollups'
+    hospital_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    run_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    model_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    service_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    department_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    cost_type_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    event_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    episodes:Mapped[int] = mapped_column(Integer, nullable=False)
+    cost:Mapped[float] = mapped_column(Numeric(15,5), nullable=True)
+    __table_args__ = (
+        Index('ix_service_cost_rollups_account', 'hospital_code', 'run_code', 'model_code', 'department_code', 'cost_type_code', unique=False),
+        Index('ix_service_cost_rollups_event', 'hospital_code', 'run_code', 'model_code', 'event_code', unique=False),
+        ForeignKeyConstraint(['hospital_code'], ['hospitals.hospital_code']),
+        ForeignKeyConstraint(['hospital_code', 'run_code'], ['clinical_costing_runs.hospital_code', 'clinical_costing_runs.run_code']),
+        ForeignKeyConstraint(['hospital_code', 'model_code'], ['models.hospital_code', 'models.model_code']),
+    )
+
+class inpat_drg_cost_rollups(Base):
+    """
+    The inpatient event costs for this hospital, during this clinical costing run, according to this clinical costing model,
+    summarised by DRG, department, cost type and event code (drg is '' for episodes without a DRG)
+    """
+    __tablename__ = 'inpat_drg_cost_rollups'
+    hospital_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    run_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    model_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    drg:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    department_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    cost_type_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    event_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    episodes:Mapped[int] = mapped_column(Integer, nullable=False)
+    cost:Mapped[float] = mapped_column(Numeric(15,5), nullable=True)
+    __table_args__ = (
+        Index('ix_inpat_drg_cost_rollups_account', 'hospital_code', 'run_code', 'model_code', 'department_code', 'cost_type_code', unique=False),
+        ForeignKeyConstraint(['hospital_code'], ['hospitals.hospital_code']),
+        ForeignKeyConstraint(['hospital_code', 'run_code'], ['clinical_costing_runs.hospital_code', 'clinical_costing_runs.run_code']),
+        ForeignKeyConstraint(['hospital_code', 'model_code'], ['models.hospital_code', 'models.model_code']),
+    )
+
+class inpat_specialty_cost_rollups(Base):
+    """
+    The inpatient event costs for this hospital, during this clinical costing run, according to this clinical costing model,
+    summarised by clinical specialty, department, cost type and event code (clinical_specialty is '' for episodes without one)
+    """
+    __tablename__ = 'inpat_specialty_cost_rollups'
+    hospital_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    run_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    model_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    clinical_specialty:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    department_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    cost_type_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    event_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    episodes:Mapped[int] = mapped_column(Integer, nullable=False)
+    cost:Mapped[float] = mapped_column(Numeric(15,5), nullable=True)
+    __table_args__ = (
+        Index('ix_inpat_specialty_cost_rollups_account', 'hospital_code', 'run_code', 'model_code', 'department_code', 'cost_type_code', unique=False),
+        ForeignKeyConstraint(['hospital_code'], ['hospitals.hospital_code']),
+        ForeignKeyConstraint(['hospital_code', 'run_code'], ['clinical_costing_runs.hospital_code', 'clinical_costing_runs.run_code']),
+        ForeignKeyConstraint(['hospital_code', 'model_code'], ['models.hospital_code', 'models.model_code']),
+    )
+
+class episode_cost_rollups(Base):
+    """
+    The event costs for this hospital, during this clinical costing run, according to this clinical costing model,
+    summarised by episode, department, cost type and event code (for looking up the costs of individual episodes)
+    """
+    __tablename__ = 'episode_cost_rollups'
+    hospital_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    run_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    model_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    service_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    episode_no:Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    department_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    cost_type_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    event_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    cost:Mapped[float] = mapped_column(Numeric(15,5), nullable=True)
+    __table_args__ = (
+        ForeignKeyConstraint(['hospital_code'], ['hospitals.hospital_code']),
+        ForeignKeyConstraint(['hospital_code', 'run_code'], ['clinical_costing_runs.hospital_code', 'clinical_costing_runs.run_code']),
+        ForeignKeyConstraint(['hospital_code', 'model_code'], ['models.hospital_code', 'models.model_code']),
+    )
+
+# The publication of each hospital, model and run's event costs and cost rollups
+class run_publications(Base):
+    """
+    When the event costs and cost rollups for this hospital, during this clinical costing run, according to this clinical costing model,
+    were last published by distribute_costs.py (publication_no counts the publications, so that cached costs can be invalidated)
+    """
+    __tablename__ = 'run_publications'
+    hospital_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    run_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    model_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    publication_no:Mapped[int] = mapped_column(Integer, nullable=False)
+    published:Mapped[datetime.datetime] = mapped_column(DateTime, nullable=False)
+    __table_args__ = (
+        ForeignKeyConstraint(['hospital_code'], ['hospitals.hospital_code']),
+        ForeignKeyConstraint(['hospital_code', 'run_code'], ['clinical_costing_runs.hospital_code', 'clinical_costing_runs.run_code']),
+        ForeignKeyConstraint(['hospital_code', 'model_code'], ['models.hospital_code', 'models.model_code']),
+    )
+
 # The General Ledger extracts details
 class general_ledger_costs(Base):
     '''
@@ -973,3 +1080,74 @@ class general_ledger_adjusted(Base):
         ForeignKeyConstraint(['hospital_code', 'department_code'], ['departments.hospital_code', 'departments.department_code']),
         ForeignKeyConstraint(['hospital_code', 'cost_type_code'], ['cost_types.hospital_code', 'cost_types.cost_type_code']),
     )
+
+
+# The telemetry history table
+class stage_telemetry(Base):
+    """
+    The telemetry (durations, row counts, cost totals, database round trips and peak memory)
+    for each step of each costing stage run, for trending performance over time
+    """
+    __tablename__ = 'stage_telemetry'
+    hospital_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    run_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    model_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    stage:Mapped[str] = mapped_column(String(30), primary_key=True, autoincrement=False)
+    started:Mapped[datetime.datetime] = mapped_column(DateTime, primary_key=True, autoincrement=False)
+    step_seq:Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    step:Mapped[str] = mapped_column(String(200), nullable=False)
+    depth:Mapped[int] = mapped_column(Integer, nullable=False)
+    seconds:Mapped[float] = mapped_column(Float, nullable=True)
+    rows_in:Mapped[int] = mapped_column(Integer, nullable=True)
+    rows_out:Mapped[int] = mapped_column(Integer, nullable=True)
+    cost_in:Mapped[float] = mapped_column(Numeric(15,5), nullable=True)
+    cost_out:Mapped[float] = mapped_column(Numeric(15,5), nullable=True)
+    round_trips:Mapped[int] = mapped_column(Integer, nullable=True)
+    peak_memory:Mapped[int] = mapped_column(Integer, nullable=True)
+    __table_args__ = (
+        Index(None, 'hospital_code', 'run_code', 'model_code', unique=False),
+        ForeignKeyConstraint(['hospital_code'], ['hospitals.hospital_code']),
+        ForeignKeyConstraint(['hospital_code', 'run_code'], ['clinical_costing_runs.hospital_code', 'clinical_costing_runs.run_code']),
+        ForeignKeyConstraint(['hospital_code', 'model_code'], ['models.hospital_code', 'models.model_code']),
+    )
+
+
+# The run-scoped tables that each costing stage clears and rebuilds for a hospital, model and run.
+# createSQLAlchemyDB.py -P creates these tables partitioned by (hospital_code, run_code, model_code) where the database supports it
+runPartitionedTables = ['general_ledger_adjusted', 'general_ledger_mapped', 'general_ledger_built',
+                        'general_ledger_disbursed', 'general_ledger_undistributed', 'events', 'event_costs']
+
+
+# The staging tables - each costing stage writes a run into staging_<table>, then publishes it to <table> in a single transaction,
+# so readers never see a partly built run. The staging tables have the same columns and primary key, but no foreign keys
+for thisRunTable in runPartitionedTables:
+    Table('staging_' + thisRunTable, Base.metadata,
+          *[column._copy() for column in Base.metadata.tables[thisRunTable].columns],       # pylint: disable=protected-access
+          Index('ix_staging_' + thisRunTable + '_run', 'hospital_code', 'run_code', 'model_code', unique=False))
+
+
+# The partitioning catalog tables
+class partitioned_tables(Base):
+    """
+    The tables that were created partitioned by run, and how (list = native LIST COLUMNS partitions)
+    """
+    __tablename__ = 'partitioned_tables'
+    table_name:Mapped[str] = mapped_column(String(64), primary_key=True, autoincrement=False)
+    partition_method:Mapped[str] = mapped_column(String(20), nullable=False)
+
+class run_partitions(Base):
+    """
+    The partition that holds each hospital, model and run in each partitioned table
+    """
+    __tablename__ = 'run_partitions'
+    table_name:Mapped[str] = mapped_column(String(64), primary_key=True, autoincrement=False)
+    hospital_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    run_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    model_code:Mapped[str] = mapped_column(String(20), primary_key=True, autoincrement=False)
+    partition_name:Mapped[str] = mapped_column(String(64), nullable=False)
+    __table_args__ = (
+        ForeignKeyConstraint(['table_name'], ['partitioned_tables.table_name']),
+        ForeignKeyConstraint(['hospital_code'], ['hospitals.hospital_code']),
+        ForeignKeyConstraint(['hospital_code', 'run_code'], ['clinical_costing_runs.hospital_code', 'clinical_costing_runs.run_code']),
+        ForeignKeyConstraint(['hospital_code', 'model_code'], ['models.hospital_code', 'models.model_code']),
+    )
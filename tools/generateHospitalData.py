@@ -0,0 +1,695 @@
+#!/usr/bin/env python
+
+# pylint: disable=unspecified-encoding, broad-exception-caught, line-too-long, invalid-name, pointless-string-statement
+
+'''
+Script generateHospitalData.py
+
+A python script to generate a synthetic, but internally consistent, set of Clinical Costing data
+(hospital configuration, clinical costing model, patient activity and hospital costs) at a chosen scale.
+The data is seeded, so the same options always generate the same data (for benchmarking).
+
+    SYNOPSIS
+
+    $ python generateHospitalData.py
+             [-O outputDir|--outputDir=outputDir]
+             [-F format|--format=format]
+             [-x seed|--seed=seed]
+             [-H hospitalCode|--hospitalCode=hospitalCode]
+             [-M modelCode|--modelCode=modelCode]
+             [-R runCode|--runCode=runCode]
+             [-S startDate|--startDate=startDate]
+             [-N days|--days=days]
+             [-e episodes|--episodes=episodes]
+             [-w wards|--wards=wards]
+             [-k clinics|--clinics=clinics]
+             [-f feeders|--feeders=feeders]
+             [-i items|--items=items]
+             [-a accounts|--accounts=accounts]
+             [-g depth|--depth=depth]
+             [-n|--sharedEpisodeNos]
+             [-v loggingLevel|--verbose=logingLevel]
+             [-L logDir|--logDir=logDir]
+             [-l logfile|--logfile=logfile]
+
+    OPTIONS
+    -O outputDir|--outputDir=outputDir
+    The directory where the data will be created (default='synthetic').
+    The data is created in the same structure as the sample data, being
+    outputDir/hospitalConfig/hospitals/hospitalCode.xlsx,
+    outputDir/hospitalConfig/models/modelCode.xlsx,
+    outputDir/hospitalActivity/hospitalCode/runPatientActivity.xlsx and
+    outputDir/hospitalCosts/hospitalCode/runHospitalCostsAndAdjustments.xlsx
+
+    -F format|--format=format
+    The format of the data [choice:xlsx/csv/parquet] (default=xlsx).
+    For csv and parquet each workbook becomes a directory (the workbook name without the .xlsx extension)
+    with one file for each worksheet (the worksheet name with a .csv or .parquet extension)
+
+    -x seed|--seed=seed
+    The seed for the random number generator (default=1)
+
+    -H hospitalCode|--hospitalCode=hospitalCode
+    The hospital code (default='hospitalS')
+
+    -M modelCode|--modelCode=modelCode
+    The model code (default='modelS')
+
+    -R runCode|--runCode=runCode
+    The run code (default='Jun-97')
+
+    -S startDate|--startDate=startDate
+    The first date (YYYY-MM-DD) of the run (default=1997-06-01)
+
+    -N days|--days=days
+    The number of days in the run (default=30)
+
+    -e episodes|--episodes=episodes
+    The number of inpatient episodes (default=1000).
+    There will be the same number of clinic attendances and one and a half times as many ED episodes.
+
+    -w wards|--wards=wards
+    The number of inpatient wards (default=8)
+
+    -k clinics|--clinics=clinics
+    The number of outpatient clinics (default=4)
+
+    -f feeders|--feeders=feeders
+    The number of feeder systems (default=4). Every fourth feeder is a weight based feeder.
+    The rest are cost based feeders.
+
+    -i items|--items=items
+    The total number of itemized cost lines, across all feeders (default=5000)
+
+    -a accounts|--accounts=accounts
+    The number of General Ledger accounts (default=200). Every department has at least
+    a wages and a supplies account, so this is a minimum of two accounts per department.
+
+    -g depth|--depth=depth
+    The number of levels of indirect (overhead) departments to be disbursed (default=2)
+
+    -n|--sharedEpisodeNos
+    Number the Clinic and ED episodes from the same first episode number as the Inpatient episodes,
+    so that the same episode numbers occur in every service (episodes are identified by service_code and episode_no)
+
+    -v loggingLevel|--verbose=loggingLevel
+    Set the level of logging that you want (defaut INFO).
+
+    -L logDir
+    The directory where the log file will be written (default='.')
+
+    -l logfile|--logfile=logfile
+    The name of a logging file where you want all messages captured
+    (default=None)
+
+    THE MAIN CODE
+    Build the hospital, the model, the patient activity and the hospital costs, as a set of worksheets,
+    then write each set of worksheets as an Excel workbook (or as a directory of CSV or Parquet files)
+'''
+
+# Import all the modules that make life easy
+import sys
+import os
+import argparse
+import logging
+import random
+import datetime
+import csv
+import math
+from openpyxl import Workbook
+import pandas as pd
+
+# This next section is plagurised from /usr/include/sysexits.h
+EX_OK = 0        # successful termination
+EX_WARN = 1        # non-fatal termination with warnings
+
+EX_USAGE = 64        # command line usage error
+EX_DATAERR = 65        # data format error
+EX_NOINPUT = 66        # cannot open input
+EX_NOUSER = 67        # addressee unknown
+EX_NOHOST = 68        # host name unknown
+EX_UNAVAILABLE = 69    # service unavailable
+EX_SOFTWARE = 70    # internal software error
+EX_OSERR = 71        # system error (e.g., can't fork)
+EX_OSFILE = 72        # critical OS file missing
+EX_CANTCREAT = 73    # can't create (user) output file
+EX_IOERR = 74        # input/output error
+EX_TEMPFAIL = 75    # temp failure; user is invited to retry
+EX_PROTOCOL = 76    # remote error in protocol
+EX_NOPERM = 77        # permission denied
+EX_CONFIG = 78        # configuration error
+
+# The raw General Ledger cost types, the cost types they are grouped into, and the cost types created by the model
+rawCostTypes = {'S&W': 'Salaries and wages', 'MSS': 'Medical and surgical supplies', 'DRGS': 'Drugs', 'DOMC': 'Domestic costs', 'ADMIN': 'Administration expenses'}
+groupedCostTypes = {'S&W': 'wages', 'MSS': 'supplies', 'DRGS': 'drugs'}
+modelCostTypes = {'wages': 'Wages', 'supplies': 'Supplies', 'drugs': 'Drugs', 'other': 'Other costs', 'invoices': 'Feeder invoices', 'overheads': 'Overheads'}
+
+# The cost of one month of each raw cost type, for one department - (low, high)
+accountCosts = {'S&W': (60000.0, 200000.0), 'MSS': (5000.0, 30000.0), 'DRGS': (2000.0, 20000.0), 'DOMC': (1000.0, 8000.0)}
+otherAccountCosts = (500.0, 5000.0)
+
+# The events in the model - event_code: (event_type_code, event_class_code, event_source_code, event_subroutine_name, event_attribute_code, event_what, event_where)
+modelEvents = {
+    'EDattend': ('other', 'ED', 'ED', 'EDattendmin', 'ED attend', 'attend min', None),
+    'EDdir': ('other', 'Medical', 'ED', 'EDtreatmin', 'ED treat', 'treat min, ED Dir', "ed_episode_details.doctor_code = 'EDDIR'"),
+    'wardbdays': ('ward', 'Ward', 'Inpat', 'ipwardbdays', 'bed days', 'bed days', None),
+    'wardadmit': ('ward', 'Ward', 'Inpat', 'ipadmissions', 'IP admission', 'admission', None),
+    'clinicattend': ('clinic', 'Clinic', 'Clinic', 'opclinicmin', 'clin min', 'attend min', None),
+    'theatre': ('other', 'Theatre', 'Inpat', 'theatremin', 'theatre min', 'theatre min', None),
+    'anaes': ('other', 'Medical', 'Inpat', 'anaesthmin', 'anaesth. min', 'anaesthetic min', None),
+}
+
+# The event subroutines in build_events_functions.py
+eventSubroutines = {
+    'EDadmissions': 'Admission to Accident and Emergency',
+    'EDdischarges': 'Discharge from Accident and Emergency',
+    'EDattendmin': 'Mins. of attendance in Accident and Emergency',
+    'EDseenmin': 'Nurse seen mins. in Accident and Emergency',
+    'EDtreatmin': 'Doctor treatment mins. in Accident & Emergency',
+    'anaesthmin': 'Minutes of anaethesia',
+    'ipadmissions': 'Inpatient admissions',
+    'ipdischarges': 'Inpatient discharges',
+    'ipwardbdays': 'Bed days in an Inpatient ward',
+    'ipwardbhrs': 'Bed hours in an Inpatient ward',
+    'ipwardsday': 'Same Day stays in a Inpatient ward',
+    'opclinicmin': 'Minute in a Clinic',
+    'theatremin': 'Minutes in an operating theatre',
+}
+
+specialties = ['GEM', 'GES', 'MID', 'ORT', 'SPM', 'CAR', 'REN', 'PAE']
+financialCategories = ['HI', 'ST', 'RE', 'DI']
+
+
+def money(value):
+    '''
+    Round a value to cents
+    '''
+    return round(value, 2)
+
+
+def buildHospital(rng, config):
+    '''
+    Build the hospital configuration worksheets
+    (and remember the departments, cost types and codes that the other workbooks need)
+    '''
+    config['wardCodes'] = [f'W{i + 1:02d}' for i in range(config['wards'])]
+    config['clinicCodes'] = [f'C{i + 1:02d}' for i in range(config['clinics'])]
+    config['theatreCodes'] = [f'T{i + 1}' for i in range(max(1, config['wards'] // 4))]
+    config['feederCodes'] = [f'feeder{i + 1:02d}' for i in range(config['feeders'])]
+    config['feederTypes'] = {feeder: ('W' if (i % 4) == 3 else 'C') for i, feeder in enumerate(config['feederCodes'])}
+    config['feederDepts'] = {feeder: f'FD{i + 1:02d}' for i, feeder in enumerate(config['feederCodes'])}
+    config['doctors'] = [f'DR{i + 1:02d}' for i in range(max(2, config['wards']))]
+    config['surgeons'] = [f'SURG{i + 1:02d}' for i in range(max(2, config['wards'] // 2))]
+    config['anaesthetists'] = [f'ANAES{i + 1:02d}' for i in range(max(2, config['wards'] // 3))]
+    config['practitioners'] = {clinic: f'{clinic}P{i + 1}' for clinic in config['clinicCodes'] for i in range(2)}
+    config['edDoctors'] = ['EDDIR', 'EDRMO1', 'EDRMO2', 'NURS']
+
+    # The departments - direct departments get distributed to events, indirect departments get disbursed
+    departments = {}          # department_code: (department_name, kind)
+    departments['ED'] = ('Emergency Department', 'ED')
+    for ward in config['wardCodes']:
+        departments[ward] = (f'Ward {ward}', 'ward')
+        departments[ward + 'N'] = (f'Ward {ward} nursing administration', 'wardSub')
+    for clinic in config['clinicCodes']:
+        departments[clinic] = (f'Clinic {clinic}', 'clinic')
+    departments['THTR'] = ('Operating theatres', 'theatre')
+    departments['ANAES'] = ('Anaesthetics', 'anaes')
+    for feeder in config['feederCodes']:
+        departments[config['feederDepts'][feeder]] = (f'Feeder department for {feeder}', 'feeder')
+    perLevel = max(2, config['wards'] // 4)
+    config['indirectLevels'] = {}
+    for level in range(1, config['depth'] + 1):
+        for i in range(perLevel):
+            dept = f'IND{level}{chr(ord("A") + i)}'
+            departments[dept] = (f'Indirect department {dept} (level {level})', 'indirect')
+            config['indirectLevels'][dept] = level
+    config['departments'] = departments
+
+    # The General Ledger accounts - every department has wages and supplies,
+    # then other cost types are added, department by department, until we have enough accounts
+    deptAccounts = {dept: ['S&W', 'MSS'] for dept in departments}
+    extraAccounts = max(0, config['accounts'] - 2 * len(departments))
+    extraTypes = ['DRGS', 'DOMC', 'ADMIN']
+    extraTypes += [f'CT{i + 1:03d}' for i in range(max(0, math.ceil(extraAccounts / len(departments)) - len(extraTypes)))]
+    config['costTypes'] = dict(rawCostTypes)
+    for costType in extraTypes:
+        if costType not in config['costTypes']:
+            config['costTypes'][costType] = f'Other cost type {costType}'
+    for costType in extraTypes:
+        for dept in departments:
+            if extraAccounts == 0:
+                break
+            deptAccounts[dept].append(costType)
+            extraAccounts -= 1
+    config['deptAccounts'] = deptAccounts
+
+    sheets = {}
+    sheets['hospital'] = (['hospital_code', 'hospital_name'], [[config['hospitalCode'], f"Synthetic hospital {config['hospitalCode']}"]])
+    sheets['departments'] = (['department_code', 'department_name'], [[dept, name] for dept, (name, kind) in departments.items()])
+    costTypes = dict(config['costTypes'])
+    costTypes.update(modelCostTypes)
+    sheets['cost types'] = (['cost_type_code', 'cost_type_description'], [[costType, description] for costType, description in costTypes.items()])
+    sheets['services'] = (['service_code', 'service_description'], [['Inpat', 'Inpatient episodes'], ['Clinic', 'Outpatient episodes'], ['ED', 'Emergency episodes']])
+    sheets['wards'] = (['ward_code', 'ward_description'], [[ward, f'Ward {ward}'] for ward in config['wardCodes']])
+    sheets['theatres'] = (['theatre_code', 'theatre_description'], [[theatre, f'Theatre {theatre}'] for theatre in config['theatreCodes']])
+    sheets['clinics'] = (['clinic_code', 'clinic_description'], [[clinic, f'Clinic {clinic}'] for clinic in config['clinicCodes']])
+    clinicians = [['none', 'Unknown/not recorded']]
+    for clinician in config['doctors'] + config['surgeons'] + config['anaesthetists'] + list(config['practitioners'].values()) + config['edDoctors']:
+        clinicians.append([clinician, f'Clinician {clinician}'])
+    sheets['clinicians'] = (['clinician_code', 'clinician_description'], clinicians)
+    sheets['feeder types'] = (['feeder_type_code', 'feeder_type_description'], [['C', 'Cost'], ['W', 'Weight']])
+    feeders = []
+    for i, feeder in enumerate(config['feederCodes']):
+        feeders.append([feeder, config['feederTypes'][feeder], feeder, 5.0 + (i + 1) / 100.0, f'Feeder {feeder} items'])
+    sheets['feeders'] = (['feeder_code', 'feeder_type_code', 'event_class_code', 'event_class_seq', 'feeder_description'], feeders)
+    return sheets
+
+
+def finalCostTypes(config, dept, groupedToOther):
+    '''
+    Return the cost types that a department will have after the costs have been built
+    '''
+    costTypes = set()
+    accounts = list(config['deptAccounts'][dept])
+    if config['departments'][dept][1] == 'ward':        # Ward sub-departments are grouped into the ward
+        accounts += config['deptAccounts'][dept + 'N']
+    for costType in accounts:
+        if (dept, costType) in groupedToOther:
+            costTypes.add('other')
+        else:
+            costTypes.add(groupedCostTypes.get(costType, 'other'))
+    return sorted(costTypes)
+
+
+def buildModel(rng, config):
+    '''
+    Build the clinical costing model worksheets
+    '''
+    departments = config['departments']
+    sheets = {}
+    sheets['hospital'] = (['hospital_code', 'hospital_name'], [[config['hospitalCode'], f"Synthetic hospital {config['hospitalCode']}"]])
+    sheets['model'] = (['model_code', 'model_description'], [[config['modelCode'], f"Synthetic clinical costing model {config['modelCode']}"]])
+    sheets['feeder model'] = (['feeder_code', 'new_department_code', 'new_cost_type_code'],
+                              [[feeder, config['feederDepts'][feeder], 'invoices'] for feeder in config['feederCodes'] if config['feederTypes'][feeder] == 'C'])
+    sheets['mapping types'] = (['mapping_type_code', 'mapping_type_code_description'], [['A', 'Actual amount mapping'], ['F', 'Fractional cost mapping']])
+
+    # Map domestic costs to other, for every third department, as a fractional mapping
+    # and move some ward wages to the operating theatres, as an actual amount mapping
+    mapping = []
+    for i, dept in enumerate(departments):
+        if ((i % 3) == 0) and ('DOMC' in config['deptAccounts'][dept]):
+            mapping.append([dept, 'DOMC', 1, 'F', 1.0, dept, 'other'])
+    mapping.append([config['wardCodes'][0], 'S&W', 2, 'A', 1000.0, 'THTR', 'wages'])
+    sheets['general ledger mapping'] = (['from_department_code', 'from_cost_type_code', 'mapping_order', 'mapping_type_code', 'amount', 'to_department_code', 'to_cost_type_code'], mapping)
+
+    # Ward sub-departments are grouped into their ward
+    sheets['department grouping'] = (['from_department_code', 'to_department_code'], [[ward + 'N', ward] for ward in config['wardCodes']])
+
+    # Indirect departments don't have drugs
+    groupedToOther = set()
+    for dept in config['indirectLevels']:
+        if 'DRGS' in config['deptAccounts'][dept]:
+            groupedToOther.add((dept, 'DRGS'))
+    sheets['department cost type grouping'] = (['department_code', 'from_cost_type_code', 'to_cost_type_code'], [[dept, costType, 'other'] for dept, costType in sorted(groupedToOther)])
+    sheets['cost type grouping'] = (['from_cost_type_code', 'to_cost_type_code'], [[costType, groupedCostType] for costType, groupedCostType in groupedCostTypes.items()])
+
+    # The events
+    sheets['event type codes'] = (['event_type_code', 'event_type_description'],
+                                  [['ward', 'separate events/costs for each ward'], ['clinic', 'separate events/costs for each clinic'], ['other', 'one event/cost per event_code']])
+    sheets['event class codes'] = (['event_class_code', 'event_class_seq', 'event_class_description'],
+                                   [['Medical', 1.1, 'Medical Expenses'], ['ED', 2.1, 'Emergency Department Expenses'], ['Ward', 3.1, 'Ward Expenses'],
+                                    ['Clinic', 4.1, 'Clinic Expenses'], ['Theatre', 6.1, 'Theatre Expenses']])
+    sheets['event source codes'] = (['event_source_code', 'event_source_description'],
+                                    [['ED', 'Emergency Department episodes'], ['Inpat', 'Inpatient episodes'], ['Clinic', 'Clinic episodes'], ['Invoice', 'Invoices']])
+    sheets['event codes'] = (['event_code', 'event_type_code', 'event_class_code', 'event_source_code', 'event_description'],
+                             [[event, eventType, eventClass, eventSource, f'Event {event}'] for event, (eventType, eventClass, eventSource, subroutine, attribute, what, where) in modelEvents.items()])
+    attributeCodes = sorted({attribute for (eventType, eventClass, eventSource, subroutine, attribute, what, where) in modelEvents.values()})
+    sheets['event attribute codes'] = (['event_attribute_code', 'event_attribute_description'], [[attribute, f'Event attribute {attribute}'] for attribute in attributeCodes])
+    sheets['event subroutines'] = (['event_subroutine_name', 'event_subroutine_description'], [[name, description] for name, description in eventSubroutines.items()])
+    sheets['event attributes'] = (['event_code', 'event_attribute_code', 'event_subroutine_name', 'event_what', 'event_where', 'event_attribute_base', 'event_attribute_weight', 'event_acuity_scaling'],
+                                  [[event, attribute, subroutine, what, where, 0, 1.0, 1] for event, (eventType, eventClass, eventSource, subroutine, attribute, what, where) in modelEvents.items()])
+    sheets['ward attributes'] = (['ward_code', 'ward_attribute_base', 'ward_attribute_weight'], [])
+    sheets['clinic attributes'] = (['clinic_code', 'clinic_attribute_base', 'clinic_attribute_weight'], [])
+
+    # The distribution of each direct department's costs to events (by distribution code)
+    distributions = {}
+    for dept, (name, kind) in departments.items():
+        if kind == 'ED':
+            distributions[dept] = [('EDattend', 0.8), ('EDdir', 0.2)]
+        elif kind == 'ward':
+            distributions[dept] = [(dept + 'bdays', 0.9), (dept + 'admit', 0.1)]
+        elif kind == 'clinic':
+            distributions[dept] = [(dept + 'attend', 1.0)]
+        elif kind == 'theatre':
+            distributions[dept] = [('theatre', 1.0)]
+        elif kind == 'anaes':
+            distributions[dept] = [('anaes', 1.0)]
+        elif kind == 'feeder':
+            feeder = [feeder for feeder, feederDept in config['feederDepts'].items() if feederDept == dept][0]
+            distributions[dept] = [(feeder, 1.0)]
+
+    # The indirect departments are disbursed, level by level, by total cost or floor space
+    # and every department that isn't grouped into another department can receive overheads
+    sheets['general ledger attribute codes'] = (['general_ledger_attribute_code', 'general_ledger_attribute_description'], [['fs', 'Floor Space'], ['total', 'Total Expenditure']])
+    attributes = []
+    for dept, (name, kind) in departments.items():
+        if (kind == 'wardSub') or (config['indirectLevels'].get(dept) == 1):       # Level 1 departments have no overheads to receive
+            continue
+        attributes.append([dept, 'overheads', 'total', 0.0])
+        attributes.append([dept, 'overheads', 'fs', float(rng.randint(10, 500))])
+    sheets['general ledger attributes'] = (['department_code', 'cost_type_code', 'general_ledger_attribute_code', 'general_ledger_attribute_weight'], attributes)
+    disbursement = []
+    for i, (dept, level) in enumerate(config['indirectLevels'].items()):
+        attribute = ('total', 'fs')[i % 2]
+        costTypes = finalCostTypes(config, dept, groupedToOther)
+        if level > 1:           # Only level 2+ departments receive overheads from the levels before them
+            costTypes.append('overheads')
+        for costType in costTypes:
+            disbursement.append([dept, costType, attribute, level])
+    sheets['general ledger disbursement'] = (['department_code', 'cost_type_code', 'general_ledger_attribute_code', 'disbursement_level'], disbursement)
+
+    distributionCodes = {}
+    for dept, theseDistributions in distributions.items():
+        for distributionCode, fraction in theseDistributions:
+            if distributionCode not in config['feederCodes']:       # Feeder distribution codes are created when the model is loaded
+                distributionCodes[distributionCode] = f'Distribution of {dept} costs to {distributionCode}'
+    sheets['distribution codes'] = (['distribution_code', 'distribution_description'], [[code, description] for code, description in distributionCodes.items()])
+    distribution = []
+    for dept, theseDistributions in distributions.items():
+        costTypes = finalCostTypes(config, dept, groupedToOther) + ['overheads']
+        for costType in costTypes:
+            for distributionCode, fraction in theseDistributions:
+                distribution.append([dept, costType, distributionCode, fraction])
+    sheets['general ledger distribution'] = (['department_code', 'cost_type_code', 'distribution_code', 'distribution_fraction'], distribution)
+    return sheets
+
+
+def randomDate(rng, config):
+    '''
+    Return a random date within the run
+    '''
+    return config['startDate'] + datetime.timedelta(days=rng.randrange(config['days']))
+
+
+def buildActivity(rng, config):
+    '''
+    Build the patient activity worksheets
+    '''
+    sheets = {}
+    sheets['hospital'] = (['hospital_code', 'hospital_name'], [[config['hospitalCode'], f"Synthetic hospital {config['hospitalCode']}"]])
+    sheets['run'] = config['runSheet']
+
+    # Inpatient episodes, with one or more ward stays and possibly some surgery
+    episodes = []
+    admissions = []
+    discharges = []
+    locations = []
+    theatres = []
+    config['inpatEpisodes'] = []
+    for i in range(config['episodes']):
+        episodeNo = config['firstEpisodeNos']['Inpat'] + i
+        config['inpatEpisodes'].append(episodeNo)
+        wards = [rng.choice(config['wardCodes']) for j in range(rng.choice([1, 1, 1, 2, 2, 3]))]
+        bedDays = 0
+        bedHours = 0
+        for j, ward in enumerate(wards):
+            wardDays = rng.randint(0, 8)
+            wardHours = wardDays * 24 + rng.randint(1, 23)
+            bedDays += wardDays
+            bedHours += wardHours
+            locations.append([episodeNo, j + 1, ward, wardDays, wardHours, rng.randint(1, 3), 0.0])
+        acuity = rng.randint(1, 3)
+        episodes.append([episodeNo, episodeNo, acuity, str(rng.randint(1, 999)), str(rng.choice([4, 5, 6])), rng.choice(specialties),
+                         wards[0], rng.choice(config['doctors']), wards[-1], bedDays, bedHours, rng.randint(0, 10), rng.randint(0, 240),
+                         1 if bedDays == 0 else 0, len(wards) - 1, 'HO', rng.choice(financialCategories), rng.choice(['M', 'F']), 'N',
+                         str(rng.randint(3000, 3999)), money(rng.uniform(0.0, 20000.0))])
+        if rng.random() < 0.9:
+            admissions.append([episodeNo])
+        if rng.random() < 0.9:
+            discharges.append([episodeNo])
+        if rng.random() < 0.35:
+            for j in range(rng.choice([1, 1, 2])):
+                anaestheticMins = rng.randint(20, 180)
+                surgeryMins = max(10, anaestheticMins - rng.randint(5, 20))
+                theatreMins = anaestheticMins + rng.randint(5, 30)
+                theatres.append([episodeNo, j + 1, rng.choice(config['theatreCodes']), rng.choice(config['surgeons']), rng.choice(config['anaesthetists']),
+                                 str(rng.randint(1000, 9999)), theatreMins, surgeryMins, anaestheticMins, rng.randint(1, 3), 0.0])
+    sheets['Inpat episode details'] = (['episode_no', 'dch_episode_no', 'acuity', 'drg', 'care_type', 'clinical_specialty', 'admitting_ward_code', 'admitting_doctor_code',
+                                        'discharge_ward_code', 'bed_days', 'bed_hours', 'prev_bdays', 'prev_bhours', 'same_day', 'transfers',
+                                        'pat_cat', 'fin_cat', 'sex', 'ethnicity', 'postcode', 'revenue'], episodes)
+    sheets['Inpat admissions'] = (['episode_no'], admissions)
+    sheets['Inpat discharges'] = (['episode_no'], discharges)
+    sheets['Inpat patient location'] = (['episode_no', 'location_seq', 'ward_code', 'ward_days', 'ward_hours', 'acuity', 'revenue'], locations)
+    sheets['Inpat theatre details'] = (['episode_no', 'surgery_seq', 'theatre_code', 'surgeon_code', 'anaesth_code', 'procedure',
+                                        'theatre_mins', 'surgery_mins', 'anaesthetic_mins', 'theatre_acuity', 'revenue'], theatres)
+
+    # Clinic attendances
+    clinics = []
+    config['clinicEpisodes'] = []
+    for i in range(config['episodes']):
+        episodeNo = config['firstEpisodeNos']['Clinic'] + i
+        config['clinicEpisodes'].append(episodeNo)
+        clinic = rng.choice(config['clinicCodes'])
+        practitioner = rng.choice([code for thisClinic, code in config['practitioners'].items() if thisClinic == clinic] or ['none'])
+        clinics.append([episodeNo, rng.randint(10, 60), clinic, practitioner, 'HO', rng.choice(financialCategories), rng.choice(['M', 'F']), 'N',
+                        str(rng.randint(3000, 3999)), rng.randint(1, 3), 27.5])
+    sheets['Clinic activity details'] = (['episode_no', 'attend_min', 'clinic_code', 'practitioner_code', 'pat_cat', 'fin_cat', 'sex', 'ethnicity',
+                                          'postcode', 'acuity', 'revenue'], clinics)
+
+    # Emergency Department episodes
+    ed = []
+    edAdmissions = []
+    edDischarges = []
+    config['edEpisodes'] = []
+    for i in range(config['episodes'] * 3 // 2):
+        episodeNo = config['firstEpisodeNos']['ED'] + i
+        config['edEpisodes'].append(episodeNo)
+        attendMin = rng.randint(30, 900)
+        seenMin = attendMin - rng.randint(0, min(60, attendMin - 1))
+        treatMin = seenMin - rng.randint(0, min(30, seenMin - 1))
+        doctor = 'EDDIR' if rng.random() < 0.1 else rng.choice(config['edDoctors'][1:])
+        ed.append([episodeNo, attendMin, seenMin, treatMin, rng.randint(1, 5), doctor, 'SL', rng.choice(['D', 'D', 'D', 'A']), 'HO',
+                   rng.choice(financialCategories), rng.choice(['M', 'F']), 'N', str(rng.randint(3000, 3999)), rng.randint(1, 6), 168.5])
+        if rng.random() < 0.95:
+            edAdmissions.append([episodeNo])
+        if rng.random() < 0.95:
+            edDischarges.append([episodeNo])
+    sheets['ED episode details'] = (['episode_no', 'attend_min', 'seen_min', 'treat_min', 'urgency', 'doctor_code', 'adm_source', 'dch_destn',
+                                     'pat_cat', 'fin_cat', 'sex', 'ethnicity', 'postcode', 'acuity', 'revenue'], ed)
+    sheets['ED admissions'] = (['episode_no'], edAdmissions)
+    sheets['ED discharges'] = (['episode_no'], edDischarges)
+    return sheets
+
+
+def buildCosts(rng, config):
+    '''
+    Build the hospital costs worksheets - the itemized costs first,
+    so that the cost based feeder accounts in the General Ledger can cover them
+    '''
+    sheets = {}
+    sheets['hospital'] = (['hospital_code', 'hospital_name'], [[config['hospitalCode'], f"Synthetic hospital {config['hospitalCode']}"]])
+    sheets['run'] = config['runSheet']
+
+    # The itemized costs, spread evenly across the feeders
+    services = [('Inpat', config['inpatEpisodes'])] * 6 + [('ED', config['edEpisodes'])] * 3 + [('Clinic', config['clinicEpisodes'])]
+    itemizedSheets = []
+    itemSheets = {}
+    feederCosts = {}
+    itemHeadings = ['who', 'invoice_no', 'invoice_line_no', 'service_code', 'episode_no', 'item_date', 'what', 'department_code', 'cost_type_code', 'amount']
+    for i, feeder in enumerate(config['feederCodes']):
+        worksheet = f'{feeder} items'
+        itemizedSheets.append([worksheet, feeder])
+        items = []
+        feederCosts[feeder] = 0.0
+        dept = config['feederDepts'][feeder]
+        for j in range(config['items'] // len(config['feederCodes']) + (1 if i < (config['items'] % len(config['feederCodes'])) else 0)):
+            serviceCode, serviceEpisodes = rng.choice(services)
+            amount = money(rng.uniform(2.0, 200.0))
+            feederCosts[feeder] += amount
+            items.append([f'{feeder.upper()}SRV', str(10000 * (i + 1) + j // 20), j % 20 + 1, serviceCode, rng.choice(serviceEpisodes), randomDate(rng, config),
+                          str(rng.randint(10000, 99999)), dept, 'MSS', amount])
+        itemSheets[worksheet] = (itemHeadings, items)
+
+    # The General Ledger costs
+    glCosts = []
+    for dept, accounts in config['deptAccounts'].items():
+        for costType in accounts:
+            low, high = accountCosts.get(costType, otherAccountCosts)
+            cost = rng.uniform(low, high)
+            feeder = [feeder for feeder, feederDept in config['feederDepts'].items() if feederDept == dept]
+            if (costType == 'MSS') and feeder and (config['feederTypes'][feeder[0]] == 'C'):
+                cost = feederCosts[feeder[0]] * rng.uniform(1.02, 1.10)     # The invoices, plus some unitemized supplies
+            glCosts.append([dept, costType, money(cost)])
+    sheets['general ledger costs'] = (['department_code', 'cost_type_code', 'cost'], glCosts)
+    sheets['itemized costs'] = (['worksheet', 'feeder_code'], itemizedSheets)
+    sheets.update(itemSheets)
+
+    # Move some anaesthetist wages to the theatres for this run
+    anaesWages = [cost for dept, costType, cost in glCosts if (dept == 'ANAES') and (costType == 'S&W')][0]
+    sheets['general ledger run adjustments'] = (['from_department_code', 'from_cost_type_code', 'to_department_code', 'to_cost_type_code', 'mapping_order', 'mapping_type_code', 'amount'],
+                                                [['ANAES', 'S&W', 'THTR', 'wages', 1, 'A', money(anaesWages * 0.05)]])
+    sheets['gl attributes run adjustments'] = (['department_code', 'cost_type_code', 'general_ledger_attribute_code', 'general_ledger_attribute_weight'], [])
+    return sheets
+
+
+def writeData(sheets, outputDir, subDir, name, outputFormat):
+    '''
+    Write a set of worksheets as an Excel workbook, or as a directory of CSV or Parquet files
+    '''
+    thisDir = os.path.join(outputDir, subDir)
+    os.makedirs(thisDir, exist_ok=True)
+    if outputFormat == 'xlsx':
+        wb = Workbook(write_only=True)
+        for sheet, (headings, rows) in sheets.items():
+            ws = wb.create_sheet(sheet)
+            ws.append(headings)
+            for row in rows:
+                ws.append(row)
+        fileName = os.path.join(thisDir, name + '.xlsx')
+        wb.save(fileName)
+        logging.info('Workbook %s created', fileName)
+        return
+    thisDir = os.path.join(thisDir, name)
+    os.makedirs(thisDir, exist_ok=True)
+    for sheet, (headings, rows) in sheets.items():
+        if outputFormat == 'csv':
+            with open(os.path.join(thisDir, sheet + '.csv'), 'wt', newline='', encoding='utf-8') as csvFile:
+                csvWriter = csv.writer(csvFile)
+                csvWriter.writerow(headings)
+                csvWriter.writerows(rows)
+        else:
+            pd.DataFrame(rows, columns=headings).to_parquet(os.path.join(thisDir, sheet + '.parquet'), index=False)
+    logging.info('Directory %s created', thisDir)
+
+
+# The main code
+if __name__ == '__main__':
+    '''
+    Generate a synthetic set of Clinical Costing data
+    '''
+
+    # Get the script name (without the '.py' extension)
+    progName = os.path.basename(sys.argv[0])
+    progName = progName[0:-3]        # Strip off the .py ending
+
+    # Define the command line options
+    parser = argparse.ArgumentParser(prog=progName)
+    parser.add_argument('-O', '--outputDir', dest='outputDir', default='synthetic', help='The directory where the data will be created (default=synthetic)')
+    parser.add_argument('-F', '--format', dest='outputFormat', choices=['xlsx', 'csv', 'parquet'], default='xlsx', help='The format of the data (default=xlsx)')
+    parser.add_argument('-x', '--seed', dest='seed', type=int, default=1, help='The seed for the random number generator (default=1)')
+    parser.add_argument('-H', '--hospitalCode', dest='hospitalCode', default='hospitalS', help='The hospital code (default=hospitalS)')
+    parser.add_argument('-M', '--modelCode', dest='modelCode', default='modelS', help='The model code (default=modelS)')
+    parser.add_argument('-R', '--runCode', dest='runCode', default='Jun-97', help='The run code (default=Jun-97)')
+    parser.add_argument('-S', '--startDate', dest='startDate', default='1997-06-01', help='The first date (YYYY-MM-DD) of the run (default=1997-06-01)')
+    parser.add_argument('-N', '--days', dest='days', type=int, default=30, help='The number of days in the run (default=30)')
+    parser.add_argument('-e', '--episodes', dest='episodes', type=int, default=1000, help='The number of inpatient episodes (default=1000)')
+    parser.add_argument('-w', '--wards', dest='wards', type=int, default=8, help='The number of inpatient wards (default=8)')
+    parser.add_argument('-k', '--clinics', dest='clinics', type=int, default=4, help='The number of outpatient clinics (default=4)')
+    parser.add_argument('-f', '--feeders', dest='feeders', type=int, default=4, help='The number of feeder systems (default=4)')
+    parser.add_argument('-i', '--items', dest='items', type=int, default=5000, help='The number of itemized cost lines (default=5000)')
+    parser.add_argument('-a', '--accounts', dest='accounts', type=int, default=200, help='The number of General Ledger accounts (default=200)')
+    parser.add_argument('-g', '--depth', dest='depth', type=int, default=2, help='The number of levels of indirect departments (default=2)')
+    parser.add_argument('-n', '--sharedEpisodeNos', dest='sharedEpisodeNos', action='store_true', help='Use the same episode numbers in every service')
+    parser.add_argument('-v', '--verbose', dest='verbose', type=int, choices=list(range(0, 5)),
+                        help='The level of logging\n\t0=CRITICAL,1=ERROR,2=WARNING,3=INFO,4=DEBUG')
+    parser.add_argument('-L', '--logDir', dest='logDir', default='.', help='The name of a logging directory')
+    parser.add_argument('-l', '--logFile', dest='logFile', default=None, help='The name of the logging file')
+    parser.add_argument('args', nargs=argparse.REMAINDER)
+
+    # Parse the command line options
+    args = parser.parse_args()
+    outputDir = args.outputDir
+    outputFormat = args.outputFormat
+    seed = args.seed
+    logDir = args.logDir
+    logFile = args.logFile
+    loggingLevel = args.verbose
+
+    # Set up logging
+    logging_levels = {0:logging.CRITICAL, 1:logging.ERROR, 2:logging.WARNING, 3:logging.INFO, 4:logging.DEBUG}
+    logfmt = progName + ' [%(asctime)s]: %(message)s'
+    if loggingLevel and (loggingLevel not in logging_levels) :
+        sys.stderr.write(f'Error - invalid logging verbosity ({loggingLevel})\n')
+        parser.print_usage(sys.stderr)
+        sys.stderr.flush()
+        sys.exit(EX_USAGE)
+    if logFile :        # If sending to a file then check if the log directory exists
+        # Check that the logDir exists
+        if not os.path.isdir(logDir) :
+            sys.stderr.write(f'Error - logDir ({logDir}) does not exits\n')
+            parser.print_usage(sys.stderr)
+            sys.stderr.flush()
+            sys.exit(EX_USAGE)
+        with open(os.path.join(logDir,logFile), 'w') as logfile :
+            pass
+        if loggingLevel :
+            logging.basicConfig(format=logfmt, datefmt='%d/%m/%y %H:%M:%S %p', level=logging_levels[loggingLevel], filename=os.path.join(logDir, logFile))
+        else :
+            logging.basicConfig(format=logfmt, datefmt='%d/%m/%y %H:%M:%S %p', filename=os.path.join(logDir, logFile))
+        print(f'Now logging to {os.path.join(logDir, logFile)}')
+        sys.stdout.flush()
+    else :
+        if loggingLevel :
+            logging.basicConfig(format=logfmt, datefmt='%d/%m/%y %H:%M:%S %p', level=logging_levels[loggingLevel])
+        else :
+            logging.basicConfig(format=logfmt, datefmt='%d/%m/%y %H:%M:%S %p')
+        print('Now logging to sys.stderr')
+        sys.stdout.flush()
+
+    # Check the scale
+    for option in ['days', 'episodes', 'wards', 'clinics', 'feeders', 'items', 'depth']:
+        if getattr(args, option) < 1:
+            logging.critical('%s(%d) must be at least 1', option, getattr(args, option))
+            logging.shutdown()
+            sys.exit(EX_USAGE)
+    try:
+        startDate = datetime.datetime.strptime(args.startDate, '%Y-%m-%d')
+    except ValueError:
+        logging.critical('Invalid startDate(%s) - must be YYYY-MM-DD', args.startDate)
+        logging.shutdown()
+        sys.exit(EX_USAGE)
+
+    config = {}
+    config['hospitalCode'] = args.hospitalCode
+    config['modelCode'] = args.modelCode
+    config['startDate'] = startDate
+    config['days'] = args.days
+    config['episodes'] = args.episodes
+    config['wards'] = args.wards
+    config['clinics'] = args.clinics
+    config['feeders'] = args.feeders
+    config['items'] = args.items
+    config['accounts'] = args.accounts
+    config['depth'] = args.depth
+    if args.sharedEpisodeNos:
+        config['firstEpisodeNos'] = {'Inpat': 100000, 'Clinic': 100000, 'ED': 100000}
+    else:
+        config['firstEpisodeNos'] = {'Inpat': 100000, 'Clinic': 300000, 'ED': 500000}
+    endDate = startDate + datetime.timedelta(days=args.days - 1)
+    config['runSheet'] = (['run_code', 'run_description', 'start_date', 'end_date'],
+                          [[args.runCode, f'Synthetic run {args.runCode} (seed {seed})', startDate, endDate]])
+
+    # Build each set of worksheets, from the one seeded random number generator, so the data is reproducible
+    rng = random.Random(seed)
+    hospitalSheets = buildHospital(rng, config)
+    modelSheets = buildModel(rng, config)
+    activitySheets = buildActivity(rng, config)
+    costSheets = buildCosts(rng, config)
+
+    # Write out the data, in the same structure as the sample data
+    runName = args.runCode.replace('-', '')
+    try:
+        writeData(hospitalSheets, outputDir, os.path.join('hospitalConfig', 'hospitals'), args.hospitalCode, outputFormat)
+        writeData(modelSheets, outputDir, os.path.join('hospitalConfig', 'models'), args.modelCode, outputFormat)
+        writeData(activitySheets, outputDir, os.path.join('hospitalActivity', args.hospitalCode), runName + 'PatientActivity', outputFormat)
+        writeData(costSheets, outputDir, os.path.join('hospitalCosts', args.hospitalCode), runName + 'HospitalCostsAndAdjustments', outputFormat)
+    except OSError as e:
+        logging.critical('Cannot create output: %s', repr(e))
+        logging.shutdown()
+        sys.exit(EX_CANTCREAT)
+
+    glTotal = sum(cost for dept, costType, cost in costSheets['general ledger costs'][1])
+    print(f"Generated {len(config['departments'])} departments, {len(costSheets['general ledger costs'][1])} General Ledger accounts (${glTotal:.2f}),")
+    print(f"{config['episodes']} inpatient, {len(config['clinicEpisodes'])} clinic and {len(config['edEpisodes'])} ED episodes and {config['items']} itemized cost lines")
+    logging.shutdown()
+    sys.exit(EX_OK)
@@ -6,6 +6,13 @@
 A python script to add primary keys, indexes and foreign key constraints to a Clinical Costing database
 NOTE: The Clinical Costing system does not need this, but it will have a significant effect on performance
 
+As well as an index for each foreign key column, a curated set of composite (and covering) indexes is created
+for the queries that the costing stages actually issue (see workloadIndexes below).
+Curated indexes that would only repeat the leading columns of the primary key are skipped.
+
+The secondary (non primary key) indexes on the large run-scoped tables slow down bulk loads,
+so they can be dropped before a bulk load (-b drop) and rebuilt afterwards (-b rebuild).
+
 SYNOPSIS
 $ python indexSQLAlchemyDB.py 
                          [-D databaseType|--databaseType=databaseType]
@@ -13,10 +20,11 @@ $ python indexSQLAlchemyDB.py
                          [-u username|--username=username] [-p password|--password=password]
                          [-s Server|--Server=Server] [-d databaseName|--databaseName=databaseName]
                          [-v loggingLevel|--verbose=logingLevel] [-L logDir|--logDir=logDir] [-l logfile|--logfile=logfile]
+                         [-b bulkLoad|--bulkLoad=bulkLoad]
 
 REQUIRED
 -D databaseType|--databaseType=databaseType
-The type of database [eg:MSSQL/MySQL]
+The type of database [eg:MSSQL/MySQL/SQLite]
 
 
 OPTIONS
@@ -47,6 +55,10 @@ The directory where the log file will be written (default='.')
 
 -l logfile|--logfile=logfile
 The name of a logging file where you want all messages captured (default=None)
+
+-b bulkLoad|--bulkLoad=bulkLoad
+Only drop [drop] or only rebuild [rebuild] the secondary indexes on the large run-scoped tables (bulkLoadTables below),
+rather than creating the primary keys, foreign keys and indexes. Use 'drop' before a large bulk load and 'rebuild' after it.
 '''
 
 # Import all the modules that make life easy
@@ -56,7 +68,7 @@ import argparse
 import logging
 import collections
 import json
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.exc import OperationalError
 from sqlalchemy_utils import database_exists
 from alembic.migration import MigrationContext
@@ -83,6 +95,117 @@ EX_PROTOCOL = 76    # remote error in protocol
 EX_NOPERM = 77        # permission denied
 EX_CONFIG = 78        # configuration error
 
+# The composite indexes for the queries issued by the costing stages
+# (table, index suffix, key columns, covered columns, the queries that use it)
+# The covered columns are INCLUDEd (MSSQL) or appended to the key columns (other databases)
+workloadIndexes = [
+    ('events', 'distribution', ['hospital_code', 'run_code', 'model_code', 'distribution_code'], ['event_weight'],
+     'distribute_costs - the events (and weights) for each distribution code'),
+    ('event_costs', 'account', ['hospital_code', 'run_code', 'model_code', 'department_code', 'cost_type_code'], ['cost'],
+     'cost reporting by department and cost type'),
+    ('event_costs', 'episode', ['hospital_code', 'run_code', 'model_code', 'service_code', 'episode_no'], ['cost'],
+     'the cost rollups and episode cost lookups'),
+    ('itemized_costs', 'feeder', ['hospital_code', 'run_code', 'feeder_code'],
+     ['service_code', 'episode_no', 'invoice_no', 'invoice_line_no', 'department_code', 'cost_type_code', 'amount'],
+     'build_events and distribute_costs - the feeder events and costs for each feeder'),
+    ('itemized_costs', 'episode', ['hospital_code', 'run_code', 'service_code', 'episode_no'], [],
+     'the itemized costs for an episode'),
+    ('inpat_episode_details', 'episode', ['hospital_code', 'run_code', 'episode_no'], [], 'build_events and load_hospital_costs episode checks'),
+    ('inpat_patient_location', 'episode', ['hospital_code', 'run_code', 'episode_no'], [], 'build_events ward events'),
+    ('inpat_theatre_details', 'episode', ['hospital_code', 'run_code', 'episode_no'], [], 'build_events theatre events'),
+    ('clinic_activity_details', 'episode', ['hospital_code', 'run_code', 'episode_no'], [], 'build_events and load_hospital_costs episode checks'),
+    ('ed_episode_details', 'episode', ['hospital_code', 'run_code', 'episode_no'], [], 'build_events and load_hospital_costs episode checks'),
+]
+
+# The large run-scoped tables whose secondary indexes can be dropped before, and rebuilt after, a bulk load
+bulkLoadTables = ['events', 'event_costs', 'itemized_costs',
+                  'inpat_episode_details', 'inpat_admissions', 'inpat_discharges', 'inpat_patient_location', 'inpat_theatre_details',
+                  'clinic_activity_details', 'ed_episode_details', 'ed_admissions', 'ed_discharges']
+
+
+def createWorkloadIndexes(ops, engine, tables):
+    '''
+    Create the curated workload indexes on these tables (if they don't already exist and aren't covered by the primary key)
+    '''
+    isMSSQL = engine.dialect.name == 'mssql'
+    inspector = inspect(engine)
+    for thisTable, suffix, keyColumns, coveredColumns, usedBy in workloadIndexes:
+        if thisTable not in tables:
+            continue
+        indexName = f'{thisTable}_{suffix}'
+        columns = list(keyColumns)
+        if not isMSSQL:
+            columns += coveredColumns
+        primaryKey = inspector.get_pk_constraint(thisTable)['constrained_columns']
+        for index in inspector.get_indexes(thisTable):
+            if index['unique'] and (len(index['column_names']) > len(primaryKey)):      # SQLite primary keys are unique indexes
+                primaryKey = index['column_names']
+        if primaryKey[:len(columns)] == columns:
+            logging.info('Index %s not needed - covered by the primary key of %s', indexName, thisTable)
+            continue
+        if indexName in [index['name'] for index in inspector.get_indexes(thisTable)]:
+            logging.info('Index %s already exists', indexName)
+            continue
+        logging.info('Creating index %s for %s', indexName, usedBy)
+        if isMSSQL and (len(coveredColumns) > 0):
+            ops.create_index(indexName, thisTable, columns, mssql_include=coveredColumns)
+        else:
+            ops.create_index(indexName, thisTable, columns)
+
+
+def foreignKeyIndexName(engine, thisTable, column):
+    '''
+    The name of the index on a foreign key column (SQLite index names are global to the database, so they are prefixed with the table name)
+    '''
+    if engine.dialect.name == 'sqlite':
+        return f'{thisTable}_{column}'
+    return column
+
+
+def createForeignKeyIndexes(ops, engine, tables):
+    '''
+    Create an index on each foreign key column of these tables (if it doesn't already exist)
+    '''
+    inspector = inspect(engine)
+    for thisTable in tables:
+        existing = [index['name'] for index in inspector.get_indexes(thisTable)]
+        for column in dbConfig.Base.metadata.tables[thisTable].columns:
+            if not column.foreign_keys:
+                continue
+            indexName = foreignKeyIndexName(engine, thisTable, column.name)
+            if indexName in existing:
+                logging.info('Index %s already exists', indexName)
+                continue
+            ops.create_index(indexName, thisTable, [column.name])
+
+
+def dropSecondaryIndexes(ops, engine, tables):
+    '''
+    Drop the secondary (not unique) indexes on these tables, before a bulk load
+    '''
+    inspector = inspect(engine)
+    for thisTable in tables:
+        for index in inspector.get_indexes(thisTable):
+            if index['unique']:         # Leave primary keys (and SQLite unique _PRIMARY indexes) alone
+                continue
+            logging.info('Dropping index %s on %s', index['name'], thisTable)
+            try:
+                ops.drop_index(index['name'], table_name=thisTable)
+            except Exception as e:      # MySQL will not drop an index that a foreign key constraint needs
+                logging.warning('Cannot drop index %s on %s - %s', index['name'], thisTable, repr(e))
+
+
+def rebuildSecondaryIndexes(ops, engine, tables):
+    '''
+    Rebuild the secondary indexes (those in the schema, those on the foreign key columns and the curated workload indexes)
+    on these tables, after a bulk load
+    '''
+    for thisTable in tables:
+        for index in dbConfig.Base.metadata.tables[thisTable].indexes:
+            index.create(engine, checkfirst=True)
+    createForeignKeyIndexes(ops, engine, tables)
+    createWorkloadIndexes(ops, engine, tables)
+
 
 
 
@@ -98,7 +221,7 @@ if __name__ == '__main__':
 
     # Define the command line options
     parser = argparse.ArgumentParser(prog=progName)
-    parser.add_argument('-D', '--databaseType', dest='databaseType', required=True, help='The database Type [e.g.: MSSQL/MySQL]')
+    parser.add_argument('-D', '--databaseType', dest='databaseType', required=True, help='The database Type [e.g.: MSSQL/MySQL/SQLite]')
     parser.add_argument('-C', '--configDir', dest='configDir', default='../databaseConfig',
                         help='The name of the directory containing the database connection configuration file (default=config)')
     parser.add_argument('-c', '--configFile', dest='configFile', default='clinical_costing.json',
@@ -111,6 +234,8 @@ if __name__ == '__main__':
                         help='The level of logging\n\t0=CRITICAL,1=ERROR,2=WARNING,3=INFO,4=DEBUG')
     parser.add_argument('-L', '--logDir', dest='logDir', default='.', help='The name of a logging directory')
     parser.add_argument('-l', '--logFile', dest='logFile', default=None, help='The name of the logging file')
+    parser.add_argument('-b', '--bulkLoad', dest='bulkLoad', choices=['drop', 'rebuild'],
+                        help='Drop the secondary indexes on the large run-scoped tables before a bulk load, or rebuild them after it')
     parser.add_argument('args', nargs=argparse.REMAINDER)
 
     # Parse the command line options
@@ -125,6 +250,7 @@ if __name__ == '__main__':
     logDir = args.logDir
     logFile = args.logFile
     loggingLevel = args.verbose
+    bulkLoad = args.bulkLoad
 
     # Set up logging
     logging_levels = {0:logging.CRITICAL, 1:logging.ERROR, 2:logging.WARNING, 3:logging.INFO, 4:logging.DEBUG}
@@ -186,16 +312,16 @@ if __name__ == '__main__':
     if ('databaseName' in config[databaseType]) and (databaseName is None):
         databaseName = config[databaseType]['databaseName']
 
-    # Check that we have all the required paramaters
-    if username is None:
+    # Check that we have all the required paramaters (those used in the connectionString)
+    if (username is None) and ('{username}' in connectionString):
         logging.critical('Missing definition for "username"')
         logging.shutdown()
         sys.exit(EX_USAGE)
-    if password is None:
+    if (password is None) and ('{password}' in connectionString):
         logging.critical('Missing definition for "password"')
         logging.shutdown()
         sys.exit(EX_USAGE)
-    if server is None:
+    if (server is None) and ('{server}' in connectionString):
         logging.critical('Missing definition for "server"')
         logging.shutdown()
         sys.exit(EX_USAGE)
@@ -235,6 +361,21 @@ if __name__ == '__main__':
     mc = MigrationContext.configure(engine.connect())
     ops = Operations(mc)
 
+    # SQLite cannot add primary keys or foreign keys to an existing table (no ALTER TABLE ... ADD CONSTRAINT)
+    # so the primary key becomes a unique index and the foreign keys are not enforced.
+    # SQLite index names are global to the database, so they are prefixed with the table name.
+    isSQLite = engine.dialect.name == 'sqlite'
+
+    # Drop or rebuild the secondary indexes on the large run-scoped tables around a bulk load
+    if bulkLoad == 'drop':
+        dropSecondaryIndexes(ops, engine, bulkLoadTables)
+        logging.shutdown()
+        sys.exit(EX_OK)
+    elif bulkLoad == 'rebuild':
+        rebuildSecondaryIndexes(ops, engine, bulkLoadTables)
+        logging.shutdown()
+        sys.exit(EX_OK)
+
     # Create the primary key and any indexes on each table
     for thisTable in dbConfig.Base.metadata.tables:
         columns = []
@@ -242,16 +383,34 @@ if __name__ == '__main__':
             if column.primary_key:
                 columns.append(column.name)
         if len(columns) > 0:
-            ops.create_primary_key('PRIMARY', thisTable, columns)
-
-    # Create the foreign key constraints on each table
-    for thisTable in dbConfig.Base.metadata.tables:
-        fkNo = 1
-        for column in dbConfig.Base.metadata.tables[thisTable].columns:
-            if column.foreign_keys:
-                ops.create_index(column.name, thisTable, [column.name])
-                fkName = f'{thisTable}_FK{fkNo}'
-                fkNo += 1
-                key = list(column.foreign_keys)[0]
-                bits = key.target_fullname.split('.')
-                ops.create_foreign_key(fkName, thisTable, bits[0], [column.name], [bits[1]])
+            if isSQLite:
+                ops.create_index(f'{thisTable}_PRIMARY', thisTable, columns, unique=True)
+            else:
+                ops.create_primary_key('PRIMARY', thisTable, columns)
+
+    # Create an index on each foreign key column
+    createForeignKeyIndexes(ops, engine, dbConfig.Base.metadata.tables)
+
+    # The tables created partitioned by run (createSQLAlchemyDB.py -P) - MySQL does not allow foreign keys on partitioned tables
+    partitionedTables = []
+    if inspect(engine).has_table('partitioned_tables'):
+        with engine.connect() as conn:
+            partitionedTables = [row.table_name for row in conn.execute(text('SELECT table_name FROM partitioned_tables'))]
+
+    # Create the foreign key constraints on each table (SQLite cannot add them to an existing table)
+    if not isSQLite:
+        for thisTable in dbConfig.Base.metadata.tables:
+            if thisTable in partitionedTables:
+                logging.info('No foreign keys for %s - it is partitioned', thisTable)
+                continue
+            fkNo = 1
+            for column in dbConfig.Base.metadata.tables[thisTable].columns:
+                if column.foreign_keys:
+                    fkName = f'{thisTable}_FK{fkNo}'
+                    fkNo += 1
+                    key = list(column.foreign_keys)[0]
+                    bits = key.target_fullname.split('.')
+                    ops.create_foreign_key(fkName, thisTable, bits[0], [column.name], [bits[1]])
+
+    # Create the curated composite indexes for the costing stage queries
+    createWorkloadIndexes(ops, engine, dbConfig.Base.metadata.tables)
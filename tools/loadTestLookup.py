@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+# pylint: disable=unspecified-encoding, broad-exception-caught, line-too-long, invalid-name, pointless-string-statement
+
+'''
+Script loadTestLookup.py
+
+A python script to load test a running cost lookup service (cost_lookup.py).
+A mix of episode and DRG cost breakdown requests are sent, from several concurrent clients,
+and the latency percentiles (p50, p90, p99 and max), throughput and cache hit rates are reported.
+
+    SYNOPSIS
+
+    $ python loadTestLookup.py
+             [-U url|--url=url]
+             [-n requests|--requests=requests]
+             [-k clients|--clients=clients]
+             [-g drgShare|--drgShare=drgShare]
+             [-Z skew|--skew=skew]
+             [-x seed|--seed=seed]
+             [-o outputFile|--outputFile=outputFile]
+             [-v loggingLevel|--verbose=logingLevel]
+             [-L logDir|--logDir=logDir]
+             [-l logfile|--logfile=logfile]
+
+    OPTIONS
+    -U url|--url=url
+    The address of the cost lookup service (default='http://localhost:8000')
+
+    -n requests|--requests=requests
+    The number of requests to send (default=2000)
+
+    -k clients|--clients=clients
+    The number of concurrent clients (default=4)
+
+    -g drgShare|--drgShare=drgShare
+    The fraction of the requests that are for DRGs, rather than episodes (default=0.2)
+
+    -Z skew|--skew=skew
+    The Zipf exponent for choosing which episodes and DRGs are requested - 0 is uniform,
+    larger values concentrate the requests on fewer episodes and DRGs (default=1.0)
+
+    -x seed|--seed=seed
+    The seed for choosing the requests (default=1)
+
+    -o outputFile|--outputFile=outputFile
+    Save the latency of every request to this CSV file
+
+    -v loggingLevel|--verbose=loggingLevel
+    Set the level of logging that you want (defaut INFO).
+
+    -L logDir
+    The directory where the log file will be written (default='.')
+
+    -l logfile|--logfile=logfile
+    The name of a logging file where you want all messages captured
+    (default=None)
+
+    THE MAIN CODE
+    Fetch the costed episodes and DRGs from the service, choose the requests,
+    then send them from concurrent clients, timing each one, and report the latencies.
+'''
+
+# Import all the modules that make life easy
+import sys
+import os
+import csv
+import json
+import time
+import random
+import argparse
+import logging
+import statistics
+import urllib.parse
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+# This next section is plagurised from /usr/include/sysexits.h
+EX_OK = 0        # successful termination
+EX_WARN = 1        # non-fatal termination with warnings
+
+EX_USAGE = 64        # command line usage error
+EX_DATAERR = 65        # data format error
+EX_NOINPUT = 66        # cannot open input
+EX_NOUSER = 67        # addressee unknown
+EX_NOHOST = 68        # host name unknown
+EX_UNAVAILABLE = 69    # service unavailable
+EX_SOFTWARE = 70    # internal software error
+EX_OSERR = 71        # system error (e.g., can't fork)
+EX_OSFILE = 72        # critical OS file missing
+EX_CANTCREAT = 73    # can't create (user) output file
+EX_IOERR = 74        # input/output error
+EX_TEMPFAIL = 75    # temp failure; user is invited to retry
+EX_PROTOCOL = 76    # remote error in protocol
+EX_NOPERM = 77        # permission denied
+EX_CONFIG = 78        # configuration error
+
+
+def getJSON(url):
+    '''
+    GET a JSON response from the service
+    '''
+    with urllib.request.urlopen(url, timeout=30) as response:
+        return json.loads(response.read())
+
+
+def timeRequest(url):
+    '''
+    Send one request and return the url, HTTP status and latency (seconds)
+    '''
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=30) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except Exception as e:
+        logging.warning('Request (%s) failed - %s', url, repr(e))
+        status = None
+    return url, status, time.perf_counter() - start
+
+
+def zipfChoices(rng, population, skew, count):
+    '''
+    Choose count items from population, where the item ranked r (in a random ranking) is chosen with weight 1/r**skew
+    '''
+    ranked = list(population)
+    rng.shuffle(ranked)
+    weights = [1.0 / (rank ** skew) for rank in range(1, len(ranked) + 1)]
+    return rng.choices(ranked, weights=weights, k=count)
+
+
+def percentile(quantiles, p):
+    '''
+    The p'th percentile, from the 99 cut points returned by statistics.quantiles(n=100)
+    '''
+    return quantiles[p - 1]
+
+
+# The main code
+if __name__ == '__main__':
+    '''
+    Load test the cost lookup service
+    '''
+
+    # Get the script name (without the '.py' extension)
+    progName = os.path.basename(sys.argv[0])
+    progName = progName[0:-3]        # Strip off the .py ending
+
+    # Define the command line options
+    parser = argparse.ArgumentParser(prog=progName)
+    parser.add_argument('-U', '--url', dest='url', default='http://localhost:8000', help='The address of the cost lookup service (default=http://localhost:8000)')
+    parser.add_argument('-n', '--requests', dest='requests', type=int, default=2000, help='The number of requests to send (default=2000)')
+    parser.add_argument('-k', '--clients', dest='clients', type=int, default=4, help='The number of concurrent clients (default=4)')
+    parser.add_argument('-g', '--drgShare', dest='drgShare', type=float, default=0.2, help='The fraction of requests for DRGs (default=0.2)')
+    parser.add_argument('-Z', '--skew', dest='skew', type=float, default=1.0, help='The Zipf exponent for choosing episodes and DRGs (default=1.0)')
+    parser.add_argument('-x', '--seed', dest='seed', type=int, default=1, help='The seed for choosing the requests (default=1)')
+    parser.add_argument('-o', '--outputFile', dest='outputFile', default=None, help='A CSV file for the latency of every request')
+    parser.add_argument('-v', '--verbose', dest='verbose', type=int, choices=list(range(0, 5)),
+                        help='The level of logging\n\t0=CRITICAL,1=ERROR,2=WARNING,3=INFO,4=DEBUG')
+    parser.add_argument('-L', '--logDir', dest='logDir', default='.', help='The name of a logging directory')
+    parser.add_argument('-l', '--logFile', dest='logFile', default=None, help='The name of the logging file')
+    parser.add_argument('args', nargs=argparse.REMAINDER)
+
+    # Parse the command line options
+    args = parser.parse_args()
+    url = args.url.rstrip('/')
+    requests = args.requests
+    clients = args.clients
+    drgShare = args.drgShare
+    skew = args.skew
+    seed = args.seed
+    outputFile = args.outputFile
+    logDir = args.logDir
+    logFile = args.logFile
+    loggingLevel = args.verbose
+
+    # Set up logging
+    logging_levels = {0:logging.CRITICAL, 1:logging.ERROR, 2:logging.WARNING, 3:logging.INFO, 4:logging.DEBUG}
+    logfmt = progName + ' [%(asctime)s]: %(message)s'
+    if loggingLevel and (loggingLevel not in logging_levels) :
+        sys.stderr.write(f'Error - invalid logging verbosity ({loggingLevel})\n')
+        parser.print_usage(sys.stderr)
+        sys.stderr.flush()
+        sys.exit(EX_USAGE)
+    if logFile :        # If sending to a file then check if the log directory exists
+        # Check that the logDir exists
+        if not os.path.isdir(logDir) :
+            sys.stderr.write(f'Error - logDir ({logDir}) does not exits\n')
+            parser.print_usage(sys.stderr)
+            sys.stderr.flush()
+            sys.exit(EX_USAGE)
+        with open(os.path.join(logDir,logFile), 'w') as logfile :
+            pass
+        if loggingLevel :
+            logging.basicConfig(format=logfmt, datefmt='%d/%m/%y %H:%M:%S %p', level=logging_levels[loggingLevel], filename=os.path.join(logDir, logFile))
+        else :
+            logging.basicConfig(format=logfmt, datefmt='%d/%m/%y %H:%M:%S %p', filename=os.path.join(logDir, logFile))
+        print(f'Now logging to {os.path.join(logDir, logFile)}')
+        sys.stdout.flush()
+    else :
+        if loggingLevel :
+            logging.basicConfig(format=logfmt, datefmt='%d/%m/%y %H:%M:%S %p', level=logging_levels[loggingLevel])
+        else :
+            logging.basicConfig(format=logfmt, datefmt='%d/%m/%y %H:%M:%S %p')
+        print('Now logging to sys.stderr')
+        sys.stdout.flush()
+
+    # Check the options
+    if (requests < 1) or (clients < 1) or (not 0.0 <= drgShare <= 1.0) or (skew < 0.0):
+        logging.critical('Invalid options - requests and clients must be at least 1, drgShare between 0 and 1 and skew not negative')
+        logging.shutdown()
+        sys.exit(EX_USAGE)
+
+    # Fetch the costed episodes and DRGs
+    try:
+        episodes = getJSON(url + '/episodes')
+        drgs = getJSON(url + '/drgs')
+        statsBefore = getJSON(url + '/stats')
+    except Exception as e:
+        logging.critical('Cannot reach the cost lookup service (%s) - %s', url, repr(e))
+        logging.shutdown()
+        sys.exit(EX_UNAVAILABLE)
+    if not episodes:
+        logging.critical('The cost lookup service (%s) has no costed episodes', url)
+        logging.shutdown()
+        sys.exit(EX_NOINPUT)
+
+    # Choose the requests
+    rng = random.Random(seed)
+    drgRequests = round(requests * drgShare) if drgs else 0
+    urls = [url + '/episode/' + urllib.parse.quote(str(service), safe='') + '/' + str(episode) for service, episode in zipfChoices(rng, [tuple(episode) for episode in episodes], skew, requests - drgRequests)]
+    if drgRequests > 0:
+        urls += [url + '/drg/' + urllib.parse.quote(str(drg), safe='') for drg in zipfChoices(rng, drgs, skew, drgRequests)]
+    rng.shuffle(urls)
+
+    # Send them
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        results = list(executor.map(timeRequest, urls))
+    elapsed = time.perf_counter() - started
+    statsAfter = getJSON(url + '/stats')
+
+    # Report the latencies
+    failures = [result for result in results if result[1] not in (200, 404)]
+    print(f'{len(results)} requests from {clients} clients in {elapsed:.3f} seconds ({len(results) / elapsed:.1f} requests/second), {len(failures)} failed')
+    print(f"{'requests':<10} {'count':>7} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9} {'cache hits':>11}")
+    for kind in ['episode', 'drg']:
+        latencies = [result[2] * 1000.0 for result in results if result[0].startswith(url + '/' + kind + '/')]
+        if not latencies:
+            continue
+        if len(latencies) > 1:
+            quantiles = statistics.quantiles(latencies, n=100, method='inclusive')
+        else:
+            quantiles = latencies * 99
+        hits = statsAfter[kind]['hits'] - statsBefore[kind]['hits']
+        misses = statsAfter[kind]['misses'] - statsBefore[kind]['misses']
+        hitRate = f'{hits / (hits + misses):.1%}' if hits + misses > 0 else '-'
+        print(f'{kind:<10} {len(latencies):>7} {percentile(quantiles, 50):>9.3f} {percentile(quantiles, 90):>9.3f} {percentile(quantiles, 99):>9.3f} {max(latencies):>9.3f} {hitRate:>11}')
+    if statsAfter['invalidations'] != statsBefore['invalidations']:
+        print(f"The cache was cleared {statsAfter['invalidations'] - statsBefore['invalidations']} times (the run was republished)")
+
+    # Save the latency of every request
+    if outputFile is not None:
+        try:
+            with open(outputFile, 'wt', newline='') as csvOut:
+                writer = csv.writer(csvOut)
+                writer.writerow(['url', 'status', 'milliseconds'])
+                for thisUrl, status, seconds in results:
+                    writer.writerow([thisUrl, status, round(seconds * 1000.0, 3)])
+        except OSError as e:
+            logging.critical('Cannot write outputFile(%s) - %s', outputFile, repr(e))
+            logging.shutdown()
+            sys.exit(EX_CANTCREAT)
+
+    logging.shutdown()
+    if failures:
+        sys.exit(EX_SOFTWARE)
+    sys.exit(EX_OK)
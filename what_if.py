@@ -0,0 +1,378 @@
+# pylint: disable=line-too-long, broad-exception-caught
+'''
+Script what_if.py
+
+A python script to interactively explore what-if scenarios over a clinical costing run.
+The run (general_ledger_built, events and itemized_costs) is loaded once and the disbursement and distribution are done in memory.
+General ledger attribute weights, distribution fractions and event attribute bases and weights can then be overridden
+and the department, DRG and episode totals that change are reported in seconds, without rerunning the clinical costing stages.
+Nothing is written to the database - override the model tables and rerun the stages to make a scenario permanent.
+
+    SYNOPSIS:
+    $ python what_if.py hospital_code model_code run_code
+        [-i|--iterate]
+        [-t top|--top=top]
+        [-D DatabaseType|--DatabaseType=DatabaseType]
+        [-C configDir|--configDir=configDir]
+        [-c configFile|--configFile=configFile]
+        [-s server|--server=server]
+        [-u username|--username=username]
+        [-p password|--password=password]
+        [-d databaseName|--databaseName=databaseName]
+        [-v loggingLevel|--verbose=logingLevel]
+        [-L logDir|--logDir=logDir]
+        [-l logfile|--logfile=logfile]
+        [--profile[=mode]]
+        [--traceMemory]
+        [--roundTripThreshold=threshold]
+
+    REQUIRED
+    hospital_code
+    The hospital code for the hospital whose clinical costing run is being explored.
+
+    model_code
+    The model code for the clinical costing model that was used for the clinical costing run.
+
+    run_code
+    The run code for the clinical costing run being explored.
+
+    -D DatabaseType|--DatabaseType=DatabaseType
+    The type of database [choice:MSSQL/MySQL/SQLite]
+
+
+    OPTIONS
+    -i|--iterate
+    Disburse using iteration (as disburse_costs.py -i), rather than cascading
+
+    -t top|--top=top
+    The number of changed departments, DRGs and episodes to print for each scenario (default=10)
+
+    -C configDir|--configDir=configDir
+    The directory containing the database connection configuration file
+    (default='databaseConfig')
+
+    -c configFile|--configFile=configFile
+    The database connection configuration file (default=clinical_costing.json)
+    which has the default database values for each Database Type.
+    These can be overwritten using command line options.
+
+    -s server|--server=server]
+    The address of the database server
+
+    -u userName|--userName=userName]
+    The user name require to access the database
+
+    -p password|--userName=userName]
+    The user password require to access the database
+
+    -d databaseName|--databaseName=databaseName]
+    The name of the database
+
+    -v loggingLevel|--verbose=loggingLevel
+    Set the level of logging that you want.
+
+    -L logDir|--logDir=logDir
+    The directory where the log file will be created (default=".").
+
+    -l logfile|--logfile=logfile
+    The name of a log file where you want all messages captured.
+
+    --profile[=mode]
+    Profile this run [choice:cprofile/sampling] (default=cprofile) and save the pstats file (cprofile only)
+    and a collapsed-stack file (for flame graphs) in logDir, named after the stage, hospital, model and run.
+
+    --traceMemory
+    Trace memory allocations and save a memory report in logDir, with the top allocation sites
+    and the size of each DataFrame at each step of the stage.
+
+    --roundTripThreshold=threshold
+    When the SQL is profiled (INFO or DEBUG logging), report the SQL shapes executed more than threshold times
+    as possible N+1 patterns (default=100).
+
+
+    COMMANDS
+    Commands are read from standard input (so a scenario can be piped in from a file).
+    Codes containing spaces must be quoted.
+    attribute department_code cost_type_code general_ledger_attribute_code weight
+    Override the weight of a general ledger attribute
+
+    fraction department_code cost_type_code distribution_code fraction
+    Override a distribution fraction
+
+    event event_code event_attribute_code [base=base] [weight=weight]
+    Override the base and/or weight of an event attribute
+
+    show
+    Show the overrides for the next scenario
+
+    run
+    Run the scenario and print the top changes
+
+    save file
+    Save all the changes from the last scenario to file (.xlsx with a sheet each for departments, DRGs and episodes, or .csv)
+
+    reset
+    Clear all the overrides
+
+    quit
+    Exit
+
+
+    THE MAIN CODE
+    Start by parsing the command line arguements and setting up logging.
+    Connect to the database and check the hospital_code, model_code and run_code.
+    Then load the run and derive the baseline costs, and read and run scenarios until told to quit.
+'''
+
+# pylint: disable=invalid-name, bare-except, pointless-string-statement, unspecified-encoding
+
+import sys
+import cmd
+import shlex
+import argparse
+import logging
+import pandas as pd
+from sqlalchemy import text
+import functions as f
+import scenario_functions as sc
+import data as d
+
+
+class WhatIfShell(cmd.Cmd):
+    '''
+    Read and run what-if scenarios
+    '''
+    intro = 'Enter overrides, then "run" (or "help" for the commands)'
+
+    def __init__(self, scenario, top):
+        super().__init__()
+        self.scenario = scenario
+        self.top = top
+        self.attributeWeights = {}
+        self.distributionFractions = {}
+        self.eventAttributes = {}
+        self.result = None
+        if not sys.stdin.isatty():
+            self.prompt = ''
+            self.intro = None
+        else:
+            self.prompt = 'what-if> '
+
+    def splitLine(self, line, count):
+        '''
+        Split the arguments of a command, which must have count arguments
+        '''
+        try:
+            words = shlex.split(line)
+        except ValueError as e:
+            print(f'Invalid arguments({line}) - {e}')
+            return None
+        if len(words) != count:
+            print(f'Expected {count} arguments, got {len(words)}')
+            return None
+        return words
+
+    def emptyline(self):
+        return False
+
+    def do_attribute(self, line):
+        '''attribute department_code cost_type_code general_ledger_attribute_code weight - override a general ledger attribute weight'''
+        words = self.splitLine(line, 4)
+        if words is None:
+            return False
+        try:
+            self.attributeWeights[tuple(words[:3])] = float(words[3])
+        except ValueError:
+            print(f'Invalid weight({words[3]})')
+        return False
+
+    def do_fraction(self, line):
+        '''fraction department_code cost_type_code distribution_code fraction - override a distribution fraction'''
+        words = self.splitLine(line, 4)
+        if words is None:
+            return False
+        try:
+            self.distributionFractions[tuple(words[:3])] = float(words[3])
+        except ValueError:
+            print(f'Invalid fraction({words[3]})')
+        return False
+
+    def do_event(self, line):
+        '''event event_code event_attribute_code [base=base] [weight=weight] - override an event attribute base and/or weight'''
+        try:
+            words = shlex.split(line)
+        except ValueError as e:
+            print(f'Invalid arguments({line}) - {e}')
+            return False
+        if len(words) < 3:
+            print('Expected event_code, event_attribute_code and base=base and/or weight=weight')
+            return False
+        key = (words[0], words[1])
+        base, weight = self.eventAttributes.get(key, (None, None))
+        for word in words[2:]:
+            name, _, value = word.partition('=')
+            try:
+                if name == 'base':
+                    base = float(value)
+                elif name == 'weight':
+                    weight = float(value)
+                else:
+                    print(f'Unknown override({word}) - expected base=base or weight=weight')
+                    return False
+            except ValueError:
+                print(f'Invalid {name}({value})')
+                return False
+        self.eventAttributes[key] = (base, weight)
+        return False
+
+    def do_show(self, line):
+        '''show - show the overrides for the next scenario'''
+        for key, weight in self.attributeWeights.items():
+            print('attribute', *key, weight)
+        for key, fraction in self.distributionFractions.items():
+            print('fraction', *key, fraction)
+        for key, (base, weight) in self.eventAttributes.items():
+            print('event', *key, f'base={base}', f'weight={weight}')
+        return False
+
+    def do_reset(self, line):
+        '''reset - clear all the overrides'''
+        self.attributeWeights = {}
+        self.distributionFractions = {}
+        self.eventAttributes = {}
+        return False
+
+    def do_run(self, line):
+        '''run - run the scenario and print the top changes'''
+        try:
+            self.result = self.scenario.run(self.attributeWeights, self.distributionFractions, self.eventAttributes)
+        except ValueError as e:
+            print(f'Scenario failed - {e}')
+            return False
+        logging.info('Scenario run in %.3f seconds', self.result.seconds)
+        for title, changes_df in [('departments', self.result.departments), ('DRGs', self.result.drgs), ('episodes', self.result.episodes)]:
+            print(f'{len(changes_df.index)} {title} changed')
+            if len(changes_df.index) > 0:
+                print(changes_df.head(self.top).to_string(index=False, float_format='{:.2f}'.format))
+        print(f'Scenario run in {self.result.seconds:.3f} seconds')
+        return False
+
+    def do_save(self, line):
+        '''save file - save all the changes from the last scenario (.xlsx or .csv)'''
+        if self.result is None:
+            print('No scenario has been run')
+            return False
+        words = self.splitLine(line, 1)
+        if words is None:
+            return False
+        try:
+            if words[0].endswith('.csv'):
+                pd.concat([self.result.departments.assign(total='department'), self.result.drgs.assign(total='drg'),
+                           self.result.episodes.assign(total='episode')]).to_csv(words[0], index=False)
+            else:
+                with pd.ExcelWriter(words[0]) as writer:
+                    self.result.departments.to_excel(writer, sheet_name='departments', index=False)
+                    self.result.drgs.to_excel(writer, sheet_name='drgs', index=False)
+                    self.result.episodes.to_excel(writer, sheet_name='episodes', index=False)
+        except Exception as e:
+            print(f'Cannot save scenario to {words[0]} - {e}')
+        return False
+
+    def do_quit(self, line):
+        '''quit - exit'''
+        return True
+
+    def do_EOF(self, line):
+        '''End of input - exit'''
+        return True
+
+
+if __name__ == '__main__':
+    '''
+    The main code
+    Start by parsing the command line arguements and setting up logging.
+    Then check that the hospital_code, model_code and run_code are valid.
+    Then load the run and run scenarios.
+    '''
+
+    # Save the program name
+    progName = sys.argv[0]
+    progName = progName[0:-3]        # Strip off the .py ending
+
+    # Set the options
+    parser = argparse.ArgumentParser(description='Explore what-if scenarios over a Clinical Costing run')
+    parser.add_argument('hospital_code',
+                        help='The hospital code for the hospital whose clinical costing run is being explored.')
+    parser.add_argument('model_code',
+                        help='The model code for the clinical costing model that was used for the clinical costing run.')
+    parser.add_argument('run_code',
+                        help='The run code for the clinical costing run being explored.')
+    parser.add_argument('-i', '--iterate', dest='useIteration', action='store_true',
+                        help='Disburse using iteration, rather than cascading')
+    parser.add_argument('-t', '--top', dest='top', type=int, default=10,
+                        help='The number of changed departments, DRGs and episodes to print (default=10)')
+    f.addCommonArguments(parser)      # Add the common command line arguments
+    args = parser.parse_args()
+
+    # Parse the command line options
+    d.hospital_code = args.hospital_code
+    d.model_code = args.model_code
+    d.run_code = args.run_code
+    useIteration = args.useIteration
+    top = args.top
+    configDir = args.configDir
+    configFile = args.configFile
+    DatabaseType = args.DatabaseType
+    server = args.server
+    username = args.username
+    password = args.password
+    databaseName = args.databaseName
+    logDir = args.logDir
+    logFile = args.logFile
+    loggingLevel = args.verbose
+
+    # Set up logging
+    f.setupLogging(progName, logDir, logFile, loggingLevel)
+
+    # Read in the configuration file - which must exist if required - and create the database engine
+    f.createEngine(configDir, configFile, DatabaseType, server, username, password, databaseName)
+
+    # Check that the hospital_code is valid
+    hospitals_df = pd.read_sql_query(text('SELECT hospital_code FROM hospitals'), d.engine.connect())
+    hospitals = hospitals_df.values.tolist()      # convert rows/columns to a list of lists (will be [[hospital_code]] )
+    if not [d.hospital_code] in hospitals:
+        logging.critical('hospital code (%s) no in table "hospitals"', d.hospital_code)
+        logging.shutdown()
+        sys.exit(d.EX_CONFIG)
+
+    # Check that the model_code is valid
+    models_df = pd.read_sql_query(text(f'SELECT model_code FROM models WHERE hospital_code = {f.sqlLiteral(d.hospital_code)}'), d.engine.connect())
+    models = models_df.values.tolist()      # convert rows/columns to a list of lists (will be [[model_code]] )
+    if not [d.model_code] in models:
+        logging.critical('model code (%s) no in table "models"', d.model_code)
+        logging.shutdown()
+        sys.exit(d.EX_CONFIG)
+
+    # Check that the run_code is valid
+    selectText = 'SELECT run_code FROM clinical_costing_runs WHERE hospital_code = ' + f.sqlLiteral(d.hospital_code)
+    runs_df = pd.read_sql_query(text(selectText), d.engine.connect())
+    runs = runs_df.values.tolist()      # convert rows/columns to a list of lists (will be [[run_code]] )
+    if not [d.run_code] in runs:
+        logging.critical('run code (%s) no in table "clinical_costing_runs"', d.run_code)
+        logging.shutdown()
+        sys.exit(d.EX_CONFIG)
+
+    # Load the run and derive the baseline
+    try:
+        scenario = sc.Scenario(useIteration)
+    except ValueError as e:
+        logging.critical('Cannot derive the baseline for this run - %s', e)
+        logging.shutdown()
+        sys.exit(d.EX_DATAERR)
+    print(f'{len(scenario.accounts)} accounts, {len(scenario.episodes)} episodes, ${scenario.baseEpisodeCosts.sum():.2f} distributed')
+
+    # Run the scenarios
+    WhatIfShell(scenario, top).cmdloop()
+
+    logging.shutdown()
+    sys.exit(d.EX_OK)